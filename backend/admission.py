@@ -0,0 +1,216 @@
+"""Memory-aware job admission: per-job peak memory estimates against a node budget"""
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".webp")
+
+# Rough model of where a render's memory goes (corrected at runtime, see release())
+JOB_OVERHEAD = 150 * MB  # interpreter state, clip objects, audio buffers
+VIDEO_READER = 60 * MB  # one ffmpeg reader process per open video
+ENCODER_OVERHEAD = 50 * MB
+ENCODER_FRAMES = 40  # frames the x264 encoder keeps in flight (lookahead, references)
+READER_FRAMES = 4  # frames buffered per open video clip
+DEFAULT_SIZE = (1920, 1080)
+
+# (estimated bytes, engine) as returned by estimate()
+Footprint = Tuple[int, str]
+
+
+def detect_memory_limit() -> int:
+    """Memory available to this container: the cgroup limit, else physical RAM"""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 60:
+                return int(value)
+        except OSError:
+            continue
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return 4 * 1024 * MB
+
+
+def process_tree_rss(pid: Optional[int] = None) -> Optional[int]:
+    """Resident memory of a process and all its descendants (ffmpeg included)"""
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    pending = [pid or os.getpid()]
+    try:
+        while pending:
+            current = pending.pop()
+            try:
+                with open(f"/proc/{current}/statm") as f:
+                    total += int(f.read().split()[1]) * page_size
+                for tid in os.listdir(f"/proc/{current}/task"):
+                    with open(f"/proc/{current}/task/{tid}/children") as f:
+                        pending.extend(int(child) for child in f.read().split())
+            except (FileNotFoundError, ProcessLookupError):
+                continue  # exited while we were looking
+    except OSError:
+        return None
+    return total
+
+
+def _local_image_size(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        from PIL import Image  # not on the API's startup path
+        with Image.open(path) as img:  # reads the header only
+            return img.size
+    except Exception:
+        return None
+
+
+class MemoryAdmission:
+    """Admits jobs while the sum of their estimated peaks fits the node budget.
+
+    ``estimate`` models a job from what is known before it runs: output
+    resolution, item count and types, local image dimensions and the engine
+    (``compose`` keeps every clip open at once, ``segments`` renders one
+    item at a time). When jobs run in this process, a sampler thread
+    measures the resident memory of the process tree, attributes it to
+    running jobs in proportion to their estimates, and keeps a per-engine
+    correction factor from the observed peaks of finished jobs. The first job is always admitted, even if its
+    estimate exceeds the budget, so nothing waits forever.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reserved: Dict[str, Footprint] = {}
+        self._raw: Dict[str, int] = {}
+        self._peaks: Dict[str, int] = {}
+        self._factors: Dict[str, float] = {}
+        self._baseline: Optional[int] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.budget = settings.memory_budget_bytes or int(detect_memory_limit() * settings.memory_budget_fraction)
+
+    def estimate(self, media_items: List[dict], output_settings: dict, engine: str) -> Footprint:
+        raw = self._raw_estimate(media_items, output_settings, engine)
+        return int(raw * self._factors.get(engine, 1.0)), engine
+
+    def fits(self, footprint: Footprint) -> bool:
+        with self._lock:
+            if not self._reserved:
+                return True
+            return sum(size for size, _ in self._reserved.values()) + footprint[0] <= self.budget
+
+    def reserve(self, job_id: str, footprint: Footprint):
+        size, engine = footprint
+        with self._lock:
+            if not self._reserved:
+                self._baseline = process_tree_rss()
+            self._reserved[job_id] = footprint
+            self._raw[job_id] = int(size / self._factors.get(engine, 1.0))
+            self._peaks[job_id] = 0
+        self._ensure_sampler()
+
+    def release(self, job_id: str):
+        with self._lock:
+            footprint = self._reserved.pop(job_id, None)
+            raw = self._raw.pop(job_id, None)
+            peak = self._peaks.pop(job_id, 0)
+            if footprint is None or not raw or not peak:
+                return
+            # Learn how far off the model was for this engine
+            engine = footprint[1]
+            ratio = min(max(peak / raw, 0.25), 8.0)
+            factor = self._factors.get(engine)
+            self._factors[engine] = ratio if factor is None else 0.7 * factor + 0.3 * ratio
+        logger.info(f"Job {job_id} peaked at ~{peak // MB}MB (estimated {footprint[0] // MB}MB)")
+
+    def forget(self, job_id: str):
+        """Drop a reservation without learning from it (the job will not render here after all)"""
+        with self._lock:
+            self._reserved.pop(job_id, None)
+            self._raw.pop(job_id, None)
+            self._peaks.pop(job_id, None)
+
+    def status(self) -> dict:
+        with self._lock:
+            reserved = sum(size for size, _ in self._reserved.values())
+            return {
+                "budget_bytes": self.budget,
+                "reserved_bytes": reserved,
+                "available_bytes": max(self.budget - reserved, 0),
+                "running": len(self._reserved),
+                "baseline_bytes": self._baseline,
+                "correction_factors": dict(self._factors),
+            }
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join(5)
+            self._sampler = None
+
+    def _raw_estimate(self, media_items: List[dict], output_settings: dict, engine: str) -> int:
+        size = self._output_size(media_items, output_settings)
+        frame = size[0] * size[1] * 3
+        items = []
+        for item in media_items:
+            path = item.get("url") or item.get("path") or ""
+            if self._is_image(item, path):
+                local = None if path.startswith(("http://", "https://")) else _local_image_size(path)
+                pixels = local[0] * local[1] if local else settings.memory_default_image_pixels
+                items.append(pixels * 4 + frame * 2)  # decoded RGB(A) plus the resized frame
+            else:
+                items.append(VIDEO_READER + frame * READER_FRAMES)
+        per_items = sum(items) if engine == "compose" else max(items, default=0)
+        return JOB_OVERHEAD + ENCODER_OVERHEAD + frame * ENCODER_FRAMES + per_items
+
+    def _output_size(self, media_items: List[dict], output_settings: dict) -> Tuple[int, int]:
+        resolution = output_settings.get("resolution")
+        if resolution:
+            try:
+                width, height = map(int, resolution.lower().split("x"))
+                return width, height
+            except ValueError:
+                pass
+        # Without a requested resolution the first item decides
+        if media_items:
+            path = media_items[0].get("url") or media_items[0].get("path") or ""
+            if not path.startswith(("http://", "https://")) and self._is_image(media_items[0], path):
+                return _local_image_size(path) or DEFAULT_SIZE
+        return DEFAULT_SIZE
+
+    def _is_image(self, item: dict, path: str) -> bool:
+        if item.get("media_type") in ("image", "video"):
+            return item["media_type"] == "image"
+        return path.lower().split("?")[0].endswith(IMAGE_EXTENSIONS)
+
+    def _ensure_sampler(self):
+        if settings.job_executor == "celery":
+            return  # jobs run on the workers; nothing to measure here
+        with self._lock:
+            if self._sampler and self._sampler.is_alive():
+                return
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name="memory-sampler", daemon=True)
+            self._sampler.start()
+
+    def _sample_loop(self):
+        while not self._stop.wait(settings.memory_sample_interval):
+            rss = process_tree_rss()
+            if rss is None:
+                return
+            with self._lock:
+                if not self._reserved:
+                    self._baseline = rss
+                    continue
+                used = rss - (self._baseline or 0)
+                total = sum(self._raw.values()) or 1
+                for job_id, raw in self._raw.items():
+                    self._peaks[job_id] = max(self._peaks.get(job_id, 0), used * raw // total)
+
+
+memory_admission = MemoryAdmission()
@@ -0,0 +1 @@
+"""Offline benchmarks: synthetic media served from a local origin, machine-readable results"""
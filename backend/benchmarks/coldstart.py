@@ -0,0 +1,167 @@
+"""Cold-start benchmark: how long until the API serves and the engine can render.
+
+    python -m benchmarks.coldstart --runs 5 --output coldstart.json
+    python -m benchmarks.coldstart --runs 5 --compare coldstart.json
+
+Every run starts fresh interpreters, the way a new container or worker does:
+
+- ``import_seconds``: ``import main``
+- ``serve_seconds``: uvicorn started until /api/v1/health first answers
+- ``engine_ready_seconds``: uvicorn started until health reports the engine
+  loaded and warmed (the API loads it in the background)
+- ``worker_warm_seconds``: what a Celery worker spends in worker_init
+  importing and warming the engine, split into ``engine_load_seconds`` and
+  ``engine_warm_seconds``
+
+The OS page cache is not dropped, so after the first run these are warm-disk
+numbers; the first run of a fresh container is the ``max``.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks import results
+from benchmarks.loadtest import BACKEND_DIR, free_port
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("import_seconds", "serve_seconds", "engine_ready_seconds",
+           "worker_warm_seconds", "engine_load_seconds", "engine_warm_seconds")
+
+WORKER_WARM = (
+    "import json, time; started = time.perf_counter()\n"
+    "from engine import engine; engine.load(warm=True)\n"
+    "print(json.dumps(dict(engine.status(), total=time.perf_counter() - started)))\n"
+)
+
+
+def server_env(args) -> dict:
+    env = dict(
+        os.environ,
+        JOB_EXECUTOR="background",
+        CHECKPOINT_ENABLED="false",
+        STORAGE_PATH=os.path.join(args.workdir, "storage"),
+        SCRATCH_PATH=os.path.join(args.workdir, "scratch"),
+    )
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    return env
+
+
+def time_import(env: dict) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=BACKEND_DIR, env=env,
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def time_server(env: dict, args) -> Dict[str, float]:
+    """Start uvicorn and poll health until it answers, then until the engine is ready"""
+    port = free_port()
+    log = open(os.path.join(args.workdir, "coldstart-server.log"), "w")
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    measured = {}
+    try:
+        with httpx.Client(timeout=2) as client:
+            deadline = started + args.timeout
+            while time.perf_counter() < deadline:
+                if server.poll() is not None:
+                    raise SystemExit(f"API server exited; see {log.name}")
+                try:
+                    health = client.get(f"http://127.0.0.1:{port}/api/v1/health").json()
+                except httpx.HTTPError:
+                    time.sleep(args.poll_interval)
+                    continue
+                measured.setdefault("serve_seconds", time.perf_counter() - started)
+                engine = health.get("engine") or {}
+                if engine.get("state") == "unavailable":
+                    raise SystemExit(f"The engine failed to load: {engine.get('error')}")
+                if engine.get("state") == "ready" and engine.get("warm_seconds") is not None:
+                    measured["engine_ready_seconds"] = time.perf_counter() - started
+                    break
+                time.sleep(args.poll_interval)
+            else:
+                raise SystemExit(f"API server did not become ready within {args.timeout}s; see {log.name}")
+    finally:
+        server.terminate()
+        server.wait(10)
+        log.close()
+    return measured
+
+
+def time_worker_warm(env: dict) -> Dict[str, float]:
+    output = subprocess.run([sys.executable, "-c", WORKER_WARM], cwd=BACKEND_DIR, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    status = json.loads(output.strip().splitlines()[-1])
+    return {
+        "worker_warm_seconds": status["total"],
+        "engine_load_seconds": status["load_seconds"],
+        "engine_warm_seconds": status["warm_seconds"],
+    }
+
+
+def comparison_metrics() -> Dict[str, bool]:
+    return {f"{metric}.p50": False for metric in METRICS}
+
+
+def print_table(result: dict):
+    print(f"coldstart: {result['parameters']['runs']} runs")
+    print(f"  {'':24} {'p50':>8} {'max':>8}")
+    for metric in METRICS:
+        summary = result[metric]
+        print(f"  {metric:24} {_fmt(summary['p50']):>8} {_fmt(summary['max']):>8}")
+    results.print_comparison(result)
+
+
+def _fmt(value) -> str:
+    return "-" if value is None else f"{value:.3f}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="API and worker cold-start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a server to be ready")
+    parser.add_argument("--poll-interval", type=float, default=0.01)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "video-processor-bench"))
+    parser.add_argument("--output", help="write the JSON result here")
+    parser.add_argument("--compare", help="a previous JSON result to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    os.makedirs(args.workdir, exist_ok=True)
+    env = server_env(args)
+
+    samples: Dict[str, List[float]] = {metric: [] for metric in METRICS}
+    for _ in range(args.runs):
+        measured = {"import_seconds": time_import(env)}
+        measured.update(time_server(env, args))
+        measured.update(time_worker_warm(env))
+        for metric, value in measured.items():
+            if value is not None:
+                samples[metric].append(value)
+
+    result = results.new_result("coldstart", {"runs": args.runs, "poll_interval": args.poll_interval})
+    result.update({metric: results.summarize(values) for metric, values in samples.items()})
+    if args.compare:
+        result["comparison"] = results.compare(result, results.load(args.compare), comparison_metrics())
+    results.write(result, args.output)
+    print_table(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""Download-path benchmark against the local origin emulator.
+
+    python -m benchmarks.downloads --sizes 2,32 --downloads 3 --output downloads.json
+    python -m benchmarks.downloads --scenarios baseline,drive_confirm,disconnect --compare downloads.json
+
+Each scenario starts an OriginEmulator with its faults and runs
+VideoProcessor.download_file for every size. Per scenario and size it
+reports latency, throughput, the time until the first body byte left the
+origin (interstitials, redirects and retries included), requests and
+bytes per download, and the extra time over the ``baseline`` scenario.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from benchmarks import results
+from benchmarks.emulator import OriginEmulator
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# name -> (emulator faults, "direct" or "drive" URLs)
+SCENARIOS: Dict[str, tuple] = {
+    "baseline": ({}, "direct"),
+    "no_ranges": ({"ranges": False}, "direct"),
+    "no_length": ({"ranges": False, "content_length": False}, "direct"),
+    "slow_start": ({"first_byte_delay": 1.0}, "direct"),
+    "bandwidth": ({"rate": 8 * MB}, "direct"),  # per connection, so ranges help
+    "throttled": ({"throttle_every": 3, "retry_after": 1}, "direct"),
+    "unavailable": ({"unavailable_first": 1}, "direct"),
+    "disconnect": ({"disconnect_after": MB, "ranges": False}, "direct"),  # restarts from byte 0
+    "disconnect_ranged": ({"disconnect_after": MB, "disconnects": 2}, "direct"),  # ranges resume
+    "redirects": ({"redirects": 3}, "direct"),
+    "html": ({"html": True}, "direct"),
+    "drive": ({}, "drive"),
+    "drive_confirm": ({"drive_confirm": "link"}, "drive"),
+    "drive_confirm_form": ({"drive_confirm": "form"}, "drive"),
+}
+
+# metric path template -> True when higher is better (one entry per scenario and size)
+SCENARIO_METRICS = {
+    "latency_seconds.p50": False,
+    "throughput_mb_s.p50": True,
+    "requests_per_download": False,
+}
+
+
+def create_files(directory: str, sizes_mb: List[float]) -> Dict[float, str]:
+    """One file of random bytes per size, reused across runs"""
+    os.makedirs(directory, exist_ok=True)
+    files = {}
+    for size_mb in sizes_mb:
+        name = f"download-{size_mb:g}mb.bin"
+        path = os.path.join(directory, name)
+        size = int(size_mb * MB)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            with open(path, "wb") as f:
+                remaining = size
+                while remaining:
+                    block = os.urandom(min(remaining, 4 * MB))
+                    f.write(block)
+                    remaining -= len(block)
+        files[size_mb] = name
+    return files
+
+
+def size_label(size_mb: float) -> str:
+    return f"{size_mb:g}mb".replace(".", "_")  # no dots: labels are parts of metric paths
+
+
+def run_scenario(name: str, files: Dict[float, str], args) -> Dict[str, dict]:
+    from downloader import get_session
+    from origin_guard import origin_guard
+    from video_processor import VideoProcessor
+
+    faults, kind = SCENARIOS[name]
+    processor = VideoProcessor()
+    session = get_session()
+    output_dir = os.path.join(args.workdir, "downloaded")
+    os.makedirs(output_dir, exist_ok=True)
+    measured = {}
+
+    with OriginEmulator(os.path.join(args.workdir, "files"), faults) as emulator:
+        origin_guard.reset()  # no circuit or negative cache state from the previous scenario
+        if kind == "drive":
+            session.proxies["http"] = emulator.base_url
+        try:
+            for size_mb, file_name in files.items():
+                def download(_) -> dict:
+                    alias = uuid.uuid4().hex[:12]
+                    url = emulator.drive_url(file_name, alias) if kind == "drive" else emulator.file_url(file_name, alias)
+                    output_path = os.path.join(output_dir, f"{alias}-{file_name}")
+                    started = time.perf_counter()
+                    outcome = {"alias": f"{file_name}~{alias}" if kind == "drive" else f"/files/{alias}/{file_name}"}
+                    try:
+                        processor.download_file(url, output_path)
+                        outcome["ok"] = os.path.getsize(output_path) == int(size_mb * MB)
+                        if not outcome["ok"]:
+                            outcome["error"] = f"size mismatch: {os.path.getsize(output_path)} bytes"
+                    except Exception as e:
+                        outcome.update(ok=False, error=str(e).strip().splitlines()[0][:300])
+                    finally:
+                        outcome["latency"] = time.perf_counter() - started
+                        if os.path.exists(output_path):
+                            os.remove(output_path)
+                    return outcome
+
+                with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="bench-download") as pool:
+                    outcomes = list(pool.map(download, range(args.downloads)))
+                seen = emulator.downloads()
+                measured[size_label(size_mb)] = summarize_size(outcomes, seen, int(size_mb * MB))
+        finally:
+            session.proxies.pop("http", None)
+    return measured
+
+
+def summarize_size(outcomes: List[dict], seen: Dict[str, dict], size: int) -> dict:
+    succeeded = [outcome for outcome in outcomes if outcome["ok"]]
+    origin = [seen.get(outcome["alias"], {}) for outcome in outcomes]
+    first_bytes = [entry["first_byte_seconds"] for entry in origin if entry.get("first_byte_seconds") is not None]
+    statuses: Dict[str, int] = {}
+    for entry in origin:
+        for status, count in entry.get("statuses", {}).items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    return {
+        "downloads": len(outcomes),
+        "failed": len(outcomes) - len(succeeded),
+        "latency_seconds": results.summarize([outcome["latency"] for outcome in succeeded]),
+        "throughput_mb_s": results.summarize([size / MB / outcome["latency"] for outcome in succeeded]),
+        "first_byte_seconds": results.summarize(first_bytes),
+        "requests_per_download": round(sum(entry.get("requests", 0) for entry in origin) / len(outcomes), 2),
+        "bytes_sent_per_download": int(sum(entry.get("bytes_sent", 0) for entry in origin) / len(outcomes)),
+        "disconnects": sum(entry.get("disconnects", 0) for entry in origin),
+        "statuses": statuses,
+        "errors": sorted({outcome["error"] for outcome in outcomes if outcome.get("error")})[:5],
+    }
+
+
+def add_retry_cost(scenarios: Dict[str, dict]):
+    """Extra median time over the baseline scenario for the same size"""
+    baseline = scenarios.get("baseline", {})
+    for measured in scenarios.values():
+        for size, entry in measured.items():
+            reference = baseline.get(size, {}).get("latency_seconds", {}).get("p50")
+            current = entry["latency_seconds"]["p50"]
+            entry["extra_seconds_over_baseline"] = (
+                round(current - reference, 3) if current is not None and reference is not None else None
+            )
+
+
+def comparison_metrics(result: dict) -> Dict[str, bool]:
+    return {
+        f"scenarios.{scenario}.{size}.{metric}": higher_is_better
+        for scenario, measured in result["scenarios"].items()
+        for size in measured
+        for metric, higher_is_better in SCENARIO_METRICS.items()
+    }
+
+
+def print_table(result: dict):
+    print(f"{'scenario':20} {'size':>6} {'ok':>5} {'p50 s':>8} {'MB/s':>8} {'ttfb s':>8} {'req/dl':>7} {'+s':>7}")
+    for scenario, measured in result["scenarios"].items():
+        for size, entry in measured.items():
+            ok = f"{entry['downloads'] - entry['failed']}/{entry['downloads']}"
+            print(f"{scenario:20} {size:>6} {ok:>5} {_fmt(entry['latency_seconds']['p50']):>8} "
+                  f"{_fmt(entry['throughput_mb_s']['p50']):>8} {_fmt(entry['first_byte_seconds']['p50']):>8} "
+                  f"{entry['requests_per_download']:>7} {_fmt(entry['extra_seconds_over_baseline']):>7}")
+            for error in entry["errors"][:1]:
+                print(f"{'':27} {error[:100]}")
+    results.print_comparison(result)
+
+
+def _fmt(value) -> str:
+    return "-" if value is None else f"{value:.2f}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download-path benchmark against the origin emulator")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--sizes", default="2,32", help="file sizes in MB, comma separated")
+    parser.add_argument("--downloads", type=int, default=3, help="downloads per scenario and size")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "video-processor-bench"))
+    parser.add_argument("--log-level", default="CRITICAL", help="logging level; expected failures log errors")
+    parser.add_argument("--output", help="write the JSON result here")
+    parser.add_argument("--compare", help="a previous JSON result to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    sizes = [float(size) for size in args.sizes.split(",")]
+
+    from config import settings
+    result = results.new_result("downloads", {
+        "scenarios": scenarios, "sizes_mb": sizes, "downloads": args.downloads, "concurrency": args.concurrency,
+        "segmented_download_min_size": settings.segmented_download_min_size,
+        "segmented_download_max_parts": settings.segmented_download_max_parts,
+    })
+    files = create_files(os.path.join(args.workdir, "files"), sizes)
+    result["scenarios"] = {name: run_scenario(name, files, args) for name in scenarios}
+    add_retry_cost(result["scenarios"])
+    if args.compare:
+        result["comparison"] = results.compare(result, results.load(args.compare), comparison_metrics(result))
+    results.write(result, args.output)
+    print_table(result)
+
+
+if __name__ == "__main__":
+    main()
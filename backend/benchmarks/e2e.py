@@ -0,0 +1,239 @@
+"""End-to-end throughput benchmark over synthetic media served from a local origin.
+
+    python -m benchmarks.e2e --mix mixed --rows 8 --items 3 --concurrency 2 --output run.json
+    python -m benchmarks.e2e --target api --mix clips --rows 6 --compare run.json
+
+``processor`` calls VideoProcessor.process_media_files directly and
+latency is each job's processing time. ``api`` posts the rows as one batch
+to the API (in this process, or to ``--api-url``) and latency runs from the
+job's creation to its completion, queueing included. Sources are generated
+once under ``--workdir`` and reused by later runs.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from typing import List, Optional
+
+from benchmarks import media, results
+from benchmarks.origin import MediaOrigin
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = {"completed", "failed", "cancelled"}
+
+
+def planned_seconds(media_items: List[dict]) -> float:
+    return float(sum(item["duration"] for item in media_items))
+
+
+def output_seconds(path: Optional[str], planned: float) -> float:
+    """Duration of a rendered output, or the requested duration if it cannot be read"""
+    if path and os.path.exists(path):
+        try:
+            from imageio_ffmpeg import count_frames_and_secs
+            return count_frames_and_secs(path)[1]
+        except Exception as e:
+            logger.warning(f"Could not read the duration of {path}: {e}")
+    return planned
+
+
+def run_processor(rows: List[List[dict]], output_settings: dict, args) -> List[dict]:
+    """Render every row with VideoProcessor, ``args.concurrency`` at a time"""
+    from cancellation import CancelToken
+    from checkpoint import JobCheckpoint
+    from job_stats import JobStats, bind_stats
+    from video_processor import VideoProcessor
+
+    processor = VideoProcessor()
+    output_dir = os.path.join(args.workdir, "outputs")
+    os.makedirs(output_dir, exist_ok=True)
+
+    def run(media_items: List[dict]) -> dict:
+        job_id = f"bench-{uuid.uuid4().hex[:12]}"
+        output_path = os.path.join(output_dir, f"{job_id}.mp4")
+        checkpoint = None
+        if args.engine == "segments":
+            checkpoint = JobCheckpoint(job_id)
+            checkpoint.acquire()
+        stats = JobStats()
+        started = time.perf_counter()
+        outcome = {"job_id": job_id, "planned_seconds": planned_seconds(media_items)}
+        try:
+            with bind_stats(stats):
+                processor.process_media_files(
+                    media_items, output_path, output_settings,
+                    cancel_token=CancelToken(), checkpoint=checkpoint
+                )
+            outcome.update(status="completed", output_seconds=output_seconds(output_path, outcome["planned_seconds"]))
+        except Exception as e:
+            logger.error(f"Benchmark job {job_id} failed: {e}")
+            outcome.update(status="failed", error=str(e))
+        finally:
+            outcome.update(latency=time.perf_counter() - started, stats=stats.as_dict())
+            if checkpoint:
+                checkpoint.discard()
+            if not args.keep_outputs and os.path.exists(output_path):
+                os.remove(output_path)
+        return outcome
+
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="bench-job") as pool:
+        return list(pool.map(run, rows))
+
+
+def run_api(rows: List[List[dict]], output_settings: dict, args) -> List[dict]:
+    """Submit the rows as one batch and wait for every job to finish"""
+    payload = {
+        "rows": [{"row_number": i + 1, "media_items": items} for i, items in enumerate(rows)],
+        "output_settings": output_settings,
+        "spreadsheet_id": "benchmark",
+    }
+    with ExitStack() as stack:
+        storage_path = None
+        if args.api_url:
+            import requests
+            client = stack.enter_context(requests.Session())
+            base = args.api_url.rstrip("/")
+        else:
+            from fastapi.testclient import TestClient
+            import main
+            client = stack.enter_context(TestClient(main.app))  # runs the startup hooks
+            base = ""
+            storage_path = main.STORAGE_PATH
+
+        response = client.post(f"{base}/api/v1/jobs/batch", json=payload)
+        response.raise_for_status()
+        jobs = response.json()
+        batch_id = jobs[0]["batch_id"]
+
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            summary = client.get(f"{base}/api/v1/batches/{batch_id}").json()
+            if all(job["status"] in TERMINAL_STATUSES for job in summary["jobs"]):
+                break
+            time.sleep(args.poll_interval)
+        else:
+            logger.error(f"Batch {batch_id} did not finish within {args.timeout}s")
+
+        outcomes = []
+        for submitted, media_items in zip(jobs, rows):
+            job = client.get(f"{base}/api/v1/jobs/{submitted['job_id']}").json()
+            planned = planned_seconds(media_items)
+            outcome = {"job_id": job["job_id"], "status": job["status"], "mode": job.get("mode"),
+                       "planned_seconds": planned, "stats": job.get("stats")}
+            if job["status"] == "completed":
+                output = os.path.join(storage_path, job["output_file"]) if storage_path and job.get("output_file") else None
+                outcome["output_seconds"] = output_seconds(output, planned)
+                if output and not args.keep_outputs and os.path.exists(output):
+                    os.remove(output)
+            elif job.get("error"):
+                outcome["error"] = job["error"]
+            if job.get("completed_at"):
+                outcome["latency"] = (datetime.fromisoformat(job["completed_at"])
+                                      - datetime.fromisoformat(job["created_at"])).total_seconds()
+            outcomes.append(outcome)
+        return outcomes
+
+
+def run(args) -> dict:
+    mix = media.MIXES[args.mix]
+    media_dir = os.path.join(args.workdir, "media")
+    media.prepare(mix, media_dir)
+    output_settings = {"fps": args.fps, "quality": args.quality}
+    if args.resolution:
+        output_settings["resolution"] = args.resolution
+
+    parameters = {
+        "target": args.target, "mix": args.mix, "rows": args.rows, "items": args.items,
+        "concurrency": args.concurrency if args.target == "processor" else None,
+        "engine": None if args.api_url else args.engine,
+        "output_settings": output_settings, "origin_latency": args.latency,
+        "api_url": args.api_url,
+    }
+    result = results.new_result("e2e", parameters)
+    local = not args.api_url
+
+    with MediaOrigin(media_dir, latency=args.latency) as origin, results.PeakRSS() as rss:
+        rows = media.build_rows(mix, args.rows, args.items, origin.base_url)
+        cpu_before = results.cpu_seconds()
+        started = time.perf_counter()
+        if args.target == "processor":
+            outcomes = run_processor(rows, output_settings, args)
+        else:
+            outcomes = run_api(rows, output_settings, args)
+        wall = time.perf_counter() - started
+        cpu = results.cpu_seconds() - cpu_before
+
+    from job_stats import aggregate
+    completed = [outcome for outcome in outcomes if outcome["status"] == "completed"]
+    if not local:
+        # Only the jobs' own accounting is visible from here
+        cpu = sum(sum((outcome.get("stats") or {}).get("cpu_seconds", {}).values()) for outcome in outcomes)
+    produced = sum(outcome["output_seconds"] for outcome in completed)
+    result.update({
+        "jobs": len(outcomes),
+        "completed": len(completed),
+        "failed": len(outcomes) - len(completed),
+        "modes": sorted({outcome["mode"] for outcome in outcomes if outcome.get("mode")}) or None,
+        "wall_seconds": round(wall, 3),
+        "jobs_per_min": round(len(completed) / wall * 60, 3) if wall else None,
+        "latency_seconds": results.summarize([outcome["latency"] for outcome in completed if "latency" in outcome]),
+        "peak_rss_bytes": rss.peak if local else None,
+        "cpu_seconds": round(cpu, 3),
+        "output_seconds": round(produced, 3),
+        "cpu_seconds_per_output_second": round(cpu / produced, 3) if produced else None,
+        "stages": aggregate(outcome.get("stats") for outcome in completed)["stages"],
+        "errors": sorted({outcome["error"].strip().splitlines()[0][:300]
+                          for outcome in outcomes if outcome.get("error")})[:10],
+    })
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end benchmark over synthetic media from a local origin")
+    parser.add_argument("--target", choices=("processor", "api"), default="processor")
+    parser.add_argument("--mix", choices=sorted(media.MIXES), default="mixed")
+    parser.add_argument("--rows", type=int, default=4, help="jobs to run")
+    parser.add_argument("--items", type=int, default=3, help="media items per row")
+    parser.add_argument("--concurrency", type=int, default=1, help="jobs rendered at once (processor target)")
+    parser.add_argument("--engine", choices=("segments", "compose"), default="segments",
+                        help="segments = checkpointed per-item rendering, compose = one MoviePy composition")
+    parser.add_argument("--resolution", default="1280x720")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--quality", choices=("low", "medium", "high"), default="medium")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the origin waits before each response")
+    parser.add_argument("--api-url", help="benchmark a running API instead of one in this process")
+    parser.add_argument("--timeout", type=float, default=1800)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "video-processor-bench"))
+    parser.add_argument("--keep-outputs", action="store_true")
+    parser.add_argument("--output", help="write the JSON result here")
+    parser.add_argument("--compare", help="a previous JSON result to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Keep job outputs, checkpoints and scratch data out of the real storage
+    os.environ.setdefault("STORAGE_PATH", os.path.join(args.workdir, "storage"))
+    os.environ.setdefault("CHECKPOINT_PATH", os.path.join(args.workdir, "storage", "checkpoints"))
+    os.environ.setdefault("SCRATCH_PATH", os.path.join(args.workdir, "scratch"))
+    from config import settings
+    settings.checkpoint_enabled = args.engine == "segments"
+
+    result = run(args)
+    if args.compare:
+        result["comparison"] = results.compare(result, results.load(args.compare))
+    results.write(result, args.output)
+    results.print_summary(result)
+
+
+if __name__ == "__main__":
+    main()
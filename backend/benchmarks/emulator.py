@@ -0,0 +1,295 @@
+"""Local media origin that reproduces Google Drive behaviour and common download faults.
+
+Files from ``directory`` are served as ``/files/<alias>/<name>``; every
+alias is tracked as a separate download. The emulator also works as a
+plain-HTTP forward proxy, so with it set as the download session's proxy,
+``http://drive.google.com/uc?export=download&id=<name>~<alias>`` reaches
+it with the Drive host name intact and exercises the Drive branches of
+VideoProcessor.download_file: the virus-scan interstitial (``confirm``
+link or the newer form), then a redirect to drive.usercontent.google.com.
+
+Faults (see DEFAULT_FAULTS) apply to every download: throttling with
+Retry-After, 503s without it, a slow first byte, a bandwidth cap per
+connection, mid-stream disconnects, redirect chains, HTML pages instead
+of media, and range / Content-Length support switched off.
+"""
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+DEFAULT_FAULTS = {
+    "ranges": True,  # Accept-Ranges and 206 answers to Range requests
+    "content_length": True,  # False: chunked transfer encoding, size unknown up front
+    "first_byte_delay": 0.0,  # seconds before the response headers (slow start)
+    "rate": 0,  # bytes per second per connection; 0 = unlimited
+    "throttle_every": 0,  # every Nth request is answered 429 with Retry-After
+    "retry_after": 1,
+    "unavailable_first": 0,  # first N requests of each download get 503 without Retry-After
+    "disconnect_after": 0,  # drop the connection after this many body bytes ...
+    "disconnects": 1,  # ... this many times per download
+    "redirects": 0,  # 302 hops before the file is served
+    "html": False,  # answer with a login page instead of the file
+    "drive_confirm": None,  # None, "link" (confirm=<token> URL) or "form" (drive.usercontent form)
+}
+
+DRIVE_HOST = "drive.google.com"
+DRIVE_CONTENT_HOST = "drive.usercontent.google.com"
+BLOCK_SIZE = 64 * 1024
+
+LOGIN_PAGE = b"<!DOCTYPE html><html><head><title>Sign in - Google Accounts</title></head><body>Sign in</body></html>"
+CONFIRM_LINK_PAGE = (
+    '<!DOCTYPE html><html><head><title>Google Drive - Virus scan warning</title></head><body>'
+    '<p>Google Drive can\'t scan this file for viruses.</p>'
+    '<a id="uc-download-link" href="/uc?export=download&amp;confirm={token}&amp;id={id}">Download anyway</a>'
+    '</body></html>'
+)
+CONFIRM_FORM_PAGE = (
+    '<!DOCTYPE html><html><head><title>Google Drive - Virus scan warning</title></head><body>'
+    '<p>Google Drive can\'t scan this file for viruses.</p>'
+    '<form id="download-form" action="https://drive.usercontent.google.com/download" method="get">'
+    '<input type="submit" value="Download anyway"/>'
+    '<input type="hidden" name="id" value="{id}"><input type="hidden" name="export" value="download">'
+    '<input type="hidden" name="confirm" value="t"><input type="hidden" name="uuid" value="{token}">'
+    '</form></body></html>'
+)
+
+
+class _Download:
+    """What the origin saw of one download (all requests for one alias)"""
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses: Dict[int, int] = {}
+        self.unavailable = 0
+        self.disconnects = 0
+        self.bytes_sent = 0
+        self.first_request: Optional[float] = None
+        self.first_byte: Optional[float] = None
+
+    def as_dict(self) -> dict:
+        first_byte = None
+        if self.first_byte is not None:
+            first_byte = round(self.first_byte - self.first_request, 3)
+        return {
+            "requests": self.requests,
+            "statuses": dict(self.statuses),
+            "disconnects": self.disconnects,
+            "bytes_sent": self.bytes_sent,
+            "first_byte_seconds": first_byte,
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    emulator: "OriginEmulator" = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        try:
+            self._handle()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # the client gave up on this response
+
+    def _handle(self):
+        emulator, faults = self.emulator, self.emulator.faults
+        url = urlparse(self.path)
+        host = url.netloc or "origin"  # absolute URLs arrive when used as a proxy
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if host in (DRIVE_HOST, DRIVE_CONTENT_HOST):
+            alias = query.get("id", "")
+            name = alias.split("~")[0]
+        else:
+            alias = url.path
+            name = os.path.basename(url.path)
+        download, sequence = emulator._start_request(alias)
+
+        if faults["throttle_every"] and sequence % faults["throttle_every"] == 0:
+            return self._reply(download, 429, b"Too Many Requests", {"Retry-After": str(faults["retry_after"])})
+        with emulator._lock:
+            unavailable = download.unavailable < faults["unavailable_first"]
+            if unavailable:
+                download.unavailable += 1
+        if unavailable:
+            return self._reply(download, 503, b"Service Unavailable")
+
+        hop = int(query.get("hop", 0))
+        if hop < faults["redirects"]:
+            location = self._url(host, url.path, dict(query, hop=hop + 1))
+            return self._reply(download, 302, b"", {"Location": location})
+        if faults["html"]:
+            return self._reply(download, 200, LOGIN_PAGE, {"Content-Type": "text/html; charset=utf-8"})
+
+        if host == DRIVE_HOST and url.path == "/uc":
+            style = faults["drive_confirm"]
+            if style and "confirm" not in query:
+                page = CONFIRM_LINK_PAGE if style == "link" else CONFIRM_FORM_PAGE
+                return self._reply(download, 200, page.format(id=alias, token="x7Qa").encode(), {
+                    "Content-Type": "text/html; charset=utf-8",
+                    "Set-Cookie": f"download_warning_{abs(hash(alias))}=x7Qa; Path=/uc",
+                })
+            location = self._url(DRIVE_CONTENT_HOST, "/download", {
+                "id": alias, "export": "download", **({"confirm": query["confirm"]} if "confirm" in query else {})
+            })
+            return self._reply(download, 303, b"", {"Location": location})
+
+        path = os.path.join(emulator.directory, name)
+        if not name or not os.path.isfile(path):
+            return self._reply(download, 404, b"Not Found")
+        self._send_file(download, path, name)
+
+    def _url(self, host: str, path: str, query: dict) -> str:
+        if host == "origin":
+            return f"{path}?{urlencode(query)}"
+        return f"http://{host}{path}?{urlencode(query)}"
+
+    def _reply(self, download: _Download, status: int, body: bytes, headers: Optional[dict] = None):
+        self.emulator._record_status(download, status)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, download: _Download, path: str, name: str):
+        faults = self.emulator.faults
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        requested = self.headers.get("Range", "")
+        if faults["ranges"] and requested.startswith("bytes="):
+            first, _, last = requested[len("bytes="):].partition("-")
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            status = 206
+
+        if faults["first_byte_delay"]:
+            time.sleep(faults["first_byte_delay"])
+        self.emulator._record_status(download, status)
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Disposition", f'attachment; filename="{name}"')
+        if faults["ranges"]:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        chunked = not faults["content_length"]
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        sent = 0
+        started = time.monotonic()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                if self._should_disconnect(download, sent):
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                if faults["rate"]:
+                    # Pace the connection to the configured bandwidth
+                    delay = started + (sent + len(block)) / faults["rate"] - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(block), block) if chunked else block)
+                sent += len(block)
+                remaining -= len(block)
+                self.emulator._record_bytes(download, len(block))
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def _should_disconnect(self, download: _Download, sent: int) -> bool:
+        faults = self.emulator.faults
+        if not faults["disconnect_after"] or sent < faults["disconnect_after"]:
+            return False
+        with self.emulator._lock:
+            if download.disconnects >= faults["disconnects"]:
+                return False
+            download.disconnects += 1
+            return True
+
+
+class OriginEmulator:
+    """Serves ``directory`` on 127.0.0.1 with the given faults; see the module docstring"""
+
+    def __init__(self, directory: str, faults: Optional[dict] = None, port: int = 0):
+        unknown = set(faults or {}) - set(DEFAULT_FAULTS)
+        if unknown:
+            raise ValueError(f"Unknown faults: {sorted(unknown)}")
+        self.directory = directory
+        self.faults = dict(DEFAULT_FAULTS, **(faults or {}))
+        self._lock = threading.Lock()
+        self._downloads: Dict[str, _Download] = {}
+        self._sequence = 0
+        handler = type("EmulatorHandler", (_Handler,), {"emulator": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def file_url(self, name: str, alias: str) -> str:
+        return f"{self.base_url}/files/{alias}/{name}"
+
+    def drive_url(self, name: str, alias: str) -> str:
+        """Drive download URL; only reaches the emulator with it set as the HTTP proxy"""
+        return f"http://{DRIVE_HOST}/uc?export=download&id={name}~{alias}"
+
+    def downloads(self) -> Dict[str, dict]:
+        """Per-alias request counts, statuses, bytes and time to first body byte"""
+        with self._lock:
+            return {alias: download.as_dict() for alias, download in self._downloads.items()}
+
+    def start(self) -> "OriginEmulator":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="origin-emulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+
+    def __enter__(self) -> "OriginEmulator":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _start_request(self, alias: str):
+        with self._lock:
+            self._sequence += 1
+            download = self._downloads.get(alias)
+            if download is None:
+                download = self._downloads[alias] = _Download()
+                download.first_request = time.monotonic()
+            download.requests += 1
+            return download, self._sequence
+
+    def _record_status(self, download: _Download, status: int):
+        with self._lock:
+            download.statuses[status] = download.statuses.get(status, 0) + 1
+
+    def _record_bytes(self, download: _Download, nbytes: int):
+        with self._lock:
+            if download.first_byte is None:
+                download.first_byte = time.monotonic()
+            download.bytes_sent += nbytes
@@ -0,0 +1,387 @@
+"""API load test: spreadsheets submitting batches, polling job status and downloading outputs.
+
+    python -m benchmarks.loadtest --concurrency 10,100,500,1000 --duration 30 --output load.json
+    python -m benchmarks.loadtest --api-url http://127.0.0.1:8000 --concurrency 50 --compare load.json
+
+Each virtual client behaves like the Apps Script add-on: it submits one
+batch of ``--rows`` rows, polls every job with GET /jobs/{id} every
+``--poll-interval`` seconds until it finishes, downloads a share of the
+completed outputs and starts over after ``--think`` seconds. Clients start
+at random times within ``--ramp`` seconds, so submissions arrive in bursts
+rather than in lockstep.
+
+Without ``--api-url`` a server is started on a free port with
+JOB_EXECUTOR=mock, so jobs finish after ``--mock-seconds`` without
+rendering and only API overhead is measured. For every concurrency step
+the result has requests per second, latency percentiles per request kind,
+the API's event loop lag (from its /metrics) and, for the local server,
+its CPU time and resident memory.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks import results
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TERMINAL_STATUSES = {"completed", "failed", "cancelled"}
+KINDS = ("submit", "status", "download")
+LAG_METRIC = "api_event_loop_lag_seconds"
+
+# metric path template within a step -> True when higher is better
+STEP_METRICS = {
+    "rps": True,
+    "latency_seconds.submit.p95": False,
+    "latency_seconds.status.p95": False,
+    "event_loop_lag_seconds.p95": False,
+}
+
+MEDIA_ITEMS = [
+    {"url": "https://example.com/media/clip-a.mp4", "start_time": 0, "duration": 3, "media_type": "video"},
+    {"url": "https://example.com/media/photo-b.jpg", "duration": 2, "media_type": "image"},
+    {"url": "https://example.com/media/clip-c.mp4", "start_time": 5, "duration": 4, "media_type": "video"},
+]
+
+
+class Recorder:
+    """Latency and outcome of every request in one step"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {kind: [] for kind in KINDS}
+        self.errors: Dict[str, int] = {kind: 0 for kind in KINDS}
+        self.error_samples: List[str] = []
+        self.jobs_submitted = 0
+        self.jobs_finished = 0
+        self.cpu_seconds = 0.0
+
+    def merge(self, other: "Recorder"):
+        for kind in KINDS:
+            self.latencies[kind].extend(other.latencies[kind])
+            self.errors[kind] += other.errors[kind]
+        for sample in other.error_samples:
+            if len(self.error_samples) < 5 and sample not in self.error_samples:
+                self.error_samples.append(sample)
+        self.jobs_submitted += other.jobs_submitted
+        self.jobs_finished += other.jobs_finished
+        self.cpu_seconds += other.cpu_seconds
+
+    async def call(self, kind: str, request) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError as e:
+            self._error(kind, f"{type(e).__name__}: {e}")
+            return None
+        self.latencies[kind].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self._error(kind, f"HTTP {response.status_code} on {kind}")
+            return None
+        return response
+
+    def _error(self, kind: str, message: str):
+        self.errors[kind] += 1
+        if len(self.error_samples) < 5 and message not in self.error_samples:
+            self.error_samples.append(message)
+
+
+async def spreadsheet(client: httpx.AsyncClient, recorder: Recorder, number: int, stop_at: float, args):
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    payload = {
+        "spreadsheet_id": f"loadtest-{number}",
+        "rows": [{"row_number": row + 1, "media_items": MEDIA_ITEMS} for row in range(args.rows)],
+        "output_settings": {"fps": 30, "quality": "medium"},
+    }
+    while time.monotonic() < stop_at:
+        response = await recorder.call("submit", client.post("/api/v1/jobs/batch", json=payload))
+        if response is None:
+            await asyncio.sleep(1)
+            continue
+        active = [job["job_id"] for job in response.json()]
+        recorder.jobs_submitted += len(active)
+        completed = []
+        while active and time.monotonic() < stop_at:
+            pending = []
+            for job_id in active:  # one job at a time, like checkJobStatus()
+                response = await recorder.call("status", client.get(f"/api/v1/jobs/{job_id}"))
+                status = response.json().get("status") if response is not None else None
+                if status in TERMINAL_STATUSES:
+                    recorder.jobs_finished += 1
+                    if status == "completed":
+                        completed.append(job_id)
+                else:
+                    pending.append(job_id)
+            active = pending
+            if active:
+                await asyncio.sleep(args.poll_interval)
+        for job_id in completed:
+            if time.monotonic() >= stop_at:
+                break
+            if random.random() < args.download_ratio:
+                await recorder.call("download", client.get(f"/api/v1/jobs/{job_id}/download"))
+        await asyncio.sleep(args.think)
+
+
+def lag_histogram(client: httpx.Client) -> Optional[Dict[str, float]]:
+    """Cumulative bucket counts, sum and count of the API's event loop lag histogram"""
+    try:
+        text = client.get("/metrics").text
+    except httpx.HTTPError:
+        return None
+    for family in text_string_to_metric_families(text):
+        if family.name != LAG_METRIC:
+            continue
+        values: Dict[str, float] = {}
+        for sample in family.samples:
+            if sample.name.endswith("_bucket"):
+                values[sample.labels["le"]] = values.get(sample.labels["le"], 0) + sample.value
+            elif sample.name.endswith(("_sum", "_count")):
+                key = sample.name.rsplit("_", 1)[1]
+                values[key] = values.get(key, 0) + sample.value
+        return values
+    return None
+
+
+def lag_summary(before: Optional[dict], after: Optional[dict]) -> Optional[dict]:
+    """Percentiles (bucket upper bounds) of the lag observed between two scrapes"""
+    if not before or not after:
+        return None
+    count = after.get("count", 0) - before.get("count", 0)
+    if count <= 0:
+        return None
+    bounds = sorted((float(le), after[le] - before.get(le, 0)) for le in after if le not in ("sum", "count"))
+
+    def percentile(q: float) -> Optional[float]:
+        for bound, cumulative in bounds:
+            if cumulative >= q * count:
+                return None if bound == float("inf") else bound
+        return None
+
+    return {
+        "samples": int(count),
+        "mean": round((after.get("sum", 0) - before.get("sum", 0)) / count, 4),
+        "p50": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+    }
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def run_clients(base_url: str, numbers: range, args) -> Recorder:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=len(numbers), max_keepalive_connections=len(numbers))
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        stop_at = time.monotonic() + args.duration
+        await asyncio.gather(*(spreadsheet(client, recorder, number, stop_at, args) for number in numbers))
+    return recorder
+
+
+def client_process(base_url: str, numbers: range, args) -> Recorder:
+    """One load generator process; its event loop drives ``numbers`` clients"""
+    started = time.process_time()
+    recorder = asyncio.run(run_clients(base_url, numbers, args))
+    recorder.cpu_seconds = time.process_time() - started
+    return recorder
+
+
+def run_step(base_url: str, concurrency: int, args) -> Recorder:
+    """Split the clients over ``args.processes`` generator processes so the generator is not the bottleneck"""
+    processes = max(1, min(args.processes, concurrency))
+    shares = [range(index, concurrency, processes) for index in range(processes)]
+    if processes == 1:
+        return client_process(base_url, shares[0], args)
+    recorder = Recorder()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for part in pool.map(client_process, [base_url] * processes, shares, [args] * processes):
+            recorder.merge(part)
+    return recorder
+
+
+def measure_step(base_url: str, concurrency: int, server: Optional[subprocess.Popen], args) -> dict:
+    with httpx.Client(base_url=base_url, timeout=30) as probe:
+        lag_before = lag_histogram(probe)
+        server_cpu = process_cpu_seconds(server.pid) if server else None
+        started = time.perf_counter()
+        recorder = run_step(base_url, concurrency, args)
+        elapsed = time.perf_counter() - started
+        if server_cpu is not None:
+            server_cpu = process_cpu_seconds(server.pid) - server_cpu
+        lag_after = lag_histogram(probe)
+
+    from admission import process_tree_rss
+    requests_done = sum(len(latencies) for latencies in recorder.latencies.values())
+    return {
+        "concurrency": concurrency,
+        "duration_seconds": round(elapsed, 3),
+        "requests": requests_done,
+        "errors": sum(recorder.errors.values()),
+        "rps": round(requests_done / elapsed, 1),
+        "latency_seconds": {
+            kind: dict(results.summarize(recorder.latencies[kind]), count=len(recorder.latencies[kind]),
+                       errors=recorder.errors[kind])
+            for kind in KINDS
+        },
+        "jobs_submitted": recorder.jobs_submitted,
+        "jobs_finished": recorder.jobs_finished,
+        "event_loop_lag_seconds": lag_summary(lag_before, lag_after),
+        "server_cpu_seconds": round(server_cpu, 3) if server_cpu is not None else None,
+        "server_rss_bytes": process_tree_rss(server.pid) if server else None,
+        # Close to duration x processes means the load generator, not the API, is the bottleneck
+        "client_cpu_seconds": round(recorder.cpu_seconds, 3),
+        "error_samples": recorder.error_samples,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args) -> tuple:
+    """uvicorn with the mock engine on a free port; returns (process, base URL)"""
+    port = free_port()
+    env = dict(
+        os.environ,
+        JOB_EXECUTOR="mock",
+        MOCK_JOB_SECONDS=str(args.mock_seconds),
+        CHECKPOINT_ENABLED="false",
+        STORAGE_PATH=os.path.join(args.workdir, "storage"),
+    )
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)  # a single process; keep its metrics in memory
+    log = open(os.path.join(args.workdir, "loadtest-server.log"), "w")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"API server exited; see {log.name}")
+        try:
+            if httpx.get(f"{base_url}/api/v1/health", timeout=2).status_code == 200:
+                return server, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise SystemExit(f"API server did not start; see {log.name}")
+
+
+def raise_open_files_limit():
+    """Thousands of clients need as many sockets"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def comparison_metrics(result: dict) -> Dict[str, bool]:
+    return {
+        f"steps.{step}.{metric}": higher_is_better
+        for step in result["steps"]
+        for metric, higher_is_better in STEP_METRICS.items()
+    }
+
+
+def print_table(result: dict):
+    print(f"{'clients':>8} {'rps':>8} {'errors':>7} {'submit p50/p95':>16} {'status p50/p95':>16} "
+          f"{'download p95':>13} {'lag p95':>8} {'server cpu':>11}")
+    for step in result["steps"].values():
+        latency = step["latency_seconds"]
+        lag = (step["event_loop_lag_seconds"] or {}).get("p95")
+        print(f"{step['concurrency']:>8} {step['rps']:>8} {step['errors']:>7} "
+              f"{_pair(latency['submit']):>16} {_pair(latency['status']):>16} "
+              f"{_ms(latency['download']['p95']):>13} {_ms(lag):>8} {_fmt(step['server_cpu_seconds']):>11}")
+        for sample in step["error_samples"][:2]:
+            print(f"{'':9}{sample[:100]}")
+    results.print_comparison(result)
+
+
+def _pair(summary: dict) -> str:
+    return f"{_ms(summary['p50'])}/{_ms(summary['p95'])}"
+
+
+def _ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+
+def _fmt(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.1f}s"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="API load test with a mock processing engine")
+    parser.add_argument("--api-url", help="load an already running API (start it with JOB_EXECUTOR=mock)")
+    parser.add_argument("--concurrency", default="10,50,100,500", help="virtual spreadsheets per step, comma separated")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per step")
+    parser.add_argument("--processes", type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                        help="load generator processes")
+    parser.add_argument("--ramp", type=float, default=2, help="clients start at random times within this many seconds")
+    parser.add_argument("--rows", type=int, default=5, help="rows per submitted batch")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between status sweeps")
+    parser.add_argument("--think", type=float, default=1.0, help="pause before a client submits again")
+    parser.add_argument("--download-ratio", type=float, default=0.5, help="share of completed jobs downloaded")
+    parser.add_argument("--mock-seconds", type=float, default=2.0, help="processing time of a mock job")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "video-processor-bench"))
+    parser.add_argument("--output", help="write the JSON result here")
+    parser.add_argument("--compare", help="a previous JSON result to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    os.makedirs(args.workdir, exist_ok=True)
+    raise_open_files_limit()
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    result = results.new_result("loadtest", {
+        "api_url": args.api_url, "concurrency": levels, "processes": args.processes, "duration": args.duration, "rows": args.rows,
+        "poll_interval": args.poll_interval, "think": args.think, "download_ratio": args.download_ratio,
+        "mock_seconds": None if args.api_url else args.mock_seconds,
+    })
+    server = None
+    base_url = args.api_url.rstrip("/") if args.api_url else None
+    if base_url is None:
+        server, base_url = start_server(args)
+    try:
+        result["steps"] = {}
+        for level in levels:
+            result["steps"][str(level)] = measure_step(base_url, level, server, args)
+    finally:
+        if server:
+            server.terminate()
+            server.wait(10)
+    if args.compare:
+        result["comparison"] = results.compare(result, results.load(args.compare), comparison_metrics(result))
+    results.write(result, args.output)
+    print_table(result)
+
+
+if __name__ == "__main__":
+    main()
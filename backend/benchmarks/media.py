@@ -0,0 +1,133 @@
+"""Synthetic benchmark sources generated locally from ffmpeg test patterns"""
+import logging
+import os
+import subprocess
+from typing import Dict, List
+
+from imageio_ffmpeg import get_ffmpeg_exe
+
+logger = logging.getLogger(__name__)
+
+# codec -> (container extension, ffmpeg video encoder arguments)
+CODECS = {
+    "h264": (".mp4", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"]),
+    "hevc": (".mp4", ["-c:v", "libx265", "-preset", "ultrafast", "-tag:v", "hvc1", "-pix_fmt", "yuv420p"]),
+    "vp9": (".webm", ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-row-mt", "1"]),
+    "mpeg4": (".mp4", ["-c:v", "mpeg4", "-q:v", "5"]),
+}
+AUDIO_CODECS = {".mp4": ["-c:a", "aac", "-b:a", "128k"], ".webm": ["-c:a", "libopus", "-b:a", "96k"]}
+
+
+def video(codec: str = "h264", size: str = "1280x720", fps: int = 30, seconds: float = 10, audio: bool = True) -> dict:
+    return {"kind": "video", "codec": codec, "size": size, "fps": fps, "seconds": seconds, "audio": audio}
+
+
+def image(size: str = "4000x3000", fmt: str = "jpg") -> dict:
+    return {"kind": "image", "size": size, "format": fmt}
+
+
+# Row mixes: each row takes its items from the list in turn (see build_rows)
+MIXES: Dict[str, List[dict]] = {
+    "clips": [
+        {"source": video("h264", "1280x720"), "start_time": 1, "duration": 3},
+        {"source": video("h264", "640x360"), "start_time": 0, "duration": 2},
+        {"source": video("h264", "1920x1080"), "start_time": 2, "duration": 3},
+    ],
+    "images": [
+        {"source": image("4000x3000", "jpg"), "duration": 2},
+        {"source": image("1920x1080", "png"), "duration": 2},
+        {"source": image("6000x4000", "jpg"), "duration": 2},
+    ],
+    "mixed": [
+        {"source": video("h264", "1280x720"), "start_time": 1, "duration": 3},
+        {"source": image("4000x3000", "jpg"), "duration": 2},
+        {"source": video("hevc", "1920x1080"), "start_time": 0, "duration": 2},
+        {"source": image("1920x1080", "png"), "duration": 1},
+    ],
+    "codecs": [
+        {"source": video("h264", "1280x720"), "start_time": 0, "duration": 2},
+        {"source": video("hevc", "1280x720"), "start_time": 0, "duration": 2},
+        {"source": video("vp9", "1280x720"), "start_time": 0, "duration": 2},
+        {"source": video("mpeg4", "1280x720"), "start_time": 0, "duration": 2},
+    ],
+    "hd": [
+        {"source": video("h264", "1920x1080", seconds=20), "start_time": 5, "duration": 8},
+        {"source": video("hevc", "3840x2160", seconds=6), "start_time": 0, "duration": 4},
+    ],
+}
+
+
+def source_name(spec: dict) -> str:
+    """Deterministic file name, so sources are generated once and reused across runs"""
+    if spec["kind"] == "image":
+        return f"image-{spec['size']}.{spec['format']}"
+    extension = CODECS[spec["codec"]][0]
+    audio = "" if spec.get("audio", True) else "-noaudio"
+    return f"video-{spec['codec']}-{spec['size']}-{spec['fps']}fps-{spec['seconds']:g}s{audio}{extension}"
+
+
+def generate(spec: dict, directory: str) -> str:
+    """Create the source described by ``spec`` in ``directory`` unless it exists; returns its file name"""
+    name = source_name(spec)
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        return name
+    os.makedirs(directory, exist_ok=True)
+    stem, extension = os.path.splitext(path)
+    partial = f"{stem}.partial{extension}"
+
+    if spec["kind"] == "image":
+        # Noise keeps the file about as large as a camera photo of that size
+        command = [
+            get_ffmpeg_exe(), "-y", "-v", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size={spec['size']}:rate=1",
+            "-vf", "noise=alls=12:allf=u", "-frames:v", "1", "-q:v", "3", partial
+        ]
+    else:
+        extension = CODECS[spec["codec"]][0]
+        command = [
+            get_ffmpeg_exe(), "-y", "-v", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size={spec['size']}:rate={spec['fps']}:duration={spec['seconds']}"
+        ]
+        if spec.get("audio", True):
+            command += ["-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={spec['seconds']}"]
+            command += CODECS[spec["codec"]][1] + AUDIO_CODECS[extension] + ["-shortest"]
+        else:
+            command += CODECS[spec["codec"]][1]
+        command.append(partial)
+
+    logger.info(f"Generating benchmark source {name}")
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise RuntimeError(f"ffmpeg could not generate {name}: {result.stderr.strip()}")
+    os.replace(partial, path)
+    return name
+
+
+def build_rows(mix: List[dict], rows: int, items: int, base_url: str) -> List[List[dict]]:
+    """``rows`` rows of ``items`` media items each, as the API receives them.
+
+    Row ``r`` starts at item ``r`` of the mix, so consecutive rows differ
+    while the batch as a whole keeps the mix's proportions.
+    """
+    result = []
+    for row in range(rows):
+        media_items = []
+        for position in range(items):
+            entry = mix[(row + position) % len(mix)]
+            spec = entry["source"]
+            media_items.append({
+                "url": f"{base_url}/{source_name(spec)}",
+                "start_time": entry.get("start_time", 0),
+                "duration": entry["duration"],
+                "media_type": spec["kind"],
+            })
+        result.append(media_items)
+    return result
+
+
+def prepare(mix: List[dict], directory: str) -> List[str]:
+    """Generate every source a mix uses"""
+    return [generate(entry["source"], directory) for entry in mix]
@@ -0,0 +1,56 @@
+"""Local HTTP origin serving benchmark media from a directory"""
+import functools
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class _MediaHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like a real CDN
+    latency = 0.0
+
+    def send_head(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return super().send_head()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaOrigin:
+    """Serves ``directory`` on 127.0.0.1 from a background thread.
+
+    ``latency`` delays every response, to approximate a remote origin's
+    round trip. Use as a context manager or call start()/stop().
+    """
+
+    def __init__(self, directory: str, port: int = 0, latency: float = 0.0):
+        handler = type("MediaHandler", (_MediaHandler,), {"latency": latency})
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), functools.partial(handler, directory=directory))
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MediaOrigin":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bench-origin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+
+    def __enter__(self) -> "MediaOrigin":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,158 @@
+"""Resource sampling, summary statistics and comparable JSON results for benchmarks"""
+import json
+import os
+import platform
+import resource
+import subprocess
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from imageio_ffmpeg import get_ffmpeg_exe
+
+SCHEMA_VERSION = 1
+
+# metric path -> True when higher is better (used by compare)
+KEY_METRICS = {
+    "jobs_per_min": True,
+    "latency_seconds.p50": False,
+    "latency_seconds.p95": False,
+    "peak_rss_bytes": False,
+    "cpu_seconds_per_output_second": False,
+}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile, ``q`` in 0..1"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 3)
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "max": round(max(values), 3) if values else None,
+        "mean": round(sum(values) / len(values), 3) if values else None,
+    }
+
+
+def cpu_seconds() -> float:
+    """CPU used so far by this process and its waited-for children (ffmpeg)"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+class PeakRSS:
+    """Samples the resident memory of this process tree in the background and keeps the peak"""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def sample(self):
+        from admission import process_tree_rss
+        rss = process_tree_rss()
+        if rss:
+            self.peak = max(self.peak, rss)
+
+    def __enter__(self) -> "PeakRSS":
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name="bench-rss", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join(5)
+        self.sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+
+def environment() -> dict:
+    """Where a result came from, so runs on different machines are not compared blindly"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    try:
+        ffmpeg = subprocess.run([get_ffmpeg_exe(), "-version"], capture_output=True, text=True).stdout.split("\n")[0]
+    except OSError:
+        ffmpeg = ""
+    return {
+        "git_commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg,
+    }
+
+
+def new_result(benchmark: str, parameters: dict) -> dict:
+    return {
+        "schema": SCHEMA_VERSION,
+        "benchmark": benchmark,
+        "started_at": datetime.utcnow().isoformat(),
+        "parameters": parameters,
+        "environment": environment(),
+    }
+
+
+def _lookup(result: dict, path: str):
+    value = result
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(current: dict, baseline: dict, metrics: Optional[Dict[str, bool]] = None) -> Dict[str, dict]:
+    """Change of each key metric against ``baseline``; ``better`` is None when unknown"""
+    changes = {}
+    for path, higher_is_better in (metrics or KEY_METRICS).items():
+        new, old = _lookup(current, path), _lookup(baseline, path)
+        if new is None or old is None:
+            continue
+        change = (new - old) / old if old else None
+        better = None if change is None or change == 0 else (change > 0) == higher_is_better
+        changes[path] = {"baseline": old, "current": new,
+                         "change": round(change, 4) if change is not None else None, "better": better}
+    return changes
+
+
+def print_summary(result: dict):
+    print(f"{result['benchmark']}: {result.get('jobs', 0)} jobs, {result.get('failed', 0)} failed "
+          f"in {result.get('wall_seconds')}s")
+    for path in KEY_METRICS:
+        print(f"  {path:32} {_lookup(result, path)}")
+    print_comparison(result)
+
+
+def print_comparison(result: dict):
+    for path, change in result.get("comparison", {}).items():
+        if change["change"] is None:
+            continue
+        verdict = "better" if change["better"] else ("worse" if change["better"] is False else "same")
+        print(f"  vs baseline {path:20} {change['change'] * 100:+.1f}% ({verdict})")
+
+
+def write(result: dict, path: Optional[str]):
+    if not path:
+        return
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+        f.write("\n")
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
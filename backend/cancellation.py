@@ -0,0 +1,166 @@
+"""Cooperative job cancellation with subprocess termination"""
+import logging
+import os
+import subprocess
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from job_stats import current_stats
+from profiler import process_cpu, track_process
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_install_lock = threading.Lock()
+_OriginalPopen = subprocess.Popen
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once its cancel token has fired"""
+
+
+class CancelToken:
+    """Cancellation flag shared between the API and a running job.
+
+    Work in progress registers callbacks (close an HTTP response, kill an
+    ffmpeg process) that run as soon as ``cancel`` is called, so blocking
+    reads and encoder pipes are interrupted instead of polled.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Cancel callback failed: {e}")
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise JobCancelled("Job was cancelled")
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep up to ``timeout`` seconds; returns True if cancelled meanwhile"""
+        return self._event.wait(timeout)
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return callback
+        callback()
+        return callback
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def track_process(self, proc: subprocess.Popen) -> Callable[[], None]:
+        """Kill ``proc`` if the job is cancelled while it is still running; returns the callback to remove"""
+        def kill():
+            if proc.poll() is None:
+                logger.info(f"Killing subprocess {proc.pid} of cancelled job")
+                proc.kill()
+        return self.add_callback(kill)
+
+
+class _TrackedPopen(_OriginalPopen):
+    """Popen that registers itself with the cancel token bound to this thread.
+
+    When job stats are bound too, the process's CPU time is added to them
+    when it is waited for or polled after exiting, and a profile of the job
+    samples its CPU use.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._job_stats = current_stats()
+        self._token = current_token()
+        self._kill_callback = None
+        self._cpu_counted = False
+        super().__init__(*args, **kwargs)
+        track_process(self)
+        if self._token is not None:
+            self._kill_callback = self._token.track_process(self)
+
+    def wait(self, timeout=None):
+        self._count_cpu(block=timeout is None)
+        try:
+            return super().wait(timeout)
+        finally:
+            self._untrack()
+
+    def poll(self):
+        self._count_cpu(block=False)
+        returncode = super().poll()
+        self._untrack()
+        return returncode
+
+    def _count_cpu(self, block: bool):
+        """Add the CPU time of the exited, not yet reaped child to the job's stats.
+
+        waitid(WNOWAIT) waits for the exit but leaves the zombie in place,
+        so /proc still has its final CPU times until Popen reaps it.
+        """
+        if self._job_stats is None or self._cpu_counted or self.returncode is not None or not hasattr(os, "waitid"):
+            return
+        flags = os.WEXITED | os.WNOWAIT | (0 if block else os.WNOHANG)
+        try:
+            if os.waitid(os.P_PID, self.pid, flags) is None:
+                return  # still running
+        except ChildProcessError:
+            return  # reaped by another thread
+        cpu = process_cpu(self.pid)
+        if cpu is not None:
+            self._cpu_counted = True
+            self._job_stats.add_cpu("children", cpu)
+
+    def _untrack(self):
+        if self.returncode is not None and self._kill_callback is not None:
+            self._token.remove_callback(self._kill_callback)
+            self._kill_callback = None
+
+
+def install_process_tracking():
+    """Route subprocess creation through _TrackedPopen.
+
+    MoviePy spawns its ffmpeg reader/writer processes internally; patching
+    Popen is the only way to reach them. Processes started from threads
+    without a bound token behave exactly as before.
+    """
+    with _install_lock:
+        if subprocess.Popen is not _TrackedPopen:
+            subprocess.Popen = _TrackedPopen
+
+
+def current_token() -> Optional[CancelToken]:
+    return getattr(_local, "token", None)
+
+
+@contextmanager
+def bind_token(token: Optional[CancelToken]):
+    """Attach ``token`` to the current thread for the duration of the block"""
+    if token is None:
+        yield
+        return
+    install_process_tracking()
+    previous = current_token()
+    _local.token = token
+    try:
+        yield
+    finally:
+        _local.token = previous
@@ -1,12 +1,18 @@
-from celery import Celery
+from celery import Celery, chain, chord
+from celery.signals import worker_init, worker_process_shutdown
 from config import settings
 import logging
 import os
 import tempfile
-from typing import List, Dict
-from video_processor import VideoProcessor
+from contextlib import contextmanager
+from typing import List, Dict, Optional
 from storage import StorageManager
-import httpx
+from engine import engine
+from checkpoint import JobCheckpoint
+from progress import progress_publisher
+from metrics import mark_process_dead, stage_timer, start_worker_metrics_server
+from job_stats import JobStats, bind_stats, record_bytes, timed
+from profiler import ProfileRequests, bind_job, watch_requests
 import asyncio
 
 logger = logging.getLogger(__name__)
@@ -28,129 +34,416 @@ celery_app.conf.update(
     task_track_started=True,
     task_time_limit=3600,  # 1 hour
     task_soft_time_limit=3300,  # 55 minutes
+    # Downloads and uploads wait on the network, rendering on cores; each
+    # runs on its own queue so a worker pool sized for one never starves
+    # the other (see docker-compose.yml for the worker commands).
+    task_routes={
+        "fetch_media_task": {"queue": settings.celery_io_queue},
+        "upload_output_task": {"queue": settings.celery_io_queue},
+        "render_video_task": {"queue": settings.celery_cpu_queue},
+        "process_video_task": {"queue": settings.celery_cpu_queue},
+        "prepare_segments_task": {"queue": settings.celery_cpu_queue},
+        "render_segment_task": {"queue": settings.celery_cpu_queue},
+        "concat_segments_task": {"queue": settings.celery_io_queue},
+    },
+    # Long CPU tasks should not be reserved by a busy worker; the io
+    # worker raises this on its command line
+    worker_prefetch_multiplier=1,
 )
 
 storage = StorageManager()
-video_processor = VideoProcessor()
 
-async def update_job_status(job_id: str, status: str, progress: int, message: str, output_url: str = None, error: str = None):
-    """Update job status via API"""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.put(
-                f"http://localhost:8000{settings.api_prefix}/jobs/{job_id}/status",
-                json={
-                    "status": status,
-                    "progress": progress,
-                    "message": message,
-                    "output_url": output_url,
-                    "error": error
-                }
-            )
-            response.raise_for_status()
-        except Exception as e:
-            logger.error(f"Failed to update job status: {e}")
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    if settings.worker_metrics_port:
+        start_worker_metrics_server(settings.worker_metrics_port)
+
+@worker_init.connect
+def warm_engine(sender=None, **kwargs):
+    """Import and warm the engine before the pool forks, so no child pays for it on its first job.
+
+    Only workers consuming the cpu queue render; an io worker loads the
+    engine on demand (segment concat) and skips the warm-up encode.
+    """
+    queues = sender.app.amqp.queues.consume_from if sender is not None else None
+    if queues and settings.celery_cpu_queue not in queues:
+        return
+    engine.load(warm=settings.engine_warm_up)
 
-def sync_update_job_status(*args, **kwargs):
-    """Synchronous wrapper for update_job_status"""
+@worker_process_shutdown.connect
+def forget_process_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
+
+def run_async(coro):
+    """Run a StorageManager coroutine from synchronous task code"""
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     try:
-        loop.run_until_complete(update_job_status(*args, **kwargs))
+        return loop.run_until_complete(coro)
     finally:
         loop.close()
 
-@celery_app.task(bind=True, name="process_video_task")
-def process_video_task(self, job_id: str, job_data: Dict):
-    """Process video concatenation task"""
+def sync_update_job_status(job_id: str, status: str, progress: int, message: str, output_url: str = None, error: str = None):
+    """Report job status to the API over the Redis progress channel"""
+    progress_publisher.publish(job_id, status, progress, message, output_url=output_url, error=error)
+
+def publish_profile(job_id: str, info: dict, collapsed: Optional[str]):
+    """Store a finished profile and report it to the API with the job's progress"""
+    if collapsed is not None:
+        try:
+            info["artifact_url"] = run_async(storage.save_file(f"profiles/{job_id}/{info['profile_id']}.folded",
+                                                               collapsed.encode()))
+        except Exception as e:
+            logger.error(f"Failed to store profile {info['profile_id']} of job {job_id}: {e}")
+            info.update(status="failed", error=str(e))
+    progress_publisher.publish_profile(job_id, info)
+
+# Profiles requested through the API are picked up while this process runs jobs
+watch_requests(ProfileRequests(), publish_profile)
+
+def download_media_items(job_id: str, media_items: List[Dict], download_dir: str, checkpoint: Optional[JobCheckpoint]) -> List[Dict]:
+    """Fetch every media item of a job, reusing whatever the checkpoint already holds"""
+    media_files = []
+    total_items = len(media_items)
+    
+    for idx, item in enumerate(media_items):
+        progress = 10 + int((idx / total_items) * 30)
+        sync_update_job_status(
+            job_id, "processing", progress, 
+            f"Downloading media file {idx + 1}/{total_items}..."
+        )
+        
+        # Download file
+        local_path = os.path.join(download_dir, f"media_{idx}{os.path.splitext(item['url'])[1]}")
+        
+        # If URL is from our storage, get local path
+        if item['url'].startswith('/storage/'):
+            local_path = storage.get_file_path(item['url'])
+        elif checkpoint and (checkpoint.completed_segment(idx) or checkpoint.completed_output()):
+            # Already rendered before the restart; the source is not needed
+            local_path = item['url']
+        elif checkpoint and checkpoint.completed_download(idx):
+            local_path = checkpoint.completed_download(idx)
+        else:
+            # Download from external URL
+            with stage_timer("download", item=idx):
+                local_path = run_async(storage.download_file(item['url'], local_path, item.get('sha256')))
+            record_bytes("download", os.path.getsize(local_path), item=idx)
+            if checkpoint:
+                local_path = checkpoint.keep_download(idx, local_path)
+        
+        media_files.append({
+            "path": local_path,
+            "duration": item["duration"],
+            "start_time": item.get("start_time", 0),
+            "media_type": item.get("media_type", "auto")
+        })
+    
+    return media_files
+
+def render_media_files(job_id: str, media_files: List[Dict], output_path: str, output_settings: Dict, checkpoint: Optional[JobCheckpoint]):
+    sync_update_job_status(job_id, "processing", 50, "Processing media files...")
+    
+    # Process with progress callback
+    def progress_callback(progress: int, message: str):
+        actual_progress = 50 + int(progress * 0.4)  # 50-90%
+        sync_update_job_status(job_id, "processing", actual_progress, message)
+    
+    engine.processor().process_media_files(
+        media_files,
+        output_path,
+        output_settings,
+        progress_callback,
+        checkpoint=checkpoint
+    )
+
+def upload_output(job_id: str, output_path: str, checkpoint: Optional[JobCheckpoint]):
+    """Store the rendered output and report the job as completed"""
+    sync_update_job_status(job_id, "processing", 90, "Uploading processed video...")
+    
+    output_key = f"outputs/{job_id}/output.mp4"
+    
+    # The storage pool observes the upload metric; this records it on the job
+    with timed("upload"):
+        output_url = run_async(storage.save_file(output_key, output_path))
+    record_bytes("upload", os.path.getsize(output_path))
+    
+    if checkpoint:
+        checkpoint.record_upload({"output_url": output_url})
+    
+    # Update job as completed
+    sync_update_job_status(
+        job_id, "completed", 100, 
+        "Video processing completed successfully!",
+        output_url=output_url
+    )
+    
+    if checkpoint:
+        checkpoint.discard()
+
+def report_recorded_upload(job_id: str, checkpoint: Optional[JobCheckpoint]) -> bool:
+    """Complete a job whose worker died after uploading but before reporting it"""
+    upload = checkpoint.completed_upload() if checkpoint else None
+    if not upload:
+        return False
+    sync_update_job_status(
+        job_id, "completed", 100,
+        "Video processing completed successfully!",
+        output_url=upload["output_url"]
+    )
+    checkpoint.discard()
+    return True
+
+@contextmanager
+def job_stage(job_id: str, stage: str, use_checkpoint: bool = True):
+    """Hold the job's checkpoint lock for one stage and report failures.
+
+    Yields None when another live process already owns the job (a duplicate
+    delivery of an acks_late task); the stage should then do nothing. The
+    stage's timing and CPU breakdown is sent to the API when it ends, where
+    the parts of all stages are added up on the job record.
+    """
+    checkpoint = None
+    if use_checkpoint:
+        checkpoint = JobCheckpoint(job_id)
+        if not checkpoint.acquire():
+            logger.warning(f"Job {job_id} is already running on this node, ignoring duplicate {stage} delivery")
+            yield None
+            return
+    
+    stats = JobStats()
     try:
+        with bind_job(job_id), bind_stats(stats):
+            yield checkpoint
+    except Exception as e:
+        logger.error(f"Error processing job {job_id} ({stage}): {str(e)}")
+        sync_update_job_status(
+            job_id, "failed", 0, 
+            "Video processing failed",
+            error=str(e)
+        )
+        raise
+    finally:
+        progress_publisher.publish_stats(job_id, stats.as_dict())
+        # Keep the checkpoint of a failed job for a retry; only the lock goes
+        if checkpoint:
+            checkpoint.release()
+
+@celery_app.task(bind=True, name="process_video_task", acks_late=True, reject_on_worker_lost=True)
+def process_video_task(self, job_id: str, job_data: Dict):
+    """Process video concatenation task.
+
+    The task is acknowledged only once it finishes, so a worker that is
+    killed mid-job gets it redelivered. With checkpointing enabled the rerun
+    resumes from the job's checkpoint, skipping finished downloads,
+    segments, the encoded output and the upload.
+    """
+    with job_stage(job_id, "process", settings.checkpoint_enabled) as checkpoint:
+        if settings.checkpoint_enabled and checkpoint is None:
+            return
+        if report_recorded_upload(job_id, checkpoint):
+            return
+        
         # Update status to processing
         sync_update_job_status(job_id, "processing", 10, "Starting video processing...")
         
         # Create temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download media files
-            media_files = []
-            total_items = len(job_data["media_items"])
+        os.makedirs(settings.scratch_path, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=settings.scratch_path) as temp_dir:
+            media_files = download_media_items(job_id, job_data["media_items"], temp_dir, checkpoint)
             
-            for idx, item in enumerate(job_data["media_items"]):
-                progress = 10 + int((idx / total_items) * 30)
-                sync_update_job_status(
-                    job_id, "processing", progress, 
-                    f"Downloading media file {idx + 1}/{total_items}..."
-                )
-                
-                # Download file
-                local_path = os.path.join(temp_dir, f"media_{idx}{os.path.splitext(item['url'])[1]}")
-                
-                # If URL is from our storage, get local path
-                if item['url'].startswith('/storage/'):
-                    local_path = storage.get_file_path(item['url'])
-                else:
-                    # Download from external URL
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    try:
-                        local_path = loop.run_until_complete(
-                            storage.download_file(item['url'], local_path)
-                        )
-                    finally:
-                        loop.close()
-                
-                media_files.append({
-                    "path": local_path,
-                    "duration": item["duration"],
-                    "start_time": item.get("start_time", 0),
-                    "media_type": item.get("media_type", "auto")
-                })
+            if checkpoint:
+                output_path = checkpoint.path("output.mp4")
+            else:
+                output_path = os.path.join(temp_dir, f"output_{job_id}.mp4")
             
-            # Process videos
-            sync_update_job_status(job_id, "processing", 50, "Processing media files...")
+            render_media_files(job_id, media_files, output_path, job_data["output_settings"], checkpoint)
+            upload_output(job_id, output_path, checkpoint)
+
+# Staged pipeline: fetch (io) -> render (cpu) -> upload (io). Each stage hands
+# its artifacts to the next through the job's checkpoint directory, so
+# CHECKPOINT_PATH must be storage shared by the io and cpu workers. A stage
+# returning None (duplicate delivery, job already finished) ends the chain.
+
+@celery_app.task(bind=True, name="fetch_media_task", acks_late=True, reject_on_worker_lost=True)
+def fetch_media_task(self, job_id: str, job_data: Dict) -> Optional[Dict]:
+    """Download a job's media into its checkpoint directory"""
+    with job_stage(job_id, "fetch") as checkpoint:
+        if checkpoint is None or report_recorded_upload(job_id, checkpoint):
+            return None
+        
+        sync_update_job_status(job_id, "processing", 10, "Starting video processing...")
+        media_files = download_media_items(job_id, job_data["media_items"], checkpoint.dir, checkpoint)
+        return {
+            "job_id": job_id,
+            "media_files": media_files,
+            "output_settings": job_data["output_settings"]
+        }
+
+@celery_app.task(bind=True, name="render_video_task", acks_late=True, reject_on_worker_lost=True)
+def render_video_task(self, fetched: Optional[Dict]) -> Optional[Dict]:
+    """Render and encode the fetched media into the job's output file"""
+    if not fetched:
+        return None
+    job_id = fetched["job_id"]
+    with job_stage(job_id, "render") as checkpoint:
+        if checkpoint is None:
+            return None
+        output_path = checkpoint.path("output.mp4")
+        render_media_files(job_id, fetched["media_files"], output_path, fetched["output_settings"], checkpoint)
+        return {"job_id": job_id, "output_path": output_path}
+
+@celery_app.task(bind=True, name="upload_output_task", acks_late=True, reject_on_worker_lost=True)
+def upload_output_task(self, rendered: Optional[Dict]):
+    """Store the rendered output and complete the job"""
+    if not rendered:
+        return None
+    job_id = rendered["job_id"]
+    with job_stage(job_id, "upload") as checkpoint:
+        if checkpoint is None or report_recorded_upload(job_id, checkpoint):
+            return None
+        upload_output(job_id, rendered["output_path"], checkpoint)
+
+# Distributed render: prepare -> chord(render_segment x N) -> concat. Every
+# media item becomes a normalized segment rendered on any cpu worker and
+# stored through the StorageManager backend; the chord callback joins them
+# without re-encoding the video and uploads the result. Task ids derive from
+# the job id so the API can revoke tasks that do not exist yet.
+
+def segment_task_ids(job_id: str, total: int) -> List[str]:
+    return ([f"{job_id}:prepare"]
+            + [f"{job_id}:segment:{idx}" for idx in range(total)]
+            + [f"{job_id}:concat"])
+
+def fetch_source(url: str, dest_dir: str) -> str:
+    """Local path of a media item or stored segment, downloading it if needed"""
+    if url.startswith('/storage/'):
+        return storage.get_file_path(url)
+    dest_path = os.path.join(dest_dir, f"source{os.path.splitext(url.split('?')[0])[1] or '.mp4'}")
+    with stage_timer("download"):
+        run_async(storage.download_file(url, dest_path))
+    record_bytes("download", os.path.getsize(dest_path))
+    return dest_path
+
+def render_stored_segment(job_id: str, idx: int, item: Dict, output_settings: Dict, size: Optional[List[int]]) -> Dict:
+    """Render one media item to a normalized segment and store it"""
+    os.makedirs(settings.scratch_path, exist_ok=True)
+    processor = engine.processor()
+    with tempfile.TemporaryDirectory(dir=settings.scratch_path) as temp_dir:
+        media = processor.parse_media_info(idx, item)
+        file_path = fetch_source(media["path"], temp_dir)
+        if size is None:
+            size = processor.target_size(output_settings, file_path, media)
+        
+        segment_path = os.path.join(temp_dir, f"segment_{idx}.mp4")
+        has_audio = processor.render_segment(file_path, media, segment_path, output_settings, tuple(size))
+        url = run_async(storage.save_file(f"segments/{job_id}/segment_{idx}.mp4", segment_path))
+    
+    return {"idx": idx, "url": url, "has_audio": has_audio, "size": list(size)}
+
+@celery_app.task(bind=True, name="prepare_segments_task", acks_late=True, reject_on_worker_lost=True)
+def prepare_segments_task(self, job_id: str, job_data: Dict):
+    """Fix the output size and fan the job out into per-segment subtasks.
+
+    Without an explicit resolution the first item decides the size, so it
+    is rendered here and only the remaining items fan out.
+    """
+    items = job_data["media_items"]
+    output_settings = job_data["output_settings"]
+    task_ids = segment_task_ids(job_id, len(items))
+    
+    with job_stage(job_id, "prepare", use_checkpoint=False):
+        if not items:
+            raise ValueError("No valid clips to process")
+        sync_update_job_status(job_id, "processing", 10, f"Rendering {len(items)} segments...")
+        
+        rendered = []
+        size = None
+        if output_settings.get("resolution"):
+            size = list(engine.processor().target_size(output_settings, None, None))
+        else:
+            rendered.append(render_stored_segment(job_id, 0, items[0], output_settings, None))
+            size = rendered[0]["size"]
+        
+        header = [
+            render_segment_task.signature(
+                (job_id, idx, item, output_settings, size),
+                task_id=task_ids[idx + 1]
+            )
+            for idx, item in enumerate(items) if idx >= len(rendered)
+        ]
+        body = concat_segments_task.signature((job_id, len(items), rendered), task_id=task_ids[-1])
+    
+    # Replace outside job_stage: outside eager mode replace() raises Ignore
+    if not header:
+        return self.replace(body.clone(args=([],)))
+    return self.replace(chord(header, body))
+
+@celery_app.task(bind=True, name="render_segment_task", acks_late=True, reject_on_worker_lost=True)
+def render_segment_task(self, job_id: str, idx: int, item: Dict, output_settings: Dict, size: List[int]) -> Dict:
+    """Render media item ``idx`` of a job as a stored segment"""
+    with job_stage(job_id, f"segment {idx}", use_checkpoint=False):
+        segment = render_stored_segment(job_id, idx, item, output_settings, size)
+        sync_update_job_status(job_id, "processing", 50, f"Rendered segment {idx + 1}")
+        return segment
+
+@celery_app.task(bind=True, name="concat_segments_task", acks_late=True, reject_on_worker_lost=True)
+def concat_segments_task(self, segments: List[Dict], job_id: str, total: int, rendered: List[Dict]):
+    """Chord callback: join the stored segments in order and upload the output"""
+    with job_stage(job_id, "concat", use_checkpoint=False):
+        segments = sorted(rendered + segments, key=lambda segment: segment["idx"])
+        if len(segments) != total:
+            raise ValueError(f"Expected {total} segments, got {len(segments)}")
+        sync_update_job_status(job_id, "processing", 85, "Concatenating segments...")
+        
+        os.makedirs(settings.scratch_path, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=settings.scratch_path) as temp_dir:
+            paths = []
+            for segment in segments:
+                segment_dir = os.path.join(temp_dir, str(segment["idx"]))
+                os.makedirs(segment_dir)
+                paths.append(fetch_source(segment["url"], segment_dir))
             
             output_path = os.path.join(temp_dir, f"output_{job_id}.mp4")
-            
-            # Process with progress callback
-            def progress_callback(progress: int, message: str):
-                actual_progress = 50 + int(progress * 0.4)  # 50-90%
-                sync_update_job_status(job_id, "processing", actual_progress, message)
-            
-            video_processor.process_media_files(
-                media_files,
-                output_path,
-                job_data["output_settings"],
-                progress_callback
+            engine.processor().concat_segments(
+                paths, output_path,
+                with_audio=any(segment["has_audio"] for segment in segments)
             )
-            
-            # Upload result
-            sync_update_job_status(job_id, "processing", 90, "Uploading processed video...")
-            
-            output_key = f"outputs/{job_id}/output.mp4"
-            
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+            upload_output(job_id, output_path, None)
+        
+        for segment in segments:
             try:
-                with open(output_path, 'rb') as f:
-                    output_url = loop.run_until_complete(
-                        storage.save_file(output_key, f.read())
-                    )
-            finally:
-                loop.close()
-            
-            # Update job as completed
-            sync_update_job_status(
-                job_id, "completed", 100, 
-                "Video processing completed successfully!",
-                output_url=output_url
-            )
-            
-    except Exception as e:
-        logger.error(f"Error processing job {job_id}: {str(e)}")
-        sync_update_job_status(
-            job_id, "failed", 0, 
-            "Video processing failed",
-            error=str(e)
-        )
-        raise
+                run_async(storage.delete_file(segment["url"]))
+            except Exception as e:
+                logger.warning(f"Failed to delete segment {segment['url']}: {e}")
+
+def dispatch_job(job_id: str, job_data: Dict) -> List[str]:
+    """Queue a job and return the ids of its Celery tasks, first stage first.
+
+    With ``celery_distributed_render`` the job is split per media item
+    across the cluster. Without checkpoints there is no shared place to hand
+    artifacts between stages, so the job runs as a single
+    process_video_task instead.
+    """
+    if settings.celery_distributed_render:
+        task_ids = segment_task_ids(job_id, len(job_data["media_items"]))
+        prepare_segments_task.apply_async((job_id, job_data), task_id=task_ids[0])
+        return task_ids
+    
+    if not settings.checkpoint_enabled:
+        return [process_video_task.delay(job_id, job_data).id]
+    
+    result = chain(
+        fetch_media_task.s(job_id, job_data),
+        render_video_task.s(),
+        upload_output_task.s()
+    ).apply_async()
+    
+    task_ids = []
+    while result is not None:
+        task_ids.insert(0, result.id)
+        result = result.parent
+    return task_ids
 
 # Worker configuration
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+"""On-disk checkpoints so interrupted jobs resume instead of restarting"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class JobCheckpoint:
+    """Stage and segment progress of one job, persisted under ``checkpoint_path/<job_id>``.
+
+    Layout::
+
+        state.json        job spec plus completed downloads, segments, output and upload
+        lock              flock held while a process is working on the job
+        terminal          final status, once the job completed, failed or was cancelled
+        source_<n>_<name> downloaded source, deleted once its segment is rendered
+        segment_<n>.mp4   normalized, encoded segment for media item n
+
+    Kept downloads and segments together stay under ``checkpoint_max_bytes``;
+    whatever does not fit is left in scratch space and redone on resume.
+
+    Every artifact is written to a temporary name and recorded only after it
+    is complete, so a crash at any point leaves either a usable artifact or
+    nothing.
+    """
+
+    STATE_FILE = "state.json"
+
+    def __init__(self, job_id: str, root: Optional[str] = None):
+        self.job_id = job_id
+        self.dir = os.path.join(root or settings.checkpoint_path, job_id)
+        self.state_path = os.path.join(self.dir, self.STATE_FILE)
+        self._lock_fd: Optional[int] = None
+        os.makedirs(self.dir, exist_ok=True)
+        self.state = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable checkpoint for job {self.job_id}: {e}")
+        return {
+            "job_id": self.job_id,
+            "created_at": datetime.utcnow().isoformat(),
+            "spec": None,
+            "target_size": None,
+            "downloads": {},
+            "segments": {},
+            "output": None,
+            "upload": None,
+        }
+
+    def save(self):
+        self.state["updated_at"] = datetime.utcnow().isoformat()
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    # Locking -----------------------------------------------------------------
+
+    def acquire(self) -> bool:
+        """Take the per-job lock; False if another live process holds it.
+
+        The kernel drops the lock when the owning process dies, so a job
+        whose worker was killed becomes recoverable immediately.
+        """
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(os.path.join(self.dir, "lock"), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def release(self):
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    # Artifacts ---------------------------------------------------------------
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def _completed(self, entry: Optional[dict]) -> Optional[str]:
+        # An artifact counts only if it is still on disk with the recorded size
+        if not entry:
+            return None
+        path = entry["path"]
+        try:
+            if os.path.getsize(path) == entry["size"]:
+                return path
+        except OSError:
+            pass
+        return None
+
+    def record_spec(self, spec: Dict):
+        self.state["spec"] = spec
+        self.save()
+
+    def completed_download(self, idx: int) -> Optional[str]:
+        return self._completed(self.state["downloads"].get(str(idx)))
+
+    def keep_download(self, idx: int, path: str) -> str:
+        """Move a finished download into the checkpoint and return its new path"""
+        size = os.path.getsize(path)
+        if self.footprint() + size > settings.checkpoint_max_bytes:
+            # Over budget: the source stays a scratch file and is re-fetched on resume
+            logger.info(f"Checkpoint for job {self.job_id} is over budget, not keeping source {idx}")
+            return path
+        kept_path = self.path(f"source_{idx}_{os.path.basename(path)}")
+        if os.path.abspath(path) != os.path.abspath(kept_path):
+            shutil.move(path, kept_path)
+        self.state["downloads"][str(idx)] = {"path": kept_path, "size": size}
+        self.save()
+        return kept_path
+
+    def completed_segment(self, idx: int) -> Optional[str]:
+        return self._completed(self.state["segments"].get(str(idx)))
+
+    def keep_segment(self, idx: int, path: str, has_audio: bool) -> str:
+        """Move a rendered segment into the checkpoint and return its new path"""
+        size = os.path.getsize(path)
+        # The segment supersedes its source download
+        download = self.state["downloads"].get(str(idx))
+        if self.footprint() - (download["size"] if download else 0) + size > settings.checkpoint_max_bytes:
+            # Over budget: the segment stays a scratch file and is re-rendered on resume
+            logger.info(f"Checkpoint for job {self.job_id} is over budget, not keeping segment {idx}")
+            return path
+        kept_path = self.path(f"segment_{idx}.mp4")
+        if os.path.abspath(path) != os.path.abspath(kept_path):
+            shutil.move(path, kept_path)
+        self.state["segments"][str(idx)] = {"path": kept_path, "size": size, "has_audio": has_audio}
+        self.state["downloads"].pop(str(idx), None)
+        if download and os.path.exists(download["path"]):
+            os.remove(download["path"])
+        self.save()
+        return kept_path
+
+    def segment_has_audio(self, idx: int) -> bool:
+        return bool(self.state["segments"].get(str(idx), {}).get("has_audio"))
+
+    def completed_output(self) -> Optional[str]:
+        return self._completed(self.state.get("output"))
+
+    def record_output(self, path: str):
+        self.state["output"] = {"path": path, "size": os.path.getsize(path)}
+        # Segments are no longer needed once the output exists
+        for entry in self.state["segments"].values():
+            if os.path.exists(entry["path"]):
+                os.remove(entry["path"])
+        self.save()
+
+    def completed_upload(self) -> Optional[dict]:
+        return self.state.get("upload")
+
+    def record_upload(self, result: dict):
+        self.state["upload"] = result
+        self.save()
+
+    def record_terminal(self, status: str):
+        """Mark the job finished, so it is never recovered even if this checkpoint outlives it.
+
+        Kept in its own file: the process working on the job rewrites
+        state.json from memory and would drop the mark.
+        """
+        with open(self.path("terminal"), "w") as f:
+            f.write(status)
+
+    def terminal_status(self) -> Optional[str]:
+        try:
+            with open(self.path("terminal")) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def footprint(self) -> int:
+        total = 0
+        for name in os.listdir(self.dir):
+            try:
+                total += os.path.getsize(os.path.join(self.dir, name))
+            except OSError:
+                pass
+        return total
+
+    def discard(self):
+        """Delete the checkpoint and everything in it"""
+        self.release()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def has_checkpoint(job_id: str, root: Optional[str] = None) -> bool:
+    return os.path.isdir(os.path.join(root or settings.checkpoint_path, job_id))
+
+
+def list_checkpoints(root: Optional[str] = None) -> List[str]:
+    """Job ids that have a checkpoint directory on this node"""
+    root = root or settings.checkpoint_path
+    try:
+        return [name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name))]
+    except FileNotFoundError:
+        return []
@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings
 from typing import Optional
 import os
+import tempfile
 
 class Settings(BaseSettings):
     # API Settings
@@ -20,6 +21,7 @@ class Settings(BaseSettings):
     # Storage
     storage_backend: str = os.getenv("STORAGE_BACKEND", "local")  # local, s3, minio
     storage_path: str = os.getenv("STORAGE_PATH", "./storage")
+    scratch_path: str = os.getenv("SCRATCH_PATH", os.path.join(tempfile.gettempdir(), "video-processor-scratch"))
     
     # S3/MinIO settings
     s3_endpoint: Optional[str] = os.getenv("S3_ENDPOINT")
@@ -27,15 +29,114 @@ class Settings(BaseSettings):
     s3_secret_key: Optional[str] = os.getenv("S3_SECRET_KEY")
     s3_bucket: str = os.getenv("S3_BUCKET", "video-processor")
     s3_region: str = os.getenv("S3_REGION", "us-east-1")
+    storage_part_size: int = 64 * 1024 * 1024  # multipart part size (S3 minimum is 5MB)
+    storage_multipart_threshold: int = 64 * 1024 * 1024
+    storage_upload_concurrency: int = 4
+    storage_io_workers: int = 8  # threads for blocking storage calls
+    presigned_downloads: bool = True  # redirect output downloads to S3/MinIO
+    presigned_url_ttl: int = 300
     
     # Celery
     celery_broker_url: str = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
     celery_result_backend: str = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
-    
+    job_executor: str = os.getenv("JOB_EXECUTOR", "background")  # background, celery, mock (no rendering; load tests)
+    mock_job_seconds: float = 2.0  # how long a mock job "processes"
+    engine_warm_up: bool = True  # run a tiny encode once the engine is imported, before the first job
+    celery_io_queue: str = "io"  # downloads and uploads
+    celery_cpu_queue: str = "cpu"  # render and encode
+    celery_distributed_render: bool = False  # render each media item as its own task
+
+    # Worker progress channel (Redis stream; defaults to the Celery broker)
+    progress_redis_url: Optional[str] = os.getenv("PROGRESS_REDIS_URL")
+    progress_stream: str = "video-processor:progress"
+    progress_coalesce_interval: float = 1.0
+    progress_stream_maxlen: int = 10000
+    progress_claim_idle: float = 60.0  # updates a crashed replica read but never acknowledged are taken over after this
+    worker_metrics_port: int = int(os.getenv("WORKER_METRICS_PORT", 0))  # Prometheus /metrics of a worker; 0 = off
+    event_loop_lag_interval: float = 0.25  # how often the API probes its event loop lag; 0 = off
+
+    # On-demand job profiles (POST /api/v1/admin/jobs/{job_id}/profile)
+    profile_max_seconds: float = 120.0
+    profile_default_interval: float = 0.01  # seconds between stack samples
+    profile_requests_key: str = "video-processor:profile-requests"  # Redis hash read by Celery workers
+    profile_request_ttl: int = 300  # a request not picked up by a worker within this is dropped
+    profile_poll_interval: float = 2.0  # how often a worker running jobs checks for requests
+
+    # Google Drive uploads (credentials come from GOOGLE_DRIVE_CREDENTIALS[_JSON])
+    gdrive_api_endpoint: Optional[str] = os.getenv("GOOGLE_DRIVE_API_ENDPOINT")  # e.g. a local fake Drive server
+    gdrive_upload_workers: int = 2
+    gdrive_queue_size: int = 1000
+    gdrive_chunk_size: int = 8 * 1024 * 1024  # resumable chunk, a multiple of 256KB
+    gdrive_permission_batch_size: int = 50  # the batch endpoint takes up to 100
+    gdrive_permission_batch_delay: float = 2.0
+    gdrive_timeout: int = 60
+    gdrive_pending_timeout: int = 3600  # an upload still pending after this (its process stopped) is retried once, then failed
+
     # Processing
     max_file_size: int = 500 * 1024 * 1024  # 500MB
+    download_chunk_size: int = 1024 * 1024  # streamed download buffer
+    segmented_download_min_size: int = 16 * 1024 * 1024  # below this one connection is enough
+    segmented_download_part_size: int = 16 * 1024 * 1024  # target bytes per range
+    segmented_download_max_parts: int = 8
+    http_pool_hosts: int = 32  # origins kept in the download connection pool
+    http_pool_maxsize: int = 16  # keep-alive connections per origin
+    origin_rate: float = 10.0  # download requests per second per origin
+    origin_burst: int = 20
+    origin_max_wait: float = 30.0  # fail instead of waiting longer for a throttled origin
+    circuit_failure_threshold: int = 5  # consecutive failures before an origin is skipped
+    circuit_reset_timeout: float = 60.0  # then one probe request is let through
+    negative_cache_ttl: int = 300  # URLs that answered 404 / HTML are refused this long
+    negative_cache_size: int = 10000
     allowed_video_extensions: set = {".mp4", ".avi", ".mov", ".mkv", ".flv", ".wmv", ".webm"}
     allowed_image_extensions: set = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff"}
+
+    # Fair-share scheduling (tenants are "user:<id>", "sheet:<spreadsheet id>" or "anonymous")
+    scheduler_max_running: int = 0  # optional cap on jobs running at once; 0 = memory budget only
+    tenant_default_max_running: int = 2
+    tenant_weights: dict = {}  # e.g. {"sheet:abc": 3}; unlisted tenants weigh 1
+    tenant_max_running: dict = {}  # per-tenant overrides of tenant_default_max_running
+
+    # Shared job state (redis: any number of API replicas and render nodes share jobs and a leased work queue)
+    job_store_backend: str = os.getenv("JOB_STORE_BACKEND", "memory")  # memory, redis
+    job_store_redis_url: Optional[str] = os.getenv("JOB_STORE_REDIS_URL")  # defaults to the Celery broker
+    job_store_prefix: str = "video-processor"
+    storage_shared: bool = False  # STORAGE_PATH is one volume mounted on every node (NFS etc.); required by redis unless Celery stores outputs in S3/MinIO
+    render_jobs: bool = True  # lease queued jobs and run them (or hand them to Celery); false for API-only replicas
+    job_lease_seconds: float = 30.0  # a lease not renewed within this expires and its job is requeued
+    job_lease_poll_interval: float = 1.0  # how often a node renews its leases, reaps expired ones and claims work
+    job_lease_max_jobs: int = 0  # leases a node holds at once; 0 = whatever its scheduler admits
+    job_lease_max_expirations: int = 3  # then the job fails instead of being requeued again
+
+    # Memory admission (jobs start while their estimated peaks fit the budget)
+    memory_budget_bytes: int = 0  # 0 = memory_budget_fraction of the container limit / RAM
+    memory_budget_fraction: float = 0.8
+    memory_default_image_pixels: int = 12_000_000  # assumed for remote images (4000x3000)
+    memory_sample_interval: float = 1.0
+
+    # Webhooks (completion callbacks)
+    webhook_secret: Optional[str] = os.getenv("WEBHOOK_SECRET")  # falls back to secret_key
+    webhook_timeout: float = 10.0
+    webhook_max_attempts: int = 6
+    webhook_backoff_base: float = 2.0
+    webhook_backoff_max: float = 300.0
+    webhook_workers: int = 2
+    webhook_queue_size: int = 10000
+
+    # Retention (seconds; 0 disables the background reclaimer / byte budget)
+    retention_interval: int = 600
+    retention_completed_ttl: int = 7 * 24 * 3600
+    retention_failed_ttl: int = 24 * 3600
+    retention_cancelled_ttl: int = 3600
+    storage_budget_bytes: int = 20 * 1024 * 1024 * 1024  # 20GB of job outputs
+    orphan_grace_period: int = 3600
+    scratch_ttl: int = 6 * 3600
+    
+    # Checkpointing (resume interrupted jobs on the same node). Opt-in: renders each item as its own
+    # segment joined without re-encoding instead of one composed encode, and enables the staged Celery chain
+    checkpoint_enabled: bool = False
+    checkpoint_path: str = os.getenv("CHECKPOINT_PATH", os.path.join(os.getenv("STORAGE_PATH", "./storage"), "checkpoints"))
+    checkpoint_max_bytes: int = 2 * 1024 * 1024 * 1024  # per job, kept downloads and segments together
+    checkpoint_ttl: int = 24 * 3600
     
     # CORS
     cors_origins: list = [
@@ -0,0 +1,176 @@
+"""Media download helpers: shared keep-alive connection pool and parallel byte-range fetching"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cancellation import CancelToken, JobCancelled
+from config import settings
+from metrics import BYTES_DOWNLOADED
+from origin_guard import origin_guard
+
+logger = logging.getLogger(__name__)
+
+
+HTML_PREFIXES = (b"<!doctype html", b"<html")
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+class RangeNotSupported(Exception):
+    """The server answered a range request with something other than that range"""
+
+
+def get_session() -> requests.Session:
+    """Process-wide session for media downloads.
+
+    urllib3 keeps a keep-alive pool per host (``http_pool_hosts`` hosts,
+    ``http_pool_maxsize`` connections each), so consecutive downloads from
+    the same origin reuse one TCP/TLS connection instead of handshaking
+    again. requests speaks HTTP/1.1 only.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=settings.http_pool_hosts,
+                pool_maxsize=settings.http_pool_maxsize
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def looks_like_html(content_type: str, first_bytes: bytes) -> bool:
+    """An HTML page (error, login or confirmation) where media was expected"""
+    if "text/html" in content_type.lower():
+        return True
+    return first_bytes[:512].lstrip().lower().startswith(HTML_PREFIXES)
+
+
+def plan_segments(total_size: int) -> List[Tuple[int, int]]:
+    """Split ``total_size`` bytes into inclusive (start, end) ranges.
+
+    About one range per ``segmented_download_part_size`` bytes, capped at
+    ``segmented_download_max_parts`` connections.
+    """
+    count = max(1, min(settings.segmented_download_max_parts,
+                       -(-total_size // settings.segmented_download_part_size)))
+    step = -(-total_size // count)
+    return [(start, min(start + step, total_size) - 1) for start in range(0, total_size, step)]
+
+
+def supports_ranges(response: requests.Response) -> bool:
+    """Whether a full GET response advertises byte ranges on an unencoded body"""
+    return (response.headers.get("accept-ranges", "").lower() == "bytes"
+            and not response.headers.get("content-encoding"))
+
+
+def download_ranges(
+    session: requests.Session,
+    url: str,
+    output_path: str,
+    total_size: int,
+    cancel_token: Optional[CancelToken] = None,
+    timeout: float = 60,
+    headers: Optional[dict] = None
+) -> int:
+    """Fetch ``url`` over several parallel range requests into a preallocated file.
+
+    Each range is written at its own offset with ``os.pwrite`` in
+    ``download_chunk_size`` blocks and resumed from where it stopped if its
+    connection drops. Raises RangeNotSupported if the server ignores the
+    Range header, in which case the caller should stream the file normally.
+    """
+    segments = plan_segments(total_size)
+    logger.info(f"Downloading {total_size} bytes in {len(segments)} ranges: {url}")
+
+    with open(output_path, "wb") as f:
+        f.truncate(total_size)
+
+    failed = threading.Event()
+    fd = os.open(output_path, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix="range-download") as pool:
+            futures = [
+                pool.submit(_fetch_range, session, url, fd, start, end, failed, cancel_token, timeout, headers or {})
+                for start, end in segments
+            ]
+            errors = []
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.set()
+                    errors.append(e)
+    finally:
+        os.close(fd)
+
+    if errors:
+        # Prefer the error that explains the others
+        for error_type in (JobCancelled, RangeNotSupported):
+            for error in errors:
+                if isinstance(error, error_type):
+                    raise error
+        raise errors[0]
+    return total_size
+
+
+def _fetch_range(
+    session: requests.Session,
+    url: str,
+    fd: int,
+    start: int,
+    end: int,
+    failed: threading.Event,
+    cancel_token: Optional[CancelToken],
+    timeout: float,
+    headers: dict,
+    max_attempts: int = 3
+):
+    offset = start
+    for attempt in range(max_attempts):
+        if failed.is_set():
+            return
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        try:
+            origin_guard.acquire(url, cancel_token)
+            response = session.get(url, headers={**headers, "Range": f"bytes={offset}-{end}"}, stream=True, timeout=timeout)
+            origin_guard.record(url, response.status_code, response.headers.get("retry-after"))
+            callback = cancel_token.add_callback(response.close) if cancel_token else None
+            try:
+                if response.status_code != 206 or not response.headers.get("content-range", "").startswith(f"bytes {offset}-"):
+                    raise RangeNotSupported(f"Range request answered with HTTP {response.status_code}")
+                for chunk in response.iter_content(chunk_size=settings.download_chunk_size):
+                    if failed.is_set():
+                        return
+                    if cancel_token:
+                        cancel_token.raise_if_cancelled()
+                    if offset + len(chunk) > end + 1:
+                        raise RangeNotSupported("Server sent more bytes than requested")
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                    BYTES_DOWNLOADED.inc(len(chunk))
+            finally:
+                if callback:
+                    cancel_token.remove_callback(callback)
+                response.close()
+            if offset == end + 1:
+                return
+            raise requests.exceptions.ChunkedEncodingError(f"Range {start}-{end} ended early at {offset}")
+        except requests.exceptions.RequestException as e:
+            if cancel_token and cancel_token.cancelled:
+                raise JobCancelled("Download cancelled") from e
+            if getattr(e, "response", None) is None:
+                origin_guard.record(url)
+            logger.warning(f"Range {offset}-{end} attempt {attempt + 1} failed: {e}")
+            if attempt == max_attempts - 1:
+                raise
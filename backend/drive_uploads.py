@@ -0,0 +1,150 @@
+"""Background Google Drive uploads, decoupled from job completion"""
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from config import settings
+from metrics import BYTES_UPLOADED, stage_timer
+
+logger = logging.getLogger(__name__)
+
+# on_done(job_id, gdrive_url, error): exactly one of gdrive_url / error is set
+UploadCallback = Callable[[str, Optional[str], Optional[str]], None]
+
+
+class DriveUploadQueue:
+    """Uploads finished outputs to Drive on a bounded pool of threads.
+
+    Uploaded files wait up to ``gdrive_permission_batch_delay`` seconds so
+    their "anyone with the link" permissions go out as one batch request;
+    each job's callback runs once its file is shared (or has failed).
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or settings.gdrive_upload_workers
+        self.stats = {"queued": 0, "uploaded": 0, "failed": 0, "permission_batches": 0}
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=settings.gdrive_queue_size)
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._to_share: List[tuple] = []
+        self._active = set()  # job ids queued or uploading here
+        self._share_wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    @property
+    def drive(self):
+        # Imported on first use: storage pulls in boto3 and minio, which the API does not need to start
+        from storage import get_drive_storage
+        return get_drive_storage()
+
+    def enabled(self) -> bool:
+        return self.drive.configured
+
+    def submit(self, job_id: str, file_path: str, filename: str, on_done: UploadCallback):
+        """Queue an upload; raises queue.Full if the backlog is at its limit"""
+        self._ensure_started()
+        with self._lock:
+            self._active.add(job_id)
+        try:
+            self._queue.put_nowait((job_id, file_path, filename, on_done))
+        except queue.Full:
+            with self._lock:
+                self._active.discard(job_id)
+            raise
+        with self._lock:
+            self.stats["queued"] += 1
+
+    def active(self, job_id: str) -> bool:
+        """Whether this process still has the job's upload queued or in flight"""
+        with self._lock:
+            return job_id in self._active
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._queue.qsize() + len(self._to_share)
+
+    def stop(self):
+        self._stop.set()
+        self._share_wakeup.set()
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(5)
+        self._threads = []
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._upload_loop, name=f"drive-upload-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._share_loop, name="drive-share", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _upload_loop(self):
+        while not self._stop.is_set():
+            item = self._queue.get()
+            if item is None:
+                return
+            job_id, file_path, filename, on_done = item
+            started = time.time()
+            try:
+                with stage_timer("upload"):
+                    file_id = self.drive.upload_file(file_path, filename)
+                BYTES_UPLOADED.labels("gdrive").inc(os.path.getsize(file_path))
+            except Exception as e:
+                logger.error(f"Failed to upload {filename} to Google Drive: {e}")
+                self._finish(on_done, job_id, None, str(e))
+                continue
+            logger.info(f"Uploaded {filename} to Google Drive in {time.time() - started:.1f}s")
+            with self._lock:
+                self._to_share.append((file_id, job_id, on_done))
+                full = len(self._to_share) >= settings.gdrive_permission_batch_size
+            if full:
+                self._share_wakeup.set()
+
+    def _share_loop(self):
+        while not self._stop.is_set():
+            self._share_wakeup.wait(settings.gdrive_permission_batch_delay)
+            self._share_wakeup.clear()
+            with self._lock:
+                batch, self._to_share = self._to_share, []
+            if batch:
+                self._share(batch)
+
+    def _share(self, batch: List[tuple]):
+        try:
+            errors: Dict[str, Optional[str]] = self.drive.share_files([file_id for file_id, _, _ in batch])
+        except Exception as e:
+            errors = {file_id: str(e) for file_id, _, _ in batch}
+        with self._lock:
+            self.stats["permission_batches"] += 1
+        for file_id, job_id, on_done in batch:
+            error = errors.get(file_id, "No response for permission request")
+            if error:
+                logger.error(f"Failed to share Google Drive file {file_id} of job {job_id}: {error}")
+                self._finish(on_done, job_id, None, error)
+            else:
+                self._finish(on_done, job_id, self.drive.shareable_url(file_id), None)
+
+    def _finish(self, on_done: UploadCallback, job_id: str, url: Optional[str], error: Optional[str]):
+        with self._lock:
+            self._active.discard(job_id)
+            self.stats["failed" if error else "uploaded"] += 1
+        try:
+            on_done(job_id, url, error)
+        except Exception as e:
+            logger.error(f"Drive upload callback failed for job {job_id}: {e}")
+
+
+drive_uploads = DriveUploadQueue()
@@ -0,0 +1,114 @@
+"""Lazy loading and warm-up of the rendering engine.
+
+Importing video_processor pulls in MoviePy, NumPy, PIL and imageio, which
+takes seconds on a cold container. The API starts serving first and loads
+the engine on a background thread; jobs that start before it is ready wait
+for it. Celery workers load and warm it in the parent process before the
+pool forks (see celery_app), so every child starts with the modules
+imported and ffmpeg already exercised.
+"""
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class EngineLoader:
+    """Imports VideoProcessor once, on first use or in the background"""
+
+    def __init__(self):
+        self.state = "idle"  # idle, loading, ready, unavailable
+        self.error: Optional[str] = None
+        self.ffmpeg: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self.warm_seconds: Optional[float] = None
+        self._processor = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        """False only once loading has failed; jobs submitted while loading wait for it"""
+        return self.state != "unavailable"
+
+    def load(self, warm: bool = False) -> bool:
+        """Import the engine unless done already (blocks while another thread loads it); True if usable"""
+        with self._lock:
+            if self.state in ("idle", "loading"):
+                self._import()
+            if warm and self._processor is not None and self.warm_seconds is None:
+                self._warm_up()
+        return self._processor is not None
+
+    def processor(self):
+        """The shared VideoProcessor; raises RuntimeError if the engine cannot be imported"""
+        if not self.load():
+            raise RuntimeError(f"Rendering engine unavailable: {self.error}")
+        return self._processor
+
+    def start(self, on_ready: Optional[Callable[[], None]] = None):
+        """Load (and warm) the engine on a background thread; ``on_ready`` runs after a successful load"""
+        def run():
+            if self.load(warm=settings.engine_warm_up) and on_ready:
+                on_ready()
+
+        self.state = "loading"
+        threading.Thread(target=run, name="engine-loader", daemon=True).start()
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "ffmpeg": self.ffmpeg,
+            "load_seconds": self.load_seconds,
+            "warm_seconds": self.warm_seconds,
+        }
+
+    def _import(self):
+        # Called with self._lock held
+        self.state = "loading"
+        started = time.perf_counter()
+        try:
+            import moviepy_config  # noqa: F401  ffmpeg location, before MoviePy is imported
+            import pillow_compat  # noqa: F401
+            from video_processor import VideoProcessor
+            self._processor = VideoProcessor()
+            self.state = "ready"
+        except Exception as e:
+            logger.error(f"Rendering engine unavailable, jobs will run in mock mode: {e}", exc_info=True)
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "unavailable"
+        self.load_seconds = round(time.perf_counter() - started, 3)
+        logger.info(f"Rendering engine {self.state} after {self.load_seconds}s")
+
+    def _warm_up(self):
+        """Locate ffmpeg and run a tiny encode so the first job does not pay for it"""
+        from imageio_ffmpeg import get_ffmpeg_exe
+        started = time.perf_counter()
+        os.makedirs(settings.scratch_path, exist_ok=True)
+        fd, output_path = tempfile.mkstemp(suffix=".mp4", prefix="warmup-", dir=settings.scratch_path)
+        os.close(fd)
+        try:
+            self.ffmpeg = get_ffmpeg_exe()
+            subprocess.run([
+                self.ffmpeg, "-y", "-v", "error",
+                "-f", "lavfi", "-i", "testsrc2=size=64x64:rate=10:duration=0.5",
+                "-f", "lavfi", "-i", "sine=duration=0.5",
+                "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-c:a", "aac",
+                output_path,
+            ], check=True, capture_output=True, timeout=60)
+        except (OSError, RuntimeError, subprocess.SubprocessError) as e:
+            logger.warning(f"Engine warm-up encode failed: {e}")
+        finally:
+            os.remove(output_path)
+        self.warm_seconds = round(time.perf_counter() - started, 3)
+        logger.info(f"Rendering engine warmed up in {self.warm_seconds}s (ffmpeg: {self.ffmpeg})")
+
+
+engine = EngineLoader()
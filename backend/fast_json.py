@@ -0,0 +1,27 @@
+"""JSON responses for the endpoints every spreadsheet polls.
+
+Returning a dict from a FastAPI endpoint runs it through jsonable_encoder,
+which walks and copies every value in Python before json.dumps. Job and
+batch payloads are built from plain JSON types already, so these endpoints
+encode them directly: with orjson when it is installed, else with compact
+stdlib json.
+"""
+import json
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,339 @@
+"""Shared work queue with fair tenant order and heartbeated job leases in Redis.
+
+Used with the Redis job store (see job_store): any API replica enqueues a
+job; any process with ``render_jobs`` enabled (a render node, or an API
+replica that also renders) leases it, runs it, and renews the lease while
+it runs. A lease that is not renewed within ``job_lease_seconds`` expires
+and the job goes back to the front of its tenant's queue for another node,
+up to ``job_lease_max_expirations`` times. Leases are released when the job
+reaches a terminal status, whichever replica records it.
+
+Tenants take turns by the same weighted virtual clock as the in-process
+FairScheduler, and ``tenant_max_running`` caps apply across the cluster.
+Each node still admits its leased jobs through its own FairScheduler and
+memory budget, and only leases another job while nothing is waiting there.
+All state changes are Lua scripts, so claims are atomic and timed by the
+Redis clock rather than the nodes' clocks.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+from typing import Callable, Dict, List, Optional, Set
+
+import redis
+
+from config import settings
+from job_store import RedisConnection, shared
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+# Shared by the scripts below: release a lease, and queue a job at the front of its tenant's queue
+_LUA_HELPERS = """
+local p = ARGV[1]
+local function now()
+    local t = redis.call('TIME')
+    return tonumber(t[1]) + tonumber(t[2]) / 1000000
+end
+local function push(tenant, job_id, front)
+    if front then
+        redis.call('LPUSH', p .. ':queue:' .. tenant, job_id)
+    else
+        redis.call('RPUSH', p .. ':queue:' .. tenant, job_id)
+    end
+    if not redis.call('ZSCORE', p .. ':tenants', tenant) then
+        -- an idle tenant rejoins at the clock of the last start, without banked credit
+        local vtime = math.max(tonumber(redis.call('HGET', p .. ':vtimes', tenant) or 0),
+                               tonumber(redis.call('GET', p .. ':vclock') or 0))
+        redis.call('ZADD', p .. ':tenants', vtime, tenant)
+    end
+end
+local function drop_lease(job_id)
+    local tenant = redis.call('HGET', p .. ':lease-tenants', job_id)
+    if not tenant or redis.call('ZREM', p .. ':leases', job_id) == 0 then
+        return false
+    end
+    redis.call('HDEL', p .. ':lease-owners', job_id)
+    redis.call('HDEL', p .. ':lease-tenants', job_id)
+    if redis.call('HINCRBY', p .. ':running', tenant, -1) <= 0 then
+        redis.call('HDEL', p .. ':running', tenant)
+    end
+    return tenant
+end
+local function finished(job_id)
+    local status = redis.call('HGET', p .. ':job:' .. job_id, 'status')
+    return not status or status == '"completed"' or status == '"failed"' or status == '"cancelled"'
+end
+"""
+
+ENQUEUE = _LUA_HELPERS + """
+push(ARGV[2], ARGV[3], false)
+return 1
+"""
+
+REMOVE = _LUA_HELPERS + """
+local tenant, job_id = ARGV[2], ARGV[3]
+local removed = redis.call('LREM', p .. ':queue:' .. tenant, 0, job_id)
+if redis.call('LLEN', p .. ':queue:' .. tenant) == 0 then
+    redis.call('ZREM', p .. ':tenants', tenant)
+end
+return removed
+"""
+
+CLAIM = _LUA_HELPERS + """
+local ttl, owner = tonumber(ARGV[2]), ARGV[3]
+local weights, limits, default_limit = cjson.decode(ARGV[4]), cjson.decode(ARGV[5]), tonumber(ARGV[6])
+for _, tenant in ipairs(redis.call('ZRANGE', p .. ':tenants', 0, -1)) do
+    local running = tonumber(redis.call('HGET', p .. ':running', tenant) or 0)
+    if running < tonumber(limits[tenant] or default_limit) then
+        local job_id = redis.call('LPOP', p .. ':queue:' .. tenant)
+        local vtime = tonumber(redis.call('ZSCORE', p .. ':tenants', tenant))
+        if job_id then
+            local next_vtime = vtime + 1 / math.max(tonumber(weights[tenant] or 1), 0.01)
+            redis.call('SET', p .. ':vclock', vtime)
+            redis.call('HSET', p .. ':vtimes', tenant, next_vtime)
+            if redis.call('LLEN', p .. ':queue:' .. tenant) == 0 then
+                redis.call('ZREM', p .. ':tenants', tenant)
+            else
+                redis.call('ZADD', p .. ':tenants', next_vtime, tenant)
+            end
+            redis.call('HINCRBY', p .. ':running', tenant, 1)
+            redis.call('ZADD', p .. ':leases', now() + ttl, job_id)
+            redis.call('HSET', p .. ':lease-owners', job_id, owner)
+            redis.call('HSET', p .. ':lease-tenants', job_id, tenant)
+            return job_id
+        end
+        redis.call('ZREM', p .. ':tenants', tenant)
+    end
+end
+return false
+"""
+
+HEARTBEAT = _LUA_HELPERS + """
+local ttl, owner = tonumber(ARGV[2]), ARGV[3]
+local expires, lost = now() + ttl, {}
+for i = 4, #ARGV do
+    if redis.call('HGET', p .. ':lease-owners', ARGV[i]) == owner then
+        redis.call('ZADD', p .. ':leases', expires, ARGV[i])
+    else
+        table.insert(lost, ARGV[i])
+    end
+end
+return lost
+"""
+
+RELEASE = _LUA_HELPERS + """
+local owner, job_id, requeue = ARGV[2], ARGV[3], ARGV[4] == '1'
+if owner ~= '' and redis.call('HGET', p .. ':lease-owners', job_id) ~= owner then
+    return 0
+end
+local tenant = drop_lease(job_id)
+if not tenant then
+    return 0
+end
+if requeue and not finished(job_id) then
+    push(tenant, job_id, true)
+end
+return 1
+"""
+
+REAP = _LUA_HELPERS + """
+local max_expirations, limit = tonumber(ARGV[2]), tonumber(ARGV[3])
+local requeued, abandoned = {}, {}
+for _, job_id in ipairs(redis.call('ZRANGEBYSCORE', p .. ':leases', '-inf', now(), 'LIMIT', 0, limit)) do
+    local tenant = drop_lease(job_id)
+    if tenant and not finished(job_id) then
+        if redis.call('HINCRBY', p .. ':job:' .. job_id, 'lease_expirations', 1) > max_expirations then
+            table.insert(abandoned, job_id)
+        else
+            push(tenant, job_id, true)
+            table.insert(requeued, job_id)
+        end
+    end
+end
+return {requeued, abandoned}
+"""
+
+
+class SharedJobQueue:
+    """The Redis side: queue, claim, renew and release leases"""
+
+    def __init__(self, connection: Optional[RedisConnection] = None, prefix: Optional[str] = None):
+        self._connection = connection or RedisConnection()
+        self.prefix = prefix or settings.job_store_prefix
+
+    @property
+    def enabled(self) -> bool:
+        return shared()
+
+    @property
+    def owner(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _eval(self, script: str, *args):
+        return self._connection.client.eval(script, 0, self.prefix, *args)
+
+    def enqueue(self, tenant: str, job_id: str):
+        self._eval(ENQUEUE, tenant, job_id)
+
+    def remove(self, tenant: str, job_id: str) -> bool:
+        """Drop a job that is still queued (cancelled before any node leased it)"""
+        return bool(self._eval(REMOVE, tenant, job_id))
+
+    def claim(self) -> Optional[str]:
+        """Lease the next job in fair order, or None when nothing is eligible"""
+        job_id = self._eval(
+            CLAIM, settings.job_lease_seconds, self.owner,
+            json.dumps(settings.tenant_weights), json.dumps(settings.tenant_max_running),
+            settings.tenant_default_max_running,
+        )
+        return job_id.decode() if job_id else None
+
+    def heartbeat(self, job_ids: List[str]) -> List[str]:
+        """Renew this node's leases; returns the jobs whose lease it no longer holds"""
+        if not job_ids:
+            return []
+        return [job_id.decode() for job_id in self._eval(HEARTBEAT, settings.job_lease_seconds, self.owner, *job_ids)]
+
+    def release(self, job_id: str, requeue: bool = False) -> bool:
+        """Give up this node's lease, putting the job back at the front of its queue if asked"""
+        return bool(self._eval(RELEASE, self.owner, job_id, "1" if requeue else "0"))
+
+    def finish(self, job_id: str):
+        """Drop the lease of a job that reached a terminal status, whoever holds it"""
+        self._eval(RELEASE, "", job_id, "0")
+
+    def reap(self, limit: int = 100) -> tuple:
+        """Requeue jobs whose leases expired; returns (requeued, abandoned) job ids"""
+        requeued, abandoned = self._eval(REAP, settings.job_lease_max_expirations, limit)
+        return [job_id.decode() for job_id in requeued], [job_id.decode() for job_id in abandoned]
+
+    def status(self) -> dict:
+        client = self._connection.client
+        tenants = [tenant.decode() for tenant in client.zrange(f"{self.prefix}:tenants", 0, -1)]
+        pipe = client.pipeline()
+        for tenant in tenants:
+            pipe.llen(f"{self.prefix}:queue:{tenant}")
+        pipe.hgetall(f"{self.prefix}:running")
+        pipe.hgetall(f"{self.prefix}:lease-owners")
+        *queued, running, owners = pipe.execute()
+        nodes: Dict[str, int] = {}
+        for owner in owners.values():
+            nodes[owner.decode()] = nodes.get(owner.decode(), 0) + 1
+        return {
+            "queued": dict(zip(tenants, queued)),
+            "running": {tenant.decode(): int(count) for tenant, count in running.items()},
+            "leases_by_node": nodes,
+        }
+
+
+class JobLeaser:
+    """Node side: leases jobs while this process has room and keeps their leases alive.
+
+    ``start(job_id)`` hands a leased job to the local scheduler,
+    ``stop(job_id)`` interrupts one whose lease was lost (expired and
+    requeued, or released because the job finished or was cancelled
+    elsewhere) and ``abandon(job_id)`` fails one that kept losing its lease.
+    """
+
+    def __init__(self, queue: SharedJobQueue, has_room: Callable[[], bool], start: Callable[[str], None],
+                 stop: Callable[[str], None], abandon: Callable[[str], None]):
+        self.queue = queue
+        self.has_room = has_room
+        self.start_job = start
+        self.stop_job = stop
+        self.abandon_job = abandon
+        self._held: Set[str] = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def held(self) -> List[str]:
+        with self._lock:
+            return list(self._held)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def done(self, job_id: str):
+        """The local run of a leased job ended; free its lease and look for more work"""
+        with self._lock:
+            if job_id not in self._held:
+                return
+            self._held.discard(job_id)
+        try:
+            self.queue.release(job_id)
+        except redis.RedisError as e:
+            logger.warning(f"Could not release the lease of job {job_id}, it will expire: {e}")
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="job-leaser", daemon=True)
+        self._thread.start()
+        logger.info(f"Leasing jobs from the shared queue as {self.queue.owner}")
+
+    def stop(self):
+        """Stop leasing and hand the jobs still held back to the queue for other nodes"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+        for job_id in self.held():
+            try:
+                self.queue.release(job_id, requeue=True)
+            except redis.RedisError as e:
+                logger.warning(f"Could not requeue job {job_id}, its lease will expire: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._renew()
+                self._expire()
+                self._claim()
+            except redis.RedisError as e:
+                logger.warning(f"Shared job queue unavailable: {e}")
+            self._wakeup.wait(settings.job_lease_poll_interval)
+            self._wakeup.clear()
+
+    def _renew(self):
+        for job_id in self.queue.heartbeat(self.held()):
+            with self._lock:
+                self._held.discard(job_id)
+            logger.info(f"Lost the lease of job {job_id}, stopping it here")
+            self.stop_job(job_id)
+
+    def _expire(self):
+        requeued, abandoned = self.queue.reap()
+        for job_id in requeued:
+            logger.warning(f"Lease of job {job_id} expired, requeued")
+        for job_id in abandoned:
+            logger.error(f"Lease of job {job_id} expired too often, failing it")
+            self.abandon_job(job_id)
+
+    def _claim(self):
+        while not self._stop.is_set():
+            if settings.job_lease_max_jobs and len(self.held()) >= settings.job_lease_max_jobs:
+                return
+            if not self.has_room():
+                return
+            job_id = self.queue.claim()
+            if job_id is None:
+                return
+            with self._lock:
+                self._held.add(job_id)
+            try:
+                self.start_job(job_id)
+            except Exception as e:
+                logger.error(f"Failed to start leased job {job_id}: {e}")
+                self.done(job_id)
+
+
+job_queue = SharedJobQueue()
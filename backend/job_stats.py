@@ -0,0 +1,153 @@
+"""Per-job timing, CPU and transfer accounting recorded on the job record"""
+import copy
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+_local = threading.local()
+
+
+def empty_stats() -> dict:
+    return {
+        "wall_seconds": 0.0,  # time spent working on the job, queue wait excluded
+        "cpu_seconds": {"job": 0.0, "children": 0.0},  # job threads / waited-for ffmpeg processes
+        "stages": {},  # stage -> {"seconds", "count", "bytes"}
+        "items": {},  # media index -> {"<stage>_seconds", "<stage>_bytes"}
+    }
+
+
+class JobStats:
+    """Accumulates one job's breakdown; safe to update from several threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = empty_stats()
+
+    def add_stage(self, stage: str, seconds: float = 0.0, nbytes: int = 0, item: Optional[int] = None, count: int = 1):
+        with self._lock:
+            entry = self._data["stages"].setdefault(stage, {"seconds": 0.0, "count": 0, "bytes": 0})
+            entry["seconds"] += seconds
+            entry["count"] += count
+            entry["bytes"] += nbytes
+            if item is not None:
+                item_entry = self._data["items"].setdefault(str(item), {})
+                if seconds or count:
+                    item_entry[f"{stage}_seconds"] = item_entry.get(f"{stage}_seconds", 0.0) + seconds
+                if nbytes:
+                    item_entry[f"{stage}_bytes"] = item_entry.get(f"{stage}_bytes", 0) + nbytes
+
+    def add_cpu(self, kind: str, seconds: float):
+        with self._lock:
+            self._data["cpu_seconds"][kind] = self._data["cpu_seconds"].get(kind, 0.0) + seconds
+
+    def add_wall(self, seconds: float):
+        with self._lock:
+            self._data["wall_seconds"] += seconds
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return _rounded(copy.deepcopy(self._data))
+
+
+def current_stats() -> Optional[JobStats]:
+    return getattr(_local, "stats", None)
+
+
+@contextmanager
+def bind_stats(stats: Optional[JobStats]):
+    """Attach ``stats`` to the current thread and add the block's wall and CPU time to it.
+
+    ffmpeg processes started inside the block report their CPU time when
+    they are waited for (see cancellation._TrackedPopen).
+    """
+    if stats is None:
+        yield
+        return
+    from cancellation import install_process_tracking  # cancellation imports this module
+    install_process_tracking()
+    previous = current_stats()
+    _local.stats = stats
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield stats
+    finally:
+        stats.add_wall(time.perf_counter() - wall)
+        stats.add_cpu("job", time.thread_time() - cpu)
+        _local.stats = previous
+
+
+@contextmanager
+def timed(stage: str, item: Optional[int] = None):
+    """Record the block as ``stage`` on the current job only (no Prometheus metric)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            stats.add_stage(stage, time.perf_counter() - started, item=item)
+
+
+def record_bytes(stage: str, nbytes: int, item: Optional[int] = None):
+    stats = current_stats()
+    if stats is not None and nbytes:
+        stats.add_stage(stage, nbytes=nbytes, item=item, count=0)
+
+
+def merge_stats(into: Optional[dict], other: dict) -> dict:
+    """Add ``other`` to ``into`` (e.g. the parts reported by separate Celery tasks)"""
+    merged = copy.deepcopy(into) if into else empty_stats()
+    return _rounded(_accumulate(merged, other))
+
+
+def aggregate(all_stats: Iterable[dict]) -> dict:
+    """Totals, per-stage means and wall time percentiles over many jobs' stats"""
+    all_stats = [stats for stats in all_stats if stats]
+    total = empty_stats()
+    for stats in all_stats:
+        _accumulate(total, stats)
+    total = _rounded(total)
+    walls = sorted(stats.get("wall_seconds", 0.0) for stats in all_stats)
+    count = len(all_stats)
+
+    def percentile(q: float) -> Optional[float]:
+        return round(walls[min(int(q * count), count - 1)], 3) if walls else None
+
+    return {
+        "jobs": count,
+        "wall_seconds": {"total": total["wall_seconds"], "p50": percentile(0.5), "p95": percentile(0.95)},
+        "cpu_seconds": total["cpu_seconds"],
+        "stages": {
+            stage: dict(entry, mean_seconds=round(entry["seconds"] / max(entry["count"], 1), 3))
+            for stage, entry in total["stages"].items()
+        },
+    }
+
+
+def _accumulate(total: dict, other: dict) -> dict:
+    """Add ``other`` into ``total`` in place"""
+    total["wall_seconds"] += other.get("wall_seconds", 0.0)
+    for kind, seconds in other.get("cpu_seconds", {}).items():
+        total["cpu_seconds"][kind] = total["cpu_seconds"].get(kind, 0.0) + seconds
+    for stage, entry in other.get("stages", {}).items():
+        target = total["stages"].setdefault(stage, {"seconds": 0.0, "count": 0, "bytes": 0})
+        for key, value in entry.items():
+            target[key] = target.get(key, 0) + value
+    for item, entry in other.get("items", {}).items():
+        target = total["items"].setdefault(item, {})
+        for key, value in entry.items():
+            target[key] = target.get(key, 0) + value
+    return total
+
+
+def _rounded(data: dict) -> dict:
+    data["wall_seconds"] = round(data["wall_seconds"], 3)
+    data["cpu_seconds"] = {kind: round(value, 3) for kind, value in data["cpu_seconds"].items()}
+    for entry in data["stages"].values():
+        entry["seconds"] = round(entry["seconds"], 3)
+    for entry in data["items"].values():
+        for key, value in entry.items():
+            if isinstance(value, float):
+                entry[key] = round(value, 3)
+    return data
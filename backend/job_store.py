@@ -0,0 +1,483 @@
+"""Job and batch records, in this process or in Redis shared by every API replica.
+
+With ``job_store_backend = "memory"`` (the default) jobs are ``JobRecord``
+objects: the fields every job has live in slots instead of a per-job dict,
+and the heavy media spec (``SPEC_FIELDS``) is kept as compact JSON and only
+decoded when a job starts or the spec is asked for. Batches are plain dicts.
+
+With ``"redis"`` every record is a Redis hash with one JSON-encoded field
+per key, so any replica behind the load balancer can answer for any job; a
+job's spec is a second hash, fetched on first access. Records read from the
+store are ``SharedRecord`` dicts: assigning, updating or popping a key
+writes just that field through to Redis, so the existing
+``job["progress"] = ...`` style code keeps working and concurrent writers of
+different fields do not overwrite each other. Mutating a nested value in
+place (``job["profiles"].append``) is not seen by Redis; assign the key
+again instead.
+
+Both job stores keep records ordered by creation for ``page()``.
+"""
+import bisect
+import json
+import os
+import threading
+from collections.abc import MutableMapping
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import redis
+
+from config import settings
+
+_record_lock = threading.Lock()
+
+# Needed to run a job, not to report on it
+SPEC_FIELDS = ("media_items", "output_settings")
+
+# Fields of a job kept in JobRecord slots; any other key goes to its overflow dict
+JOB_FIELDS = (
+    "job_id", "batch_id", "row_number", "status", "progress", "message", "created_at", "completed_at",
+    "tenant", "mode", "output_url", "output_file", "error", "gdrive_url", "gdrive_status", "gdrive_error",
+    "stats", "profiles", "celery_task_ids", "last_downloaded_at", "output_evicted_at", "sequence",
+)
+_JOB_SLOTS = frozenset(JOB_FIELDS)
+
+Match = Callable[[MutableMapping], bool]
+
+SET_IF_ABSENT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current and current ~= 'null' then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# ARGV: JSON list of encoded statuses that refuse the update, then field/value pairs
+UPDATE_STATUS = """
+local current = redis.call('HGET', KEYS[1], 'status') or ''
+for _, refused in ipairs(cjson.decode(ARGV[1])) do
+    if current == refused then
+        return {0, current, 0}
+    end
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+return {1, current, redis.call('HINCRBY', KEYS[1], 'sequence', 1)}
+"""
+
+
+def order_key(record_id: str, record) -> str:
+    """Sort key of a record in creation order (also the opaque position a page() cursor encodes)"""
+    return f"{record.get('created_at') or ''}|{record_id}"
+
+
+def public_fields(record, include_spec: bool = False) -> dict:
+    """A record as a plain dict for responses, without the media spec unless asked for"""
+    data = {field: record[field] for field in record if field not in SPEC_FIELDS}
+    if include_spec:
+        for field in SPEC_FIELDS:
+            if field in record:
+                data[field] = record[field]
+    return data
+
+
+class JobRecord(MutableMapping):
+    """One job in memory, read and written like the dict it replaces"""
+
+    __slots__ = JOB_FIELDS + ("_spec", "_extra")
+
+    def __init__(self, data: dict):
+        self._spec = {}  # field -> JSON bytes
+        self._extra = None
+        for field, value in data.items():
+            self[field] = value
+
+    def __getitem__(self, field):
+        if field in _JOB_SLOTS:
+            try:
+                return getattr(self, field)
+            except AttributeError:
+                raise KeyError(field) from None
+        if field in self._spec:
+            return json.loads(self._spec[field])
+        if self._extra and field in self._extra:
+            return self._extra[field]
+        raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        if field in _JOB_SLOTS:
+            setattr(self, field, value)
+        elif field in SPEC_FIELDS:
+            self._spec[field] = json.dumps(value, separators=(",", ":")).encode()
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[field] = value
+
+    def __delitem__(self, field):
+        if field in _JOB_SLOTS:
+            try:
+                delattr(self, field)
+            except AttributeError:
+                raise KeyError(field) from None
+        elif field in self._spec:
+            del self._spec[field]
+        elif self._extra and field in self._extra:
+            del self._extra[field]
+        else:
+            raise KeyError(field)
+
+    def __contains__(self, field) -> bool:
+        if field in _JOB_SLOTS:
+            return hasattr(self, field)
+        return field in self._spec or bool(self._extra and field in self._extra)
+
+    def __iter__(self) -> Iterator[str]:
+        for field in JOB_FIELDS:
+            if hasattr(self, field):
+                yield field
+        yield from list(self._extra or ())
+        yield from list(self._spec)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"JobRecord({public_fields(self)!r})"
+
+
+class LocalJobs(dict):
+    """job_id -> JobRecord in this process; plain dicts stored here are converted"""
+
+    def __init__(self):
+        super().__init__()
+        self._order: List[str] = []
+        self._order_lock = threading.Lock()
+
+    def __setitem__(self, job_id: str, record: dict):
+        if not isinstance(record, JobRecord):
+            record = JobRecord(record)
+        with self._order_lock:
+            previous = super().get(job_id)
+            if previous is not None:
+                self._unindex(job_id, previous)
+            super().__setitem__(job_id, record)
+            bisect.insort(self._order, order_key(job_id, record))
+
+    def __delitem__(self, job_id: str):
+        with self._order_lock:
+            record = super().pop(job_id)
+            self._unindex(job_id, record)
+
+    def pop(self, job_id: str, *default):
+        with self._order_lock:
+            if job_id not in self:
+                if default:
+                    return default[0]
+                raise KeyError(job_id)
+            record = super().pop(job_id)
+            self._unindex(job_id, record)
+            return record
+
+    def _unindex(self, job_id: str, record: JobRecord):
+        key = order_key(job_id, record)
+        index = bisect.bisect_left(self._order, key)
+        if index < len(self._order) and self._order[index] == key:
+            del self._order[index]
+
+    def page(self, after: Optional[str], limit: int, match: Optional[Match] = None,
+             reverse: bool = False) -> Tuple[List[JobRecord], Optional[str]]:
+        """Up to ``limit`` matching records created after the ``after`` key (before it, newest first,
+        with ``reverse``), and the key to continue from"""
+        with self._order_lock:
+            if reverse:
+                keys = self._order[:bisect.bisect_left(self._order, after) if after else len(self._order)][::-1]
+            else:
+                keys = self._order[bisect.bisect_right(self._order, after):] if after else list(self._order)
+        records = []
+        for index, key in enumerate(keys):
+            record = super().get(key.rsplit("|", 1)[1])
+            if record is None or (match and not match(record)):
+                continue
+            records.append(record)
+            if len(records) == limit:
+                return records, key if index + 1 < len(keys) else None
+        return records, None
+
+
+class RedisConnection:
+    """One client per process (uvicorn workers and prefork children re-create it)"""
+
+    def __init__(self, url: Optional[str] = None):
+        self.url = url or settings.job_store_redis_url or settings.celery_broker_url
+        self._client: Optional[redis.Redis] = None
+        self._pid: Optional[int] = None
+
+    @property
+    def client(self) -> redis.Redis:
+        if self._client is None or self._pid != os.getpid():
+            self._client = redis.Redis.from_url(self.url)
+            self._pid = os.getpid()
+        return self._client
+
+
+class SharedRecord(dict):
+    """A snapshot of one stored record whose top-level writes go through to its Redis hash"""
+
+    def __init__(self, connection: RedisConnection, key: str, data: dict, spec_key: Optional[str] = None):
+        super().__init__(data)
+        self._connection = connection
+        self._key = key
+        self._spec_key = spec_key
+        self._spec_loaded = spec_key is None
+
+    def _load_spec(self):
+        if not self._spec_loaded:
+            raw = self._connection.client.hgetall(self._spec_key)
+            super().update({field.decode(): json.loads(value) for field, value in raw.items()})
+            self._spec_loaded = True
+
+    def _key_for(self, field) -> str:
+        return self._spec_key if self._spec_key and field in SPEC_FIELDS else self._key
+
+    def __getitem__(self, field):
+        if field in SPEC_FIELDS:
+            self._load_spec()
+        return super().__getitem__(field)
+
+    def get(self, field, default=None):
+        if field in SPEC_FIELDS:
+            self._load_spec()
+        return super().get(field, default)
+
+    def __contains__(self, field) -> bool:
+        if field in SPEC_FIELDS:
+            self._load_spec()
+        return super().__contains__(field)
+
+    def __setitem__(self, field, value):
+        super().__setitem__(field, value)
+        self._connection.client.hset(self._key_for(field), field, json.dumps(value))
+
+    def update(self, *args, **kwargs):
+        fields = dict(*args, **kwargs)
+        super().update(fields)
+        by_key = {}
+        for field, value in fields.items():
+            by_key.setdefault(self._key_for(field), {})[field] = json.dumps(value)
+        for key, mapping in by_key.items():
+            self._connection.client.hset(key, mapping=mapping)
+
+    def setdefault(self, field, default=None):
+        if field not in self:
+            self[field] = default
+        return self[field]
+
+    def pop(self, field, *default):
+        value = super().pop(field, *default)
+        self._connection.client.hdel(self._key_for(field), field)
+        return value
+
+    def __delitem__(self, field):
+        super().__delitem__(field)
+        self._connection.client.hdel(self._key_for(field), field)
+
+    def update_status(self, status: str, fields: dict, refuse_from) -> Tuple[bool, Optional[str], int]:
+        fields = dict(fields, status=status)
+        args = [json.dumps([json.dumps(refused) for refused in refuse_from])]
+        for field, value in fields.items():
+            args += [field, json.dumps(value)]
+        applied, current, sequence = self._connection.client.eval(UPDATE_STATUS, 1, self._key, *args)
+        previous = json.loads(current) if current else None
+        if applied:
+            super().update(fields, sequence=sequence)
+        return bool(applied), previous, sequence
+
+    def next_sequence(self) -> int:
+        sequence = self._connection.client.hincrby(self._key, "sequence", 1)
+        super().__setitem__("sequence", sequence)
+        return sequence
+
+    def set_if_absent(self, field, value) -> bool:
+        """Set ``field`` only if it is missing or null in Redis; True if this call set it"""
+        if not self._connection.client.eval(SET_IF_ABSENT, 1, self._key, field, json.dumps(value)):
+            return False
+        super().__setitem__(field, value)
+        return True
+
+
+class RedisRecords(MutableMapping):
+    """Mapping of id -> SharedRecord over ``<prefix>:<kind>:<id>`` hashes.
+
+    ``<prefix>:<kind>s`` indexes them in creation order (a sorted set of
+    ``order_key`` members, all scored 0, so it is ranged by key). With
+    ``split_spec`` the SPEC_FIELDS of each record go to a separate
+    ``<prefix>:<kind>-spec:<id>`` hash that is only read when needed.
+    """
+
+    def __init__(self, connection: RedisConnection, kind: str, prefix: Optional[str] = None, split_spec: bool = False):
+        self._connection = connection
+        self._prefix = f"{prefix or settings.job_store_prefix}:{kind}"
+        self._index = f"{self._prefix}s"
+        self._split_spec = split_spec
+
+    def key(self, record_id: str) -> str:
+        return f"{self._prefix}:{record_id}"
+
+    def save_artifact(self, record_id: str, name: str, data: bytes, ttl: int):
+        """Keep a small file of a record (e.g. a profile) where every replica can read it, for ``ttl`` seconds"""
+        self._connection.client.set(f"{self._prefix}-artifact:{record_id}:{name}", data, ex=ttl)
+
+    def load_artifact(self, record_id: str, name: str) -> Optional[bytes]:
+        return self._connection.client.get(f"{self._prefix}-artifact:{record_id}:{name}")
+
+    def spec_key(self, record_id: str) -> Optional[str]:
+        return f"{self._prefix}-spec:{record_id}" if self._split_spec else None
+
+    def _record(self, record_id: str, raw: dict) -> SharedRecord:
+        data = {field.decode(): json.loads(value) for field, value in raw.items()}
+        return SharedRecord(self._connection, self.key(record_id), data, self.spec_key(record_id))
+
+    def __getitem__(self, record_id: str) -> SharedRecord:
+        raw = self._connection.client.hgetall(self.key(record_id)) if record_id else None
+        if not raw:
+            raise KeyError(record_id)
+        return self._record(record_id, raw)
+
+    def __setitem__(self, record_id: str, record: dict):
+        key, spec_key = self.key(record_id), self.spec_key(record_id)
+        fields = {field: json.dumps(value) for field, value in record.items()}
+        spec = {field: fields.pop(field) for field in SPEC_FIELDS if spec_key and field in fields}
+        previous = self._connection.client.hget(key, "created_at")
+        pipe = self._connection.client.pipeline()
+        if previous is not None:
+            pipe.zrem(self._index, order_key(record_id, {"created_at": json.loads(previous)}))
+        pipe.delete(key, *[spec_key] if spec_key else [])
+        pipe.hset(key, mapping=fields)
+        if spec:
+            pipe.hset(spec_key, mapping=spec)
+        pipe.zadd(self._index, {order_key(record_id, record): 0})
+        pipe.execute()
+
+    def __delitem__(self, record_id: str):
+        self.pop(record_id)
+
+    def __contains__(self, record_id) -> bool:
+        return bool(record_id) and bool(self._connection.client.exists(self.key(record_id)))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([member.decode().rsplit("|", 1)[1] for member in self._connection.client.zrange(self._index, 0, -1)])
+
+    def __len__(self) -> int:
+        return self._connection.client.zcard(self._index)
+
+    def pop(self, record_id: str, *default):
+        """Remove a record; another replica removing it first counts as missing"""
+        raw = self._connection.client.hgetall(self.key(record_id)) if record_id else None
+        if not raw:
+            if default:
+                return default[0]
+            raise KeyError(record_id)
+        record = self._record(record_id, raw)
+        pipe = self._connection.client.pipeline()
+        pipe.delete(self.key(record_id), *[self.spec_key(record_id)] if self._split_spec else [])
+        pipe.zrem(self._index, order_key(record_id, record))
+        pipe.execute()
+        return record
+
+    def setdefault(self, record_id: str, default: Optional[dict] = None) -> SharedRecord:
+        if record_id not in self:
+            self[record_id] = default or {}
+        return self[record_id]
+
+    def _fetch(self, record_ids: List[str]) -> List[Tuple[str, SharedRecord]]:
+        pipe = self._connection.client.pipeline()
+        for record_id in record_ids:
+            pipe.hgetall(self.key(record_id))
+        # Records deleted since the index was read come back empty
+        return [(record_id, self._record(record_id, raw)) for record_id, raw in zip(record_ids, pipe.execute()) if raw]
+
+    def items(self) -> List[Tuple[str, SharedRecord]]:
+        """Every record, fetched in pipelined chunks rather than one round trip each"""
+        ids = list(self)
+        records = []
+        for start in range(0, len(ids), 500):
+            records.extend(self._fetch(ids[start:start + 500]))
+        return records
+
+    def values(self) -> List[SharedRecord]:
+        return [record for _, record in self.items()]
+
+    def page(self, after: Optional[str], limit: int, match: Optional[Match] = None,
+             reverse: bool = False) -> Tuple[List[SharedRecord], Optional[str]]:
+        """Up to ``limit`` matching records created after the ``after`` key (before it, newest first,
+        with ``reverse``), and the key to continue from"""
+        client = self._connection.client
+
+        def keys_from(bound: Optional[str], count: int) -> List[str]:
+            if reverse:
+                members = client.zrevrangebylex(self._index, f"({bound}" if bound else "+", "-", start=0, num=count)
+            else:
+                members = client.zrangebylex(self._index, f"({bound}" if bound else "-", "+", start=0, num=count)
+            return [member.decode() for member in members]
+
+        records = []
+        while True:
+            keys = keys_from(after, max(limit, 100))
+            if not keys:
+                return records, None
+            fetched = dict(self._fetch([key.rsplit("|", 1)[1] for key in keys]))
+            for index, key in enumerate(keys):
+                record = fetched.get(key.rsplit("|", 1)[1])
+                if record is None or (match and not match(record)):
+                    continue
+                records.append(record)
+                if len(records) == limit:
+                    more = index + 1 < len(keys) or bool(keys_from(key, 1))
+                    return records, key if more else None
+            after = keys[-1]
+
+
+def set_if_absent(record: dict, field: str, value) -> bool:
+    """Atomically claim ``field`` of a record (e.g. a batch's completed_at) across threads and replicas"""
+    if isinstance(record, SharedRecord):
+        return record.set_if_absent(field, value)
+    with _record_lock:
+        if record.get(field) is not None:
+            return False
+        record[field] = value
+        return True
+
+
+def update_status(record: dict, status: str, fields: dict, refuse_from) -> Tuple[bool, Optional[str], int]:
+    """Set a job's status and fields unless its current status is in ``refuse_from``, atomically across
+    threads and replicas; returns (applied, previous status, the record's new ``sequence`` or 0)"""
+    if isinstance(record, SharedRecord):
+        return record.update_status(status, fields, refuse_from)
+    with _record_lock:
+        previous = record.get("status")
+        if previous in refuse_from:
+            return False, previous, 0
+        sequence = record.get("sequence", 0) + 1
+        record.update(fields, status=status, sequence=sequence)
+        return True, previous, sequence
+
+
+def next_sequence(record: dict) -> int:
+    """Advance a record's ``sequence``, which orders its webhook events, atomically across replicas"""
+    if isinstance(record, SharedRecord):
+        return record.next_sequence()
+    with _record_lock:
+        record["sequence"] = record.get("sequence", 0) + 1
+        return record["sequence"]
+
+
+def shared() -> bool:
+    return settings.job_store_backend == "redis"
+
+
+def open_stores() -> Tuple[MutableMapping, MutableMapping]:
+    """(jobs, batches) for the configured backend"""
+    if not shared():
+        return LocalJobs(), {}
+    connection = RedisConnection()
+    return RedisRecords(connection, "job", split_spec=True), RedisRecords(connection, "batch")
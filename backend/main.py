@@ -1,58 +1,35 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Response
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from typing import Dict, List
+from fastapi.responses import FileResponse, RedirectResponse
+from typing import Dict, List, Optional
 import uuid
+import asyncio
+import base64
+import binascii
 from datetime import datetime
 import os
 import logging
 from pathlib import Path
-import time
-
-# Configure MoviePy before importing
-try:
-    import moviepy_config
-except:
-    pass
-
-# Apply Pillow compatibility patch
-try:
-    import pillow_compat
-except:
-    pass
-
-# Debug Python environment
-import sys
-print(f"Python executable: {sys.executable}")
-print(f"Python path: {sys.path[:3]}...")
-
-# Conditional import of video processor
-try:
-    print("Attempting to import video_processor...")
-    from video_processor import VideoProcessor
-    print("VideoProcessor imported successfully!")
-    
-    print("Creating VideoProcessor instance...")
-    video_processor = VideoProcessor()
-    print("VideoProcessor instance created successfully!")
-    
-    MOVIEPY_AVAILABLE = True
-    print("✅ MoviePy imported successfully!")
-except ImportError as e:
-    print(f"❌ MoviePy ImportError: {e}")
-    import traceback
-    traceback.print_exc()
-    video_processor = None
-    MOVIEPY_AVAILABLE = False
-except Exception as e:
-    print(f"❌ Unexpected error importing MoviePy: {e}")
-    print(f"Error type: {type(e)}")
-    import traceback
-    traceback.print_exc()
-    video_processor = None
-    MOVIEPY_AVAILABLE = False
-
-print(f"MOVIEPY_AVAILABLE: {MOVIEPY_AVAILABLE}")
+import threading
+
+from engine import engine
+from webhooks import webhook_dispatcher
+from retention import RetentionManager
+from cancellation import CancelToken, JobCancelled
+from checkpoint import JobCheckpoint, has_checkpoint, list_checkpoints
+from progress import ProgressConsumer
+from drive_uploads import drive_uploads
+from scheduler import job_scheduler
+from admission import memory_admission
+from metrics import JOB_OUTCOMES, metrics_payload, watch_event_loop
+from job_stats import JobStats, aggregate, bind_stats, merge_stats
+from profiler import ProfileRequests, bind_job, start_profile, watch_requests
+from job_store import next_sequence, open_stores, public_fields, set_if_absent, shared, update_status
+from fast_json import FastJSONResponse
+from job_queue import JobLeaser, job_queue
+from auth import get_current_user
+from models import User
+from config import settings
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -68,19 +45,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Simple in-memory storage
-jobs_db: Dict[str, dict] = {}
+# Job and batch records: in this process, or in Redis shared by every replica (see job_store)
+jobs_db, batches_db = open_stores()
+cancel_tokens: Dict[str, CancelToken] = {}
+
+TERMINAL_STATUSES = {"completed", "failed", "cancelled"}
+CALLBACK_MODES = {"all", "batch"}
+PROFILE_STATES = ["requested", "running", "expired", "failed", "completed"]
 
 # Storage paths
 STORAGE_PATH = os.getenv("STORAGE_PATH", "/tmp/video-processor")
 Path(STORAGE_PATH).mkdir(parents=True, exist_ok=True)
 
+_storage_manager = None
+
+def get_storage():
+    """StorageManager for outputs written by Celery workers, created on first use"""
+    global _storage_manager
+    if _storage_manager is None:
+        from storage import StorageManager
+        _storage_manager = StorageManager()
+    return _storage_manager
+
 @app.get("/")
 async def root():
     return {
         "message": "Video Processor API is running!",
         "status": "ok",
-        "moviepy_available": MOVIEPY_AVAILABLE
+        "moviepy_available": engine.state == "ready"
     }
 
 @app.head("/")
@@ -88,12 +80,68 @@ async def head_root():
     """HEAD request support for health checks"""
     return Response(status_code=200)
 
+def check_shared_storage():
+    """Refuse to share jobs between nodes that cannot read each other's outputs"""
+    if not shared() or settings.storage_shared or settings.job_executor == "mock":
+        return  # mock jobs write no outputs
+    if settings.job_executor == "celery" and settings.storage_backend in ("s3", "minio"):
+        return
+    raise RuntimeError(
+        "JOB_STORE_BACKEND=redis lets any replica serve any job, but outputs are written to the "
+        "rendering node's STORAGE_PATH: mount it on every node and set STORAGE_SHARED=true, "
+        "or run JOB_EXECUTOR=celery with STORAGE_BACKEND=s3/minio"
+    )
+
+@app.on_event("startup")
+def start_background_services():
+    check_shared_storage()
+    retention_manager.start()
+    if settings.job_executor == "celery":
+        progress_consumer.start()
+    if job_queue.enabled:
+        # Jobs are leased from the shared queue; leases of a dead node expire and requeue its jobs
+        if settings.render_jobs:
+            if settings.job_executor == "background":
+                engine.start()
+            job_leaser.start()
+            watch_requests(profile_requests, save_profile)
+        return
+    if settings.job_executor == "background":
+        # Serve right away; recovered jobs render here, so they wait for the engine.
+        # Celery jobs are not recovered: the broker still holds them and resubmitting would run them twice.
+        engine.start(on_ready=recover_interrupted_jobs if settings.checkpoint_enabled else None)
+
+@app.on_event("startup")
+async def start_event_loop_watch():
+    if settings.event_loop_lag_interval > 0:
+        app.state.event_loop_watch = asyncio.create_task(watch_event_loop(settings.event_loop_lag_interval))
+
+@app.on_event("shutdown")
+def stop_background_services():
+    if getattr(app.state, "event_loop_watch", None):
+        app.state.event_loop_watch.cancel()
+    retention_manager.stop()
+    progress_consumer.stop()
+    if job_queue.enabled:
+        job_leaser.stop()
+    job_scheduler.stop()
+    memory_admission.stop()
+    drive_uploads.stop()
+    webhook_dispatcher.stop()
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics of the API process"""
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/api/v1/health")
 async def health():
     return {
         "status": "healthy",
         "timestamp": datetime.utcnow().isoformat(),
-        "moviepy_available": MOVIEPY_AVAILABLE
+        "moviepy_available": engine.state == "ready",
+        "engine": engine.status()
     }
 
 @app.post("/api/v1/test/simple")
@@ -119,7 +167,7 @@ async def test_simple_process(background_tasks: BackgroundTasks):
         }
     }
     
-    return await create_batch_jobs(background_tasks, test_data)
+    return create_batch_jobs(background_tasks, test_data, current_user=None)
 
 @app.post("/api/v1/test/multiple")
 async def test_multiple_sources(background_tasks: BackgroundTasks):
@@ -150,7 +198,7 @@ async def test_multiple_sources(background_tasks: BackgroundTasks):
         }
     }
     
-    return await create_batch_jobs(background_tasks, test_data)
+    return create_batch_jobs(background_tasks, test_data, current_user=None)
 
 @app.post("/api/v1/test/generate")
 async def test_generate_video(background_tasks: BackgroundTasks):
@@ -181,7 +229,7 @@ async def test_generate_video(background_tasks: BackgroundTasks):
         }
     }
     
-    return await create_batch_jobs(background_tasks, test_data)
+    return create_batch_jobs(background_tasks, test_data, current_user=None)
 
 @app.post("/api/v1/test/gdrive")
 async def test_google_drive(background_tasks: BackgroundTasks):
@@ -206,7 +254,7 @@ async def test_google_drive(background_tasks: BackgroundTasks):
         }
     }
     
-    return await create_batch_jobs(background_tasks, test_data)
+    return create_batch_jobs(background_tasks, test_data, current_user=None)
 
 @app.post("/api/v1/test/gdrive-check")
 async def check_google_drive_url(data: dict):
@@ -237,40 +285,194 @@ async def check_google_drive_url(data: dict):
     except Exception as e:
         return {"error": str(e)}
 
+def job_summary(job: dict) -> dict:
+    """Public fields of a job, without the heavy media spec"""
+    return {
+        "job_id": job["job_id"],
+        "batch_id": job.get("batch_id"),
+        "row_number": job.get("row_number"),
+        "status": job.get("status"),
+        "progress": job.get("progress", 0),
+        "message": job.get("message"),
+        "output_url": job.get("output_url"),
+        "gdrive_url": job.get("gdrive_url"),
+        "gdrive_status": job.get("gdrive_status"),
+        "error": job.get("error"),
+        "completed_at": job.get("completed_at"),
+    }
+
+def batch_summary(batch: dict) -> dict:
+    jobs = [job_summary(job) for job in map(jobs_db.get, batch["job_ids"]) if job is not None]
+    counts: Dict[str, int] = {}
+    for job in jobs:
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+    return {
+        "batch_id": batch["batch_id"],
+        "created_at": batch["created_at"],
+        "completed_at": batch.get("completed_at"),
+        "status_counts": counts,
+        "jobs": jobs,
+    }
+
+def set_job_status(job_id: str, status: str, **fields) -> bool:
+    """Update a job's status and fields, notifying its batch callback on change; False if refused"""
+    job = jobs_db.get(job_id)
+    if job is None:
+        return False
+    # A finished job keeps its outcome: late updates from a worker that is still unwinding, a duplicate
+    # worker or a stale update applied by another replica never change it, not even to another final status
+    applied, previous, sequence = update_status(job, status, fields, TERMINAL_STATUSES)
+    if not applied:
+        return False
+    if status in TERMINAL_STATUSES:
+        job_scheduler.release(job_id)
+        finish_checkpoint(job_id, status)
+        if job_queue.enabled:
+            job_queue.finish(job_id)
+            job_leaser.done(job_id)
+        profiles = job.get("profiles", [])
+        for profile in profiles:
+            if profile["status"] == "requested":
+                profile["status"] = "expired"  # the job ended before a worker picked it up
+        if profiles:
+            job["profiles"] = profiles
+    if status != previous:
+        if status in TERMINAL_STATUSES:
+            JOB_OUTCOMES.labels(status).inc()
+        notify_status_change(job, sequence)
+    return True
+
+def apply_progress_update(update: dict):
+    """Apply a status update published by a Celery worker"""
+    if "stats" in update:
+        job = jobs_db.get(update["job_id"])
+        if job is not None:
+            job["stats"] = merge_stats(job.get("stats"), update["stats"])
+        return
+    if "profile" in update:
+        record_profile(update["job_id"], update["profile"])
+        return
+    fields = {
+        "progress": update["progress"],
+        "message": update["message"],
+    }
+    if update.get("output_url"):
+        fields["output_url"] = update["output_url"]
+    if update.get("error"):
+        fields["error"] = update["error"]
+    if update["status"] in TERMINAL_STATUSES:
+        fields["completed_at"] = datetime.utcnow().isoformat()
+    set_job_status(update["job_id"], update["status"], **fields)
+
+# Worker progress arrives over Redis when jobs run on Celery; replicas sharing jobs split the stream
+progress_consumer = ProgressConsumer(apply_progress_update, group="api" if shared() else None)
+profile_requests = ProfileRequests()
+
+def notify_status_change(job: dict, sequence: int):
+    """Queue webhook deliveries for a job state change and batch completion.
+
+    ``sequence`` increases with every change of the job; deliveries are
+    retried independently, so receivers drop events older than the last
+    one they applied for the job.
+    """
+    batch = batches_db.get(job.get("batch_id"))
+    if not batch or not batch.get("callback_url"):
+        return
+
+    if batch["callback_mode"] == "all":
+        webhook_dispatcher.send(batch["callback_url"], "job.status_changed", {
+            "event": "job.status_changed",
+            "batch_id": batch["batch_id"],
+            "sequence": sequence,
+            "job": job_summary(job),
+        })
+
+    if job["status"] in TERMINAL_STATUSES:
+        notify_batch_completed(batch)
+
+def notify_drive_upload(job: dict):
+    """Queue webhook deliveries once a job's background Drive upload has finished or failed"""
+    batch = batches_db.get(job.get("batch_id"))
+    if not batch or not batch.get("callback_url"):
+        return
+
+    if batch["callback_mode"] == "all":
+        webhook_dispatcher.send(batch["callback_url"], "job.drive_upload_finished", {
+            "event": "job.drive_upload_finished",
+            "batch_id": batch["batch_id"],
+            "sequence": next_sequence(job),
+            "job": job_summary(job),
+        })
+    notify_batch_completed(batch)
+
+def notify_batch_completed(batch: dict):
+    """Send batch.completed once every job has finished, Drive uploads included"""
+    if batch.get("completed_at"):
+        return
+    for job_id in batch["job_ids"]:
+        job = jobs_db.get(job_id, {})
+        if job.get("status") not in TERMINAL_STATUSES or job.get("gdrive_status") == "pending":
+            return
+    if not set_if_absent(batch, "completed_at", datetime.utcnow().isoformat()):
+        return  # another thread or replica saw the last job finish too
+
+    webhook_dispatcher.send(batch["callback_url"], "batch.completed", {
+        "event": "batch.completed",
+        **batch_summary(batch),
+    })
+
 def process_video_job_mock(job_id: str, media_items: List[dict], output_settings: dict):
     """Mock video processing for when MoviePy is not available"""
+    cancel_token = cancel_tokens.get(job_id) or CancelToken()
     try:
+        if cancel_token.cancelled:
+            return
+        
         # Update job status
-        jobs_db[job_id]["status"] = "processing"
-        jobs_db[job_id]["progress"] = 50
-        jobs_db[job_id]["message"] = "Processing videos (mock mode)"
+        set_job_status(job_id, "processing", progress=50, message="Processing videos (mock mode)")
         
         # Simulate processing
-        time.sleep(2)
+        if cancel_token.wait(settings.mock_job_seconds):
+            return
         
         # Create a test Google Drive URL (temporary for testing)
         test_drive_url = "https://drive.google.com/file/d/1test_file_id/view?usp=drive_link"
         
         # Update job completion
-        jobs_db[job_id]["status"] = "completed"
-        jobs_db[job_id]["progress"] = 100
-        jobs_db[job_id]["output_url"] = f"/api/v1/jobs/{job_id}/download"
-        jobs_db[job_id]["gdrive_url"] = test_drive_url  # Test Google Drive URL
-        jobs_db[job_id]["message"] = "Processing completed (mock mode - MoviePy not available)"
-        jobs_db[job_id]["completed_at"] = datetime.utcnow().isoformat()
+        set_job_status(
+            job_id, "completed",
+            progress=100,
+            output_url=f"/api/v1/jobs/{job_id}/download",
+            gdrive_url=test_drive_url,  # Test Google Drive URL
+            message="Processing completed (mock mode - MoviePy not available)",
+            completed_at=datetime.utcnow().isoformat()
+        )
         
     except Exception as e:
         logger.error(f"Error processing job {job_id}: {str(e)}")
-        jobs_db[job_id]["status"] = "failed"
-        jobs_db[job_id]["error"] = str(e)
-        jobs_db[job_id]["completed_at"] = datetime.utcnow().isoformat()
+        set_job_status(job_id, "failed", error=str(e), completed_at=datetime.utcnow().isoformat())
+    finally:
+        cancel_tokens.pop(job_id, None)
 
 def process_video_job_real(job_id: str, media_items: List[dict], output_settings: dict):
     """Real video processing with MoviePy"""
+    cancel_token = cancel_tokens.get(job_id) or CancelToken()
+    checkpoint = None
+    stats = JobStats()
     try:
+        if settings.checkpoint_enabled:
+            checkpoint = JobCheckpoint(job_id)
+            if not checkpoint.acquire():
+                logger.warning(f"Job {job_id} is already running in another process")
+                checkpoint = None
+                return
+        
+        # Jobs cancelled while still queued never start
+        if cancel_token.cancelled:
+            return
+        
         # Update job status
-        jobs_db[job_id]["status"] = "processing"
-        jobs_db[job_id]["progress"] = 0
+        set_job_status(job_id, "processing", progress=0)
         
         # Prepare media files for processing
         media_files = []
@@ -300,46 +502,290 @@ def process_video_job_real(job_id: str, media_items: List[dict], output_settings
         
         # Progress callback
         def update_progress(progress: int, message: str):
-            jobs_db[job_id]["progress"] = progress
-            jobs_db[job_id]["message"] = message
+            set_job_status(job_id, "processing", progress=progress, message=message)
         
-        # Process videos
-        video_processor.process_media_files(
-            media_files=media_files,
-            output_path=output_path,
-            output_settings=output_settings,
-            progress_callback=update_progress
+        # Process videos, recording where the time goes
+        with bind_stats(stats):
+            engine.processor().process_media_files(
+                media_files=media_files,
+                output_path=output_path,
+                output_settings=output_settings,
+                progress_callback=update_progress,
+                cancel_token=cancel_token,
+                checkpoint=checkpoint
+            )
+        cancel_token.raise_if_cancelled()
+        
+        # The job is complete once rendered; the Drive upload follows in the background
+        gdrive_status = "pending" if drive_uploads.enabled() else None
+        set_job_status(
+            job_id, "completed",
+            progress=100,
+            output_url=f"/api/v1/jobs/{job_id}/download",
+            output_file=output_filename,
+            gdrive_url=None,  # Google Drive URL, set when the upload finishes
+            gdrive_status=gdrive_status,
+            stats=stats.as_dict(),
+            completed_at=datetime.utcnow().isoformat()
         )
+        if gdrive_status:
+            try:
+                drive_uploads.submit(job_id, output_path, output_filename, on_drive_upload)
+            except Exception as e:
+                logger.warning(f"Failed to queue Google Drive upload for job {job_id}: {e}")
+                on_drive_upload(job_id, None, str(e))
         
-        # Try to upload to Google Drive
-        drive_url = None
+    except JobCancelled:
+        logger.info(f"Job {job_id} cancelled")
+        if job_id in jobs_db:
+            jobs_db[job_id]["stats"] = stats.as_dict()
+    except Exception as e:
+        logger.error(f"Error processing job {job_id}: {str(e)}")
+        set_job_status(job_id, "failed", error=str(e), stats=stats.as_dict(), completed_at=datetime.utcnow().isoformat())
+    finally:
+        cancel_tokens.pop(job_id, None)
+        # Finished, failed or cancelled jobs are never resumed; free the space
+        if checkpoint:
+            checkpoint.discard()
+
+def tenant_for(data: dict, user: Optional[User]) -> str:
+    """Fair-share key for a batch: the signed-in user, else the spreadsheet"""
+    if user:
+        return f"user:{user.id}"
+    if data.get("spreadsheet_id"):
+        return f"sheet:{data['spreadsheet_id']}"
+    return "anonymous"
+
+def job_mode() -> str:
+    """How new jobs run: on Celery workers, rendered in this process, or mocked"""
+    if settings.job_executor == "celery":
+        return "celery"
+    if settings.job_executor == "mock" or not engine.available:
+        return "mock"
+    return "real"
+
+def job_footprint(job: dict):
+    """Estimated peak memory of a job, used by the scheduler to admit it"""
+    if job["mode"] == "mock":
+        return 0, "mock"  # renders nothing
+    if job["mode"] == "celery":
+        return 0, "celery"  # rendered by the workers, which bound themselves by their concurrency
+    engine = "segments" if settings.checkpoint_enabled else "compose"
+    return memory_admission.estimate(job["media_items"], job["output_settings"], engine)
+
+def start_job(job_id: str):
+    """Launch a job the scheduler has admitted; its slot is released when it ends"""
+    job = jobs_db.get(job_id)
+    if job is None or job.get("status") in TERMINAL_STATUSES:
+        job_scheduler.release(job_id)
+        return
+    if job["mode"] == "celery":
+        if job.get("celery_task_ids"):
+            return  # leased again after the node that dispatched it died; the tasks are still queued
+        from celery_app import dispatch_job
+        job["celery_task_ids"] = dispatch_job(job_id, {
+            "media_items": job["media_items"],
+            "output_settings": job["output_settings"]
+        })
+        return
+    threading.Thread(target=run_job, args=(job_id,), name=f"job-{job_id[:8]}", daemon=True).start()
+
+def run_job(job_id: str):
+    job = jobs_db[job_id]
+    if job["mode"] == "real" and not engine.load():
+        job["mode"] = "mock"  # the engine failed to import after the job was queued
+        memory_admission.forget(job_id)  # nothing to reserve, and nothing to learn from a mock run
+        finish_checkpoint(job_id, "mock")  # a mock run never resumes from it
+    process = process_video_job_real if job["mode"] == "real" else process_video_job_mock
+    try:
+        with bind_job(job_id):
+            process(job_id, job["media_items"], job["output_settings"])
+    finally:
+        job_scheduler.release(job_id)
+        if job_queue.enabled:
+            job_leaser.done(job_id)
+
+def submit_job(job: dict):
+    """Queue a new job: on this process's scheduler, or on the shared queue for any node to lease"""
+    tenant = job.get("tenant", "anonymous")
+    if job_queue.enabled:
+        job_queue.enqueue(tenant, job["job_id"])
+        job_leaser.wake()
+    else:
+        job_scheduler.submit(tenant, job["job_id"], start_job, job_footprint(job))
+
+def start_leased_job(job_id: str):
+    """Hand a job leased from the shared queue to this node's scheduler"""
+    job = jobs_db.get(job_id)
+    if job is None or job.get("status") in TERMINAL_STATUSES:
+        job_leaser.done(job_id)
+        return
+    cancel_tokens.setdefault(job_id, CancelToken())
+    job_scheduler.submit(job.get("tenant", "anonymous"), job_id, start_job, job_footprint(job))
+
+def stop_leased_job(job_id: str):
+    """This node lost a job's lease (it finished, was cancelled or went to another node); stop running it"""
+    token = cancel_tokens.get(job_id)
+    if token:
+        token.cancel()
+    job_scheduler.release(job_id)
+
+def abandon_leased_job(job_id: str):
+    set_job_status(
+        job_id, "failed",
+        error=f"Job lease expired {settings.job_lease_max_expirations + 1} times; the nodes running it stopped responding",
+        completed_at=datetime.utcnow().isoformat()
+    )
+
+# Leases jobs from the shared queue while this node's scheduler has nothing waiting
+job_leaser = JobLeaser(
+    job_queue, has_room=lambda: job_scheduler.queued() == 0,
+    start=start_leased_job, stop=stop_leased_job, abandon=abandon_leased_job
+)
+
+def record_profile(job_id: str, profile: dict):
+    """Add or update a profile on the job record, keyed by profile_id"""
+    job = jobs_db.get(job_id)
+    if job is None:
+        return
+    profiles = job.get("profiles", [])
+    entry = next((entry for entry in profiles if entry["profile_id"] == profile["profile_id"]), None)
+    if entry is None:
+        entry = {}
+        profiles.append(entry)
+    elif PROFILE_STATES.index(profile["status"]) < PROFILE_STATES.index(entry["status"]):
+        return  # the profile finished before its start was recorded
+    entry.update(profile)
+    if entry.get("artifact_url") or entry.get("artifact_file") or entry.get("artifact_key"):
+        entry["download_url"] = f"/api/v1/jobs/{job_id}/profiles/{entry['profile_id']}"
+    job["profiles"] = profiles  # reassigned so a shared record writes it through
+
+def save_profile(job_id: str, info: dict, collapsed: Optional[str]):
+    """Write a profile taken in this process next to the outputs, or to Redis for shared jobs, and record it"""
+    if collapsed is not None and shared():
+        # Any replica may serve the download, and it cannot read this node's disk
+        jobs_db.save_artifact(job_id, info["profile_id"], collapsed.encode(), settings.retention_completed_ttl)
+        info["artifact_key"] = info["profile_id"]
+    elif collapsed is not None:
+        artifact_file = os.path.join("profiles", job_id, f"{info['profile_id']}.folded")
+        path = os.path.join(STORAGE_PATH, artifact_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(collapsed)
+        info["artifact_file"] = artifact_file
+    record_profile(job_id, info)
+
+def on_drive_upload(job_id: str, gdrive_url: Optional[str], error: Optional[str]):
+    """Record the outcome of a background Google Drive upload"""
+    job = jobs_db.get(job_id)
+    if job is None:
+        return
+    if error:
+        job.update(gdrive_status="failed", gdrive_error=error)
+    else:
+        job.update(gdrive_status="uploaded", gdrive_url=gdrive_url)
+        logger.info(f"Successfully uploaded to Google Drive: {gdrive_url}")
+    notify_drive_upload(job)
+
+def resume_stale_upload(job: dict) -> bool:
+    """Retry once a Drive upload whose process was restarted or is gone, then give up on it"""
+    job_id = job["job_id"]
+    if drive_uploads.active(job_id):
+        return False  # still waiting in this process's upload queue
+    output_path = os.path.join(STORAGE_PATH, job.get("output_file") or "")
+    if (drive_uploads.enabled() and job.get("output_file") and os.path.exists(output_path)
+            and set_if_absent(job, "gdrive_requeued_at", datetime.utcnow().isoformat())):
+        logger.info(f"Retrying interrupted Google Drive upload of job {job_id}")
         try:
-            from storage import GoogleDriveStorage
-            drive_storage = GoogleDriveStorage()
-            drive_url = drive_storage.upload_video(output_path, output_filename)
-            if drive_url:
-                logger.info(f"Successfully uploaded to Google Drive: {drive_url}")
+            drive_uploads.submit(job_id, output_path, job["output_file"], on_drive_upload)
+            return True
         except Exception as e:
-            logger.warning(f"Failed to upload to Google Drive: {e}")
-        
-        # Update job completion
-        jobs_db[job_id]["status"] = "completed"
-        jobs_db[job_id]["progress"] = 100
-        jobs_db[job_id]["output_url"] = f"/api/v1/jobs/{job_id}/download"
-        jobs_db[job_id]["output_file"] = output_filename
-        jobs_db[job_id]["gdrive_url"] = drive_url  # Google Drive URL
-        jobs_db[job_id]["completed_at"] = datetime.utcnow().isoformat()
+            logger.warning(f"Failed to queue Google Drive upload for job {job_id}: {e}")
+    on_drive_upload(job_id, None, "Upload was interrupted before it finished")
+    return True
+
+# Background reclaimer for expired jobs, outputs and scratch data
+retention_manager = RetentionManager(jobs_db, batches_db, STORAGE_PATH, on_stale_upload=resume_stale_upload)
+
+def save_job_spec(job: dict, batch: dict):
+    """Persist what is needed to re-run a job if this process dies"""
+    if not (settings.checkpoint_enabled and job["mode"] == "real") or shared():
+        # Shared jobs are requeued when the lease of a dead node expires; Celery jobs stay in the broker
+        return
+    JobCheckpoint(job["job_id"]).record_spec({
+        "job": job,
+        "batch": {key: value for key, value in batch.items() if key != "job_ids"}
+    })
+
+def finish_checkpoint(job_id: str, status: str):
+    """Drop a finished job's checkpoint; if a live process still holds it, mark it so recovery skips it"""
+    if not settings.checkpoint_enabled or not has_checkpoint(job_id):
+        return
+    checkpoint = JobCheckpoint(job_id)
+    if checkpoint.acquire():
+        checkpoint.discard()
+        return
+    try:
+        checkpoint.record_terminal(status)
+    except OSError:
+        pass  # the owner discarded it meanwhile
+
+def recover_interrupted_jobs():
+    """Re-queue jobs whose checkpoint shows they were still running when the process died"""
+    recovered = []
+    for job_id in list_checkpoints():
+        if job_id in jobs_db:
+            continue
+        checkpoint = JobCheckpoint(job_id)
+        spec = checkpoint.state.get("spec")
+        if not spec or not checkpoint.acquire():
+            continue  # no spec yet, or another live process owns it
+        if checkpoint.terminal_status():
+            checkpoint.discard()  # finished before the process died; never run it again
+            continue
+        checkpoint.release()
         
-    except Exception as e:
-        logger.error(f"Error processing job {job_id}: {str(e)}")
-        jobs_db[job_id]["status"] = "failed"
-        jobs_db[job_id]["error"] = str(e)
-        jobs_db[job_id]["completed_at"] = datetime.utcnow().isoformat()
+        job = dict(spec["job"], status="pending", progress=0, message="Recovered after restart")
+        batch_spec = spec["batch"]
+        batch = batches_db.setdefault(batch_spec["batch_id"], dict(batch_spec, job_ids=[]))
+        batch["job_ids"] = batch["job_ids"] + [job_id]
+        jobs_db[job_id] = job
+        cancel_tokens[job_id] = CancelToken()
+        recovered.append(job)
+    
+    if not recovered:
+        return
+    logger.info(f"Recovering {len(recovered)} interrupted jobs from checkpoints")
+    for job in recovered:
+        submit_job(job)
 
 @app.post("/api/v1/jobs/batch")
-async def create_batch_jobs(background_tasks: BackgroundTasks, data: dict):
-    """Create batch video processing jobs"""
+def create_batch_jobs(
+    background_tasks: BackgroundTasks,
+    data: dict,
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    """Create batch video processing jobs, queued fairly per tenant"""
     jobs = []
+    tenant = tenant_for(data, current_user)
+    
+    # Optional completion callback registered for the whole batch
+    callback_url = data.get("callback_url")
+    callback_mode = data.get("callback_mode", "all")
+    if callback_url and not callback_url.startswith(("http://", "https://")):
+        raise HTTPException(status_code=400, detail="callback_url must be an http(s) URL")
+    if callback_mode not in CALLBACK_MODES:
+        raise HTTPException(status_code=400, detail=f"callback_mode must be one of {sorted(CALLBACK_MODES)}")
+    
+    batch_id = str(uuid.uuid4())
+    batch = {
+        "batch_id": batch_id,
+        "job_ids": [],
+        "callback_url": callback_url,
+        "callback_mode": callback_mode,
+        "created_at": datetime.utcnow().isoformat(),
+        "completed_at": None
+    }
     
     for i, row in enumerate(data.get("rows", [])):
         job_id = str(uuid.uuid4())
@@ -353,6 +799,7 @@ async def create_batch_jobs(background_tasks: BackgroundTasks, data: dict):
         # Create job entry
         job = {
             "job_id": job_id,
+            "batch_id": batch_id,
             "status": "pending",
             "progress": 0,
             "message": "Job queued for processing",
@@ -360,46 +807,101 @@ async def create_batch_jobs(background_tasks: BackgroundTasks, data: dict):
             "row_number": row.get("row_number", i + 1),
             "media_items": row.get("media_items", []),
             "output_settings": data.get("output_settings", {}),
-            "mode": "real" if MOVIEPY_AVAILABLE else "mock"
+            "tenant": tenant,
+            "mode": job_mode()
         }
         
         jobs_db[job_id] = job
+        cancel_tokens[job_id] = CancelToken()
+        batch["job_ids"].append(job_id)
+        save_job_spec(job, batch)
         jobs.append(job)
-        
-        # Queue background processing
-        if MOVIEPY_AVAILABLE:
-            background_tasks.add_task(
-                process_video_job_real,
-                job_id,
-                row.get("media_items", []),
-                data.get("output_settings", {})
-            )
-        else:
-            background_tasks.add_task(
-                process_video_job_mock,
-                job_id,
-                row.get("media_items", []),
-                data.get("output_settings", {})
-            )
+    
+    # Stored whole, then queued: the scheduler starts each job (or hands it to Celery) when its tenant's turn comes
+    batches_db[batch_id] = batch
+    for job in jobs:
+        submit_job(job)
     
     return jobs
 
-@app.get("/api/v1/jobs/{job_id}")
-async def get_job_status(job_id: str):
+@app.get("/api/v1/batches/{batch_id}")
+def get_batch_status(batch_id: str):
+    batch = batches_db.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return FastJSONResponse(batch_summary(batch))
+
+def cancel_job(job_id: str) -> bool:
+    """Mark a job cancelled and interrupt its work; False if already finished"""
+    job = jobs_db.get(job_id)
+    if job is None or not set_job_status(
+        job_id, "cancelled",
+        message="Job cancelled",
+        completed_at=datetime.utcnow().isoformat()
+    ):
+        return False
+    token = cancel_tokens.get(job_id)
+    if token:
+        token.cancel()
+    if job_queue.enabled:
+        job_queue.remove(job.get("tenant", "anonymous"), job_id)  # a node leasing it stops on its next heartbeat
+    if job.get("celery_task_ids"):
+        from celery_app import celery_app
+        celery_app.control.revoke(job["celery_task_ids"], terminate=True)
+    return True
+
+@app.post("/api/v1/batches/{batch_id}/cancel")
+def cancel_batch(batch_id: str):
+    if batch_id not in batches_db:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    batch = batches_db[batch_id]
+    cancelled = [job_id for job_id in list(batch["job_ids"]) if cancel_job(job_id)]
+    return {"batch_id": batch_id, "cancelled": len(cancelled), "job_ids": cancelled}
+
+@app.post("/api/v1/jobs/{job_id}/cancel")
+def cancel_job_endpoint(job_id: str):
     if job_id not in jobs_db:
         raise HTTPException(status_code=404, detail="Job not found")
-    return jobs_db[job_id]
+    if not cancel_job(job_id):
+        raise HTTPException(status_code=409, detail=f"Job already {jobs_db[job_id]['status']}")
+    return job_summary(jobs_db[job_id])
+
+@app.get("/api/v1/jobs/{job_id}")
+def get_job_status(job_id: str, include_spec: bool = False):
+    """A job's record; its media_items and output_settings only with ``include_spec``"""
+    job = jobs_db.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return FastJSONResponse(public_fields(job, include_spec))
 
 @app.get("/api/v1/jobs/{job_id}/download")
-async def download_job_output(job_id: str):
+def download_job_output(job_id: str):
     if job_id not in jobs_db:
         raise HTTPException(status_code=404, detail="Job not found")
     
     job = jobs_db[job_id]
     if job["status"] != "completed":
         raise HTTPException(status_code=400, detail="Job not completed yet")
+    if job.get("output_evicted_at"):
+        raise HTTPException(status_code=410, detail="Job output has expired")
+    
+    job["last_downloaded_at"] = datetime.utcnow().isoformat()
     
-    if MOVIEPY_AVAILABLE and "output_file" in job:
+    # Outputs stored by Celery workers: hand out a presigned URL instead of
+    # proxying the bytes, or serve the shared local storage directly
+    output_url = job.get("output_url") or ""
+    if output_url.startswith(("s3://", "minio://")) and settings.presigned_downloads:
+        return RedirectResponse(get_storage().presigned_url(output_url), status_code=307)
+    if output_url.startswith("/storage/"):
+        file_path = get_storage().get_file_path(output_url)
+        if os.path.exists(file_path):
+            return FileResponse(
+                file_path,
+                media_type="video/mp4",
+                filename=f"processed_video_{job_id}.mp4"
+            )
+    
+    if "output_file" in job:
         # Real file download
         output_file = job.get("output_file")
         file_path = os.path.join(STORAGE_PATH, output_file)
@@ -410,6 +912,10 @@ async def download_job_output(job_id: str):
                 filename=f"processed_video_{job_id}.mp4"
             )
     
+    if shared() and job.get("mode") != "mock":
+        # Written to a node whose STORAGE_PATH this replica does not see, or removed from it
+        raise HTTPException(status_code=404, detail="Job output not found in the storage of this server")
+    
     # Mock response
     return {
         "message": "MoviePy is not available or file not found. This is a mock response.",
@@ -417,6 +923,125 @@ async def download_job_output(job_id: str):
         "download_url": f"https://example.com/mock-video-{job_id}.mp4"
     }
 
+@app.get("/api/v1/jobs/{job_id}/profiles/{profile_id}")
+def download_job_profile(job_id: str, profile_id: str):
+    """Collapsed stacks of a finished profile (flamegraph.pl, speedscope, inferno)"""
+    job = jobs_db.get(job_id)
+    profile = next((entry for entry in (job or {}).get("profiles", []) if entry["profile_id"] == profile_id), None)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if profile["status"] != "completed":
+        raise HTTPException(status_code=400, detail=f"Profile {profile['status']}")
+    
+    filename = f"profile_{job_id}_{profile_id}.folded"
+    if profile.get("artifact_key"):
+        collapsed = jobs_db.load_artifact(job_id, profile["artifact_key"])
+        if collapsed is None:
+            raise HTTPException(status_code=410, detail="Profile file is gone")
+        return Response(collapsed, media_type="text/plain",
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    artifact_url = profile.get("artifact_url") or ""
+    if artifact_url.startswith(("s3://", "minio://")):
+        return RedirectResponse(get_storage().presigned_url(artifact_url), status_code=307)
+    if artifact_url.startswith("/storage/"):
+        file_path = get_storage().get_file_path(artifact_url)
+    else:
+        file_path = os.path.join(STORAGE_PATH, profile.get("artifact_file", ""))
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=410, detail="Profile file is gone")
+    return FileResponse(file_path, media_type="text/plain", filename=filename)
+
+@app.post("/api/v1/admin/jobs/{job_id}/profile")
+def profile_job(job_id: str, seconds: float = 30.0, interval: Optional[float] = None, all_threads: bool = False):
+    """Sample the process running a job for ``seconds``; the result is listed under the job's profiles.
+
+    ``all_threads`` samples every thread of that process instead of only
+    the job's own. Celery jobs, and jobs leased by render nodes, are
+    profiled by the worker that picks the request up next while running one
+    of the job's tasks.
+    """
+    job = jobs_db.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.get("status") in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Job already {job['status']}")
+    if not 0 < seconds <= settings.profile_max_seconds:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {settings.profile_max_seconds}")
+    if interval is not None and not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="interval must be between 0.001 and 1 second")
+    
+    profile_id = uuid.uuid4().hex[:12]
+    if job["mode"] == "celery" or job_queue.enabled:
+        request = {"profile_id": profile_id, "seconds": seconds, "interval": interval, "all_threads": all_threads}
+        try:
+            profile_requests.submit(job_id, request)
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Could not queue the profile request: {e}")
+        profile = dict(request, status="requested", requested_at=datetime.utcnow().isoformat())
+    else:
+        profile = start_profile(job_id, seconds, interval, all_threads, profile_id, save_profile)
+        if profile is None:
+            raise HTTPException(status_code=409, detail="Job is not running or is already being profiled")
+    record_profile(job_id, profile)
+    return profile
+
+@app.get("/api/v1/admin/retention")
+def get_retention_status():
+    """Retention policy, storage usage and reclaimed totals"""
+    return retention_manager.status()
+
+@app.get("/api/v1/admin/stats")
+def get_job_stats(status: str = "completed", limit: int = 1000):
+    """Stage timing, CPU and transfer totals over the most recently created jobs with ``status``"""
+    if not 1 <= limit <= 10000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 10000")
+    jobs, _ = jobs_db.page(None, limit, lambda job: job.get("status") == status and job.get("stats"), reverse=True)
+    return {"status": status, **aggregate(job["stats"] for job in jobs)}
+
+@app.get("/api/v1/admin/jobs")
+def list_jobs(
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    tenant: Optional[str] = None,
+    batch_id: Optional[str] = None
+):
+    """Jobs in creation order, a page at a time; pass ``next_cursor`` back as ``cursor`` for the next page"""
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    try:
+        after = base64.urlsafe_b64decode(cursor.encode()).decode() if cursor else None
+    except (binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    filters = {"status": status, "tenant": tenant, "batch_id": batch_id}
+    filters = {field: value for field, value in filters.items() if value is not None}
+    
+    def match(job) -> bool:
+        return all(job.get(field) == value for field, value in filters.items())
+    
+    jobs, last = jobs_db.page(after, limit, match if filters else None)
+    return FastJSONResponse({
+        "jobs": [
+            dict(job_summary(job), tenant=job.get("tenant"), mode=job.get("mode"), created_at=job.get("created_at"))
+            for job in jobs
+        ],
+        "next_cursor": base64.urlsafe_b64encode(last.encode()).decode() if last else None,
+    })
+
+@app.get("/api/v1/admin/scheduler")
+def get_scheduler_status():
+    """Per-tenant queue depth, running jobs and queue wait times"""
+    status = job_scheduler.status()
+    if job_queue.enabled:
+        status["shared_queue"] = job_queue.status()
+        status["leased"] = job_leaser.held()
+    return status
+
+@app.post("/api/v1/admin/retention/run")
+def run_retention():
+    """Run a reclaim pass immediately and return its report"""
+    return retention_manager.run_once()
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
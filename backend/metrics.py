@@ -0,0 +1,157 @@
+"""Prometheus metrics for the API process and the Celery workers.
+
+Updates are a lock and an add (an mmap write in multiprocess mode), cheap
+enough for per-chunk loops. Prefork Celery workers need
+PROMETHEUS_MULTIPROC_DIR set so every child's samples are merged when the
+worker's metrics server is scraped.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess, start_http_server
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from config import settings
+from job_stats import current_stats
+from retention import path_size
+
+logger = logging.getLogger(__name__)
+
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+STAGES = ("download", "probe", "render", "encode", "concat", "upload")
+
+JOBS_QUEUED = Gauge(
+    "video_jobs_queued", "Jobs waiting in the fair-share scheduler", multiprocess_mode="livesum"
+)
+JOBS_RUNNING = Gauge(
+    "video_jobs_running", "Jobs admitted by the scheduler and not yet finished", multiprocess_mode="livesum"
+)
+QUEUE_WAIT = Histogram(
+    "video_job_queue_wait_seconds", "Time from submission until the scheduler starts a job",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+)
+JOB_OUTCOMES = Counter("video_jobs_finished", "Jobs reaching a terminal status", ["status"])
+STAGE_SECONDS = Histogram(
+    "video_stage_duration_seconds", "Wall time per pipeline stage", ["stage"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+BYTES_DOWNLOADED = Counter("video_downloaded_bytes", "Source media bytes downloaded")
+BYTES_UPLOADED = Counter("video_uploaded_bytes", "Output bytes uploaded", ["destination"])
+CACHE_LOOKUPS = Counter("video_cache_lookups", "Cache lookups by cache and result (hit/miss)", ["cache", "result"])
+ENCODE_FPS = Histogram(
+    "video_encode_fps", "Frames encoded per second of wall time",
+    buckets=(5, 10, 25, 50, 100, 200, 400, 800)
+)
+EVENT_LOOP_LAG = Histogram(
+    "api_event_loop_lag_seconds", "How late the API event loop woke from a timer",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+
+@contextmanager
+def stage_timer(stage: str, item: Optional[int] = None):
+    """Observe the wall time of the block as ``stage``, whether or not it raises.
+
+    The time is also added to the job stats bound to this thread, under
+    media item ``item`` when given.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        stats = current_stats()
+        if stats is not None:
+            stats.add_stage(stage, elapsed, item=item)
+
+
+async def watch_event_loop(interval: float):
+    """Observe how late each ``interval`` sleep wakes up; blocking handlers show up as lag"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - started - interval, 0.0))
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def count_processes(name: str = "ffmpeg") -> int:
+    """Processes in this container whose command name contains ``name``"""
+    count = 0
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, "comm")) as f:
+                if name in f.read():
+                    count += 1
+        except OSError:
+            continue
+    return count
+
+
+class RuntimeCollector:
+    """Gauges computed at scrape time instead of on every change"""
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            "video_active_subprocesses", "Running ffmpeg reader/encoder processes", value=count_processes()
+        )
+        yield GaugeMetricFamily(
+            "video_scratch_bytes", "Bytes under the scratch directory", value=path_size(settings.scratch_path)
+        )
+
+
+_runtime_collector = RuntimeCollector()
+REGISTRY.register(_runtime_collector)
+
+
+def multiprocess_enabled() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def scrape_registry() -> CollectorRegistry:
+    """The registry to expose: this process, or every process sharing the multiprocess dir"""
+    if not multiprocess_enabled():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(_runtime_collector)
+    return registry
+
+
+def metrics_payload() -> tuple:
+    """(body, content type) for a /metrics response"""
+    return generate_latest(scrape_registry()), CONTENT_TYPE_LATEST
+
+
+def start_worker_metrics_server(port: int):
+    """Serve /metrics from a Celery worker's main process"""
+    if multiprocess_enabled():
+        # Files of processes from earlier runs would otherwise be summed into this one
+        directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            pid = name.rsplit("_", 1)[-1].split(".")[0]
+            if pid.isdigit() and not os.path.exists(f"/proc/{pid}"):
+                os.remove(os.path.join(directory, name))
+    start_http_server(port, registry=scrape_registry())
+    logger.info(f"Worker metrics on :{port}/metrics")
+
+
+def mark_process_dead(pid: int):
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
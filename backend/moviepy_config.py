@@ -3,7 +3,5 @@ import os
 
 # Set FFmpeg path if needed
 # MoviePy should auto-detect ffmpeg in PATH, but we can help it
-os.environ['IMAGEIO_FFMPEG_EXE'] = 'ffmpeg'
-
-# Enable verbose logging for debugging
-os.environ['MOVIEPY_DEBUG'] = '1'
\ No newline at end of file
+# (the Docker image points IMAGEIO_FFMPEG_EXE at the system ffmpeg)
+os.environ.setdefault('IMAGEIO_FFMPEG_EXE', 'ffmpeg')
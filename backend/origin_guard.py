@@ -0,0 +1,227 @@
+"""Per-origin rate limiting, circuit breaking and negative caching for media downloads"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from cancellation import CancelToken
+from config import settings
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+# Responses that mean "this URL will not work", not "try again later"
+PERMANENT_STATUSES = {400, 401, 403, 404, 410}
+THROTTLE_STATUSES = {429, 503}
+
+
+class OriginUnavailable(Exception):
+    """A download was refused without contacting the origin"""
+
+
+def origin_of(url: str) -> str:
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}".lower()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """``rate`` requests per second with bursts up to ``capacity``; can be paused"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self) -> float:
+        """Take a token; returns how long the caller must wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failures; lets one probe through after ``reset_timeout``"""
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+class OriginGuard:
+    """Shared download policy for every origin this process talks to.
+
+    ``acquire`` is called before each request and ``record`` after it.
+    Throttled origins (429/503 with Retry-After) pause their token bucket;
+    a wait longer than ``origin_max_wait`` fails immediately instead of
+    holding a worker slot. Origins failing repeatedly trip their circuit
+    breaker, and URLs that answered with a permanent error or an HTML page
+    are refused for ``negative_cache_ttl`` seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._bad_urls: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def acquire(self, url: str, cancel_token: Optional[CancelToken] = None):
+        """Wait for a request slot on ``url``'s origin, or raise OriginUnavailable"""
+        origin = origin_of(url)
+        with self._lock:
+            reason = self._bad_url_reason(url)
+            record_cache("negative_url", bool(reason))
+            if reason:
+                raise OriginUnavailable(f"{url} failed recently ({reason}), not retrying yet")
+            breaker = self._breakers.setdefault(
+                origin, CircuitBreaker(settings.circuit_failure_threshold, settings.circuit_reset_timeout)
+            )
+            if not breaker.allow():
+                raise OriginUnavailable(f"{origin} is failing, circuit open")
+            bucket = self._buckets.setdefault(origin, TokenBucket(settings.origin_rate, settings.origin_burst))
+            wait = bucket.reserve()
+            if wait > settings.origin_max_wait:
+                bucket.tokens += 1  # hand the token back
+                breaker.probing = False
+                raise OriginUnavailable(f"{origin} is throttled for another {wait:.0f}s")
+
+        if wait > 0:
+            logger.info(f"Rate limiting {origin}: waiting {wait:.1f}s")
+            try:
+                if cancel_token:
+                    cancel_token.wait(wait)
+                    cancel_token.raise_if_cancelled()
+                else:
+                    time.sleep(wait)
+            except BaseException:
+                # No request goes out, so a probe slot taken by allow() must not stay held
+                with self._lock:
+                    breaker.probing = False
+                raise
+
+    def record(self, url: str, status: Optional[int] = None, retry_after: Optional[str] = None):
+        """Report a request's outcome; ``status`` None means the connection failed"""
+        origin = origin_of(url)
+        with self._lock:
+            breaker = self._breakers.get(origin)
+            if status is not None and status < 400:
+                if breaker:
+                    breaker.success()
+                return
+
+            if status in THROTTLE_STATUSES:
+                delay = parse_retry_after(retry_after)
+                if delay:
+                    self._buckets.setdefault(
+                        origin, TokenBucket(settings.origin_rate, settings.origin_burst)
+                    ).pause(delay)
+                    logger.warning(f"{origin} asked to back off for {delay:.0f}s")
+
+            if status in PERMANENT_STATUSES:
+                # The origin is fine; the URL is not
+                if breaker:
+                    breaker.success()
+                self._remember_bad_url(url, f"HTTP {status}")
+            elif status == 429:
+                # Alive but busy; the paused bucket handles it
+                if breaker:
+                    breaker.probing = False
+            elif breaker:
+                breaker.failure()
+                if breaker.state == "open":
+                    logger.warning(f"Circuit opened for {origin} after {breaker.failures} failures")
+
+    def reject_url(self, url: str, reason: str):
+        """Refuse ``url`` for a while, e.g. after it served an HTML page"""
+        with self._lock:
+            self._remember_bad_url(url, reason)
+
+    def reset(self):
+        """Forget all origin state, e.g. between benchmark scenarios"""
+        with self._lock:
+            self._buckets.clear()
+            self._breakers.clear()
+            self._bad_urls.clear()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "origins": {
+                    origin: {"circuit": breaker.state, "failures": breaker.failures}
+                    for origin, breaker in self._breakers.items()
+                },
+                "negative_cache_size": len(self._bad_urls),
+            }
+
+    def _bad_url_reason(self, url: str) -> Optional[str]:
+        entry = self._bad_urls.get(url)
+        if entry is None:
+            return None
+        expires, reason = entry
+        if expires < time.monotonic():
+            del self._bad_urls[url]
+            return None
+        return reason
+
+    def _remember_bad_url(self, url: str, reason: str):
+        self._bad_urls[url] = (time.monotonic() + settings.negative_cache_ttl, reason)
+        self._bad_urls.move_to_end(url)
+        while len(self._bad_urls) > settings.negative_cache_size:
+            self._bad_urls.popitem(last=False)
+
+
+origin_guard = OriginGuard()
@@ -0,0 +1,391 @@
+"""On-demand sampling profiles of running jobs, written as collapsed stacks.
+
+Threads running a job are registered with ``bind_job`` and the ffmpeg
+processes they start with ``track_process``; both are a dict update, so
+nothing else runs until a profile is requested. A ``Profile`` then samples
+the Python stacks of the job's threads (or of every thread of the process)
+for a bounded window. Samples taken while a thread was off CPU end in
+``[waiting on ffmpeg]`` when it was blocked on an ffmpeg pipe or process,
+``[off-cpu]`` otherwise, and the CPU time of the job's ffmpeg processes is
+added as ``[ffmpeg]`` stacks in sample units.
+
+The output is the collapsed format read by flamegraph.pl, speedscope and
+inferno: one ``frame;frame;frame count`` line per distinct stack.
+
+Celery workers cannot be reached from the API directly; ``ProfileRequests``
+hands requests over through Redis, and ``watch_requests`` polls for them
+only while the worker process is running a job.
+"""
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import redis
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Leaf frames that mean "blocked on an ffmpeg pipe or process": MoviePy's
+# reader/writer pipes and subprocess waits (our own ffmpeg calls)
+FFMPEG_WAIT_FILES = {"subprocess.py", "ffmpeg_reader.py", "ffmpeg_writer.py", "ffmpeg_audiowriter.py", "readers.py"}
+OFF_CPU_RATIO = 0.5  # below this share of the interval on CPU, a sample counts as waiting
+FFMPEG_POLL_SECONDS = 0.5
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+_local = threading.local()
+_lock = threading.Lock()
+_job_threads: Dict[str, Dict[int, int]] = {}  # job id -> thread ident -> nesting depth
+_job_processes: Dict[str, weakref.WeakSet] = {}
+_profiling: Dict[str, "Profile"] = {}
+
+
+def current_job() -> Optional[str]:
+    return getattr(_local, "job_id", None)
+
+
+def running_jobs() -> List[str]:
+    with _lock:
+        return list(_job_threads)
+
+
+@contextmanager
+def bind_job(job_id: str):
+    """Mark the current thread as working on ``job_id`` for the duration of the block"""
+    ident = threading.get_ident()
+    previous = current_job()
+    _local.job_id = job_id
+    with _lock:
+        threads = _job_threads.setdefault(job_id, {})
+        threads[ident] = threads.get(ident, 0) + 1
+    if _watcher is not None:
+        _watcher.ensure_running()
+    try:
+        yield
+    finally:
+        _local.job_id = previous
+        with _lock:
+            threads[ident] -= 1
+            if not threads[ident]:
+                del threads[ident]
+            if not threads:
+                _job_threads.pop(job_id, None)
+                _job_processes.pop(job_id, None)
+
+
+def track_process(process):
+    """Remember a subprocess started by a thread bound to a job (see cancellation._TrackedPopen)"""
+    job_id = current_job()
+    if job_id is None:
+        return
+    with _lock:
+        if job_id in _job_threads:
+            _job_processes.setdefault(job_id, weakref.WeakSet()).add(process)
+
+
+def _thread_cpu(ident: int) -> Optional[float]:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None  # not Linux, or the thread just ended
+
+
+def process_cpu(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+
+
+def _ffmpeg_label(args) -> str:
+    """``decode <input>`` for MoviePy readers, ``encode <output>`` when frames are piped in"""
+    if isinstance(args, str):
+        args = args.split()
+    args = [str(arg) for arg in args]
+    source = args[args.index("-i") + 1] if "-i" in args[:-1] else None
+    if source is None:
+        return os.path.basename(args[0]) if args else "ffmpeg"
+    if source in ("-", "pipe:", "pipe:0"):
+        return f"encode {os.path.basename(args[-1])}"
+    return f"decode {os.path.basename(source)}"
+
+
+class Profile:
+    """One sampling window over a job's threads (or all threads) of this process"""
+
+    def __init__(self, job_id: str, seconds: float, interval: Optional[float] = None,
+                 all_threads: bool = False, profile_id: Optional[str] = None):
+        self.job_id = job_id
+        self.seconds = min(seconds, settings.profile_max_seconds)
+        self.interval = max(interval or settings.profile_default_interval, 0.001)
+        self.all_threads = all_threads
+        self.profile_id = profile_id or uuid.uuid4().hex[:12]
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.off_cpu_samples = 0
+        self.ffmpeg_wait_samples = 0
+        self.ffmpeg_cpu_seconds = 0.0
+        self._labels: Dict[object, str] = {}
+        self._thread_cpu: Dict[int, float] = {}
+        self._process_cpu: Dict[int, float] = {}
+
+    def info(self, status: str, **fields) -> dict:
+        return {
+            "profile_id": self.profile_id,
+            "status": status,
+            "seconds": self.seconds,
+            "interval": self.interval,
+            "all_threads": self.all_threads,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            **fields,
+        }
+
+    def run(self) -> dict:
+        """Sample until the window ends or the job stops running here; returns the summary"""
+        started_at = datetime.utcnow().isoformat()
+        started = time.perf_counter()
+        own = threading.get_ident()
+        last_tick = started
+        last_ffmpeg = started
+        self._sample_ffmpeg(baseline=True)
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            threads = self._threads(own)
+            if not self.all_threads and not threads:
+                break  # the job finished
+            self._sample_threads(threads, now - last_tick)
+            last_tick = now
+            if now - last_ffmpeg >= FFMPEG_POLL_SECONDS:
+                self._sample_ffmpeg()
+                last_ffmpeg = now
+            if now - started >= self.seconds:
+                break
+        self._sample_ffmpeg()
+        return self.info(
+            "completed",
+            started_at=started_at,
+            finished_at=datetime.utcnow().isoformat(),
+            duration_seconds=round(time.perf_counter() - started, 3),
+            samples=self.samples,
+            off_cpu_samples=self.off_cpu_samples,
+            ffmpeg_wait_samples=self.ffmpeg_wait_samples,
+            ffmpeg_cpu_seconds=round(self.ffmpeg_cpu_seconds, 3),
+        )
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def _threads(self, own: int) -> Dict[int, str]:
+        """ident -> thread name of the threads to sample"""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        if self.all_threads:
+            return {ident: name for ident, name in names.items()
+                    if ident != own and not name.startswith("profiler-")}
+        with _lock:
+            idents = list(_job_threads.get(self.job_id, ()))
+        return {ident: names.get(ident, str(ident)) for ident in idents}
+
+    def _sample_threads(self, threads: Dict[int, str], elapsed: float):
+        frames = sys._current_frames()
+        for ident, name in threads.items():
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = [name]
+            # The leaf or its caller: waits go through cancellation._TrackedPopen
+            waiting_on_ffmpeg = any(
+                os.path.basename(code.co_filename) in FFMPEG_WAIT_FILES
+                for code in (frame.f_code, frame.f_back.f_code if frame.f_back else frame.f_code)
+            )
+            stack.extend(reversed(self._frames(frame)))
+
+            cpu = _thread_cpu(ident)
+            previous = self._thread_cpu.get(ident)
+            if cpu is not None:
+                self._thread_cpu[ident] = cpu
+            waiting = cpu is not None and previous is not None and cpu - previous < elapsed * OFF_CPU_RATIO
+            if waiting:
+                self.off_cpu_samples += 1
+                if waiting_on_ffmpeg:
+                    stack.append("[waiting on ffmpeg]")
+                    self.ffmpeg_wait_samples += 1
+                else:
+                    stack.append("[off-cpu]")
+            self.stacks[";".join(stack)] += 1
+            self.samples += 1
+
+    def _frames(self, frame) -> List[str]:
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+            labels.append(label)
+            frame = frame.f_back
+        return labels
+
+    def _sample_ffmpeg(self, baseline: bool = False):
+        with _lock:
+            if self.all_threads:
+                processes = [process for tracked in _job_processes.values() for process in tracked]
+            else:
+                processes = list(_job_processes.get(self.job_id, ()))
+        for process in processes:
+            cpu = process_cpu(process.pid)
+            if cpu is None:
+                continue
+            previous = self._process_cpu.get(process.pid)
+            self._process_cpu[process.pid] = cpu
+            if baseline or previous is None:
+                if baseline:
+                    continue
+                previous = 0.0  # started during the window
+            used = cpu - previous
+            if used > 0:
+                self.ffmpeg_cpu_seconds += used
+                self.stacks[f"[ffmpeg];{_ffmpeg_label(process.args)}"] += round(used / self.interval)
+
+
+def _short_path(path: str) -> str:
+    """Module path without the site-packages or checkout prefix"""
+    marker = "site-packages" + os.sep
+    if marker in path:
+        return path.split(marker, 1)[1]
+    return os.path.basename(path)
+
+
+def start_profile(job_id: str, seconds: float, interval: Optional[float] = None, all_threads: bool = False,
+                  profile_id: Optional[str] = None,
+                  on_update: Optional[Callable[[str, dict, Optional[str]], None]] = None) -> Optional[dict]:
+    """Profile ``job_id`` in a background thread; None if it is not running here or already profiled.
+
+    ``on_update(job_id, info, collapsed)`` is called from that thread when
+    the window ends (``collapsed`` is the artifact) or the profile fails.
+    """
+    profile = Profile(job_id, seconds, interval, all_threads, profile_id)
+    with _lock:
+        if job_id not in _job_threads or job_id in _profiling:
+            return None
+        _profiling[job_id] = profile
+
+    def run():
+        try:
+            info = profile.run()
+            collapsed = profile.collapsed()
+        except Exception as e:
+            logger.error(f"Profile {profile.profile_id} of job {job_id} failed: {e}")
+            info, collapsed = profile.info("failed", error=str(e)), None
+        finally:
+            with _lock:
+                _profiling.pop(job_id, None)
+        logger.info(f"Profiled job {job_id} for {info.get('duration_seconds')}s ({info.get('samples')} samples)")
+        if on_update:
+            on_update(job_id, info, collapsed)
+
+    threading.Thread(target=run, name=f"profiler-{profile.profile_id}", daemon=True).start()
+    return profile.info("running", started_at=datetime.utcnow().isoformat())
+
+
+class ProfileRequests:
+    """Profile requests for Celery jobs, handed from the API to workers through a Redis hash"""
+
+    def __init__(self, redis_url: Optional[str] = None):
+        self.redis_url = redis_url or settings.progress_redis_url or settings.celery_broker_url
+        self._client: Optional[redis.Redis] = None
+        self._pid: Optional[int] = None
+
+    @property
+    def client(self) -> redis.Redis:
+        if self._client is None or self._pid != os.getpid():
+            self._client = redis.Redis.from_url(self.redis_url)
+            self._pid = os.getpid()
+        return self._client
+
+    def submit(self, job_id: str, request: dict):
+        request = dict(request, expires_at=time.time() + settings.profile_request_ttl)
+        self.client.hset(settings.profile_requests_key, job_id, json.dumps(request))
+
+    def claim(self, job_ids: List[str]) -> Dict[str, dict]:
+        """Take the pending requests for these jobs, expired ones included; HDEL makes each one go to a single worker"""
+        if not job_ids:
+            return {}
+        claimed = {}
+        for job_id, raw in zip(job_ids, self.client.hmget(settings.profile_requests_key, job_ids)):
+            if raw is None or not self.client.hdel(settings.profile_requests_key, job_id):
+                continue
+            claimed[job_id] = json.loads(raw)
+        return claimed
+
+
+def request_info(request: dict) -> dict:
+    """Profile fields of a request that never started sampling"""
+    return {field: request.get(field) for field in ("profile_id", "seconds", "interval", "all_threads")}
+
+
+class _RequestWatcher:
+    """Polls ProfileRequests while this process runs jobs and starts the requested profiles"""
+
+    def __init__(self, requests: ProfileRequests, on_update: Callable[[str, dict, Optional[str]], None]):
+        self.requests = requests
+        self.on_update = on_update
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+
+    def ensure_running(self):
+        # Prefork children inherit the object but not the thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="profiler-requests", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.profile_poll_interval)
+            jobs = running_jobs()
+            if not jobs:
+                continue
+            try:
+                claimed = self.requests.claim(jobs)
+            except redis.RedisError as e:
+                logger.warning(f"Could not check for profile requests: {e}")
+                continue
+            for job_id, request in claimed.items():
+                # Every claimed request ends in a state, or the API would list it as requested forever
+                if request["expires_at"] < time.time():
+                    info = dict(request_info(request), status="expired")
+                else:
+                    info = start_profile(job_id, request["seconds"], request.get("interval"),
+                                         request.get("all_threads", False), request["profile_id"], self.on_update)
+                    if info is None:
+                        info = dict(request_info(request), status="failed",
+                                    error="Job stopped running here or is already being profiled")
+                self.on_update(job_id, info, None)
+
+
+_watcher: Optional[_RequestWatcher] = None
+
+
+def watch_requests(requests: ProfileRequests, on_update: Callable[[str, dict, Optional[str]], None]):
+    """Serve profile requests from the API in this (worker) process; see _RequestWatcher"""
+    global _watcher
+    _watcher = _RequestWatcher(requests, on_update)
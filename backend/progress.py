@@ -0,0 +1,270 @@
+"""Job progress channel from Celery workers to the API over Redis"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import redis
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = {"completed", "failed", "cancelled"}
+
+# How long a job's last update time is remembered; late coalesced flushes arrive well within this
+DEDUPE_WINDOW_SECONDS = 300.0
+
+
+class ProgressPublisher:
+    """Publishes job updates to a Redis stream, coalescing bursts per job.
+
+    Within ``interval`` seconds only the latest update of a job is sent
+    (last writer wins); terminal updates are sent immediately. One pooled
+    Redis connection is kept per worker process.
+    """
+
+    def __init__(self, redis_url: Optional[str] = None, interval: Optional[float] = None):
+        self.redis_url = redis_url or settings.progress_redis_url or settings.celery_broker_url
+        self.interval = settings.progress_coalesce_interval if interval is None else interval
+        self._client: Optional[redis.Redis] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        self._pending: Dict[str, dict] = {}
+        self._last_sent: Dict[str, float] = {}
+        self._wakeup = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    @property
+    def client(self) -> redis.Redis:
+        # Prefork workers inherit the parent's object; give each process its own pool
+        if self._client is None or self._pid != os.getpid():
+            self._client = redis.Redis.from_url(self.redis_url)
+            self._pid = os.getpid()
+            self._flusher = None
+        return self._client
+
+    def publish(self, job_id: str, status: str, progress: int, message: str,
+                output_url: Optional[str] = None, error: Optional[str] = None):
+        update = {
+            "job_id": job_id,
+            "status": status,
+            "progress": progress,
+            "message": message,
+            "output_url": output_url,
+            "error": error,
+            "ts": time.time(),
+        }
+
+        with self._lock:
+            self._pending[job_id] = update
+            due = (status in TERMINAL_STATUSES
+                   or time.monotonic() - self._last_sent.get(job_id, 0) >= self.interval)
+            if due:
+                self._pending.pop(job_id)
+                self._mark_sent(job_id, status)
+
+        if due:
+            self._send(update)
+        else:
+            self._ensure_flusher()
+
+    def publish_stats(self, job_id: str, stats: dict):
+        """Send the timing/CPU breakdown of one task of a job; never coalesced"""
+        self._send({"job_id": job_id, "stats": stats, "ts": time.time()})
+
+    def publish_profile(self, job_id: str, profile: dict):
+        """Report a profile of a job starting, finishing or failing; never coalesced"""
+        self._send({"job_id": job_id, "profile": profile, "ts": time.time()})
+
+    def flush(self):
+        """Send every coalesced update that is still waiting"""
+        with self._lock:
+            updates = list(self._pending.values())
+            self._pending.clear()
+            for update in updates:
+                self._mark_sent(update["job_id"], update["status"])
+        for update in updates:
+            self._send(update)
+
+    def _mark_sent(self, job_id: str, status: str):
+        # Called with self._lock held
+        if status in TERMINAL_STATUSES:
+            self._last_sent.pop(job_id, None)
+        else:
+            self._last_sent[job_id] = time.monotonic()
+
+    def _send(self, update: dict):
+        try:
+            self.client.xadd(
+                settings.progress_stream,
+                {"data": json.dumps(update)},
+                maxlen=settings.progress_stream_maxlen,
+                approximate=True,
+            )
+        except redis.RedisError as e:
+            logger.error(f"Failed to publish progress for job {update['job_id']}: {e}")
+
+    def _ensure_flusher(self):
+        self.client  # make sure the pid check has run
+        with self._lock:
+            if self._flusher and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="progress-flusher", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.interval / 2)
+            now = time.monotonic()
+            with self._lock:
+                ready = [update for job_id, update in self._pending.items()
+                         if now - self._last_sent.get(job_id, 0) >= self.interval]
+                for update in ready:
+                    self._pending.pop(update["job_id"], None)
+                    self._mark_sent(update["job_id"], update["status"])
+            for update in ready:
+                self._send(update)
+
+
+class ProgressConsumer:
+    """Reads worker updates from the Redis stream and applies them in the API.
+
+    With ``group`` set, the API replicas read through one consumer group so
+    each update is applied once, by whichever replica reads it first;
+    updates a replica read but never acknowledged are claimed by another
+    after ``progress_claim_idle`` seconds.
+    Without one, the id of the last update read is kept in Redis, so a
+    restarted API picks up what was published while it was down.
+    """
+
+    def __init__(self, apply_update: Callable[[dict], None], redis_url: Optional[str] = None,
+                 group: Optional[str] = None):
+        self.apply_update = apply_update
+        self.redis_url = redis_url or settings.progress_redis_url or settings.celery_broker_url
+        self.group = group
+        self._group_created = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_ts: Dict[str, float] = {}
+        self._touched: "OrderedDict[str, float]" = OrderedDict()  # job id -> when its last update arrived, oldest first
+        self._cursor_key = f"{settings.progress_stream}:last-read"
+        self._consumer = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="progress-consumer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+
+    def _read(self, client: redis.Redis, last_id):
+        if not self.group:
+            return client.xread({settings.progress_stream: last_id}, count=500, block=2000)
+        if not self._group_created:
+            # A new group starts where a single consumer left off, else from everything retained
+            start = client.get(self._cursor_key) or "0"
+            try:
+                client.xgroup_create(settings.progress_stream, self.group, id=start, mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):  # another replica created it
+                    raise
+            self._group_created = True
+        return client.xreadgroup(self.group, self._consumer, {settings.progress_stream: ">"}, count=500, block=2000)
+
+    def _claim_abandoned(self, client: redis.Redis) -> list:
+        """Take over updates another replica read but never acknowledged (it died in between)"""
+        min_idle = int(settings.progress_claim_idle * 1000)
+        claimed = []
+        start = "0-0"
+        while True:
+            result = client.xautoclaim(settings.progress_stream, self.group, self._consumer,
+                                       min_idle, start_id=start, count=500)
+            start, messages = result[0], result[1]
+            claimed += messages
+            if not messages or start in (b"0-0", "0-0"):
+                break
+        if claimed:
+            logger.info(f"Claimed {len(claimed)} progress updates left unacknowledged by another replica")
+        return [(settings.progress_stream, claimed)]
+
+    def _run(self):
+        client = redis.Redis.from_url(self.redis_url)
+        last_id = None
+        next_claim = 0.0
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                if last_id is None:
+                    # Resume where the last run stopped; the first run starts with new updates
+                    last_id = "$" if self.group else (client.get(self._cursor_key) or "$")
+                if self.group and self._group_created and time.monotonic() >= next_claim:
+                    next_claim = time.monotonic() + settings.progress_claim_idle / 2
+                    entries = self._claim_abandoned(client)
+                else:
+                    entries = self._read(client, last_id)
+                backoff = 1.0
+            except redis.RedisError as e:
+                logger.warning(f"Progress channel unavailable ({e}), retrying in {backoff:.0f}s")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+
+            for _, messages in entries or []:
+                for message_id, fields in messages:
+                    last_id = message_id
+                    if not fields:
+                        continue  # trimmed from the stream before it was claimed
+                    try:
+                        self._apply(json.loads(fields[b"data"]))
+                    except Exception as e:
+                        logger.error(f"Failed to apply progress update {message_id}: {e}")
+                if not messages:
+                    continue
+                try:
+                    if self.group:
+                        client.xack(settings.progress_stream, self.group, *[message_id for message_id, _ in messages])
+                    else:
+                        client.set(self._cursor_key, last_id)
+                except redis.RedisError as e:
+                    logger.warning(f"Could not acknowledge progress updates: {e}")
+
+    def _apply(self, update: dict):
+        if "status" not in update:
+            self.apply_update(update)  # stats and profiles apply in any order, even after completion
+            return
+        # A coalesced update can be flushed just after a newer terminal one; drop it
+        job_id = update["job_id"]
+        if update["ts"] < self._last_ts.get(job_id, 0):
+            return
+        if update["status"] in TERMINAL_STATUSES:
+            self._last_ts[job_id] = float("inf")
+        else:
+            self._last_ts[job_id] = update["ts"]
+        self._touched[job_id] = time.monotonic()
+        self._touched.move_to_end(job_id)
+        self._forget_idle()
+        self.apply_update(update)
+
+    def _forget_idle(self):
+        """Drop jobs without updates for DEDUPE_WINDOW_SECONDS; the status guard in the API covers anything later"""
+        cutoff = time.monotonic() - DEDUPE_WINDOW_SECONDS
+        while self._touched:
+            job_id, touched_at = next(iter(self._touched.items()))
+            if touched_at > cutoff:
+                break
+            self._touched.popitem(last=False)
+            self._last_ts.pop(job_id, None)
+
+
+progress_publisher = ProgressPublisher()
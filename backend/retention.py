@@ -0,0 +1,314 @@
+"""Retention policies and garbage collection for jobs, outputs and scratch data"""
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+from checkpoint import JobCheckpoint, list_checkpoints
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Top-level files the API writes into STORAGE_PATH: "<job_id>.mp4" outputs and
+# the temporary audio tracks MoviePy leaves next to an output when encoding dies.
+OUTPUT_FILE_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}.*\.mp4$")
+
+
+def _utc_timestamp(value: Optional[str]) -> Optional[float]:
+    """Epoch seconds of a naive ``datetime.utcnow().isoformat()`` job timestamp"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def path_size(path: str) -> int:
+    if os.path.isdir(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove_path(path: str) -> int:
+    """Delete a file or directory tree and return the bytes released"""
+    size = path_size(path)
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logger.warning(f"Failed to remove {path}: {e}")
+        return 0
+    return size
+
+
+class RetentionManager:
+    """Background reclaimer keeping job records, outputs and scratch data bounded.
+
+    Each pass:
+    1. drops terminal jobs (and their outputs) older than the TTL for their status,
+    2. deletes partial outputs left behind by failed or cancelled jobs,
+    3. evicts completed outputs by least-recent download while the output
+       directory is above ``storage_budget_bytes``,
+    4. sweeps orphaned outputs, stale scratch files and abandoned checkpoints,
+    5. hands Drive uploads pending longer than ``gdrive_pending_timeout`` to
+       ``on_stale_upload``, which returns whether it retried or failed them.
+    """
+
+    def __init__(self, jobs: Dict[str, dict], batches: Dict[str, dict], output_dir: str, scratch_dir: Optional[str] = None,
+                 on_stale_upload: Optional[Callable[[dict], bool]] = None):
+        self.jobs = jobs
+        self.on_stale_upload = on_stale_upload
+        self.batches = batches
+        self.output_dir = output_dir
+        self.scratch_dir = scratch_dir or settings.scratch_path
+        self.ttls = {
+            "completed": settings.retention_completed_ttl,
+            "failed": settings.retention_failed_ttl,
+            "cancelled": settings.retention_cancelled_ttl,
+        }
+        self.last_report: Optional[dict] = None
+        self.totals = {"passes": 0, "jobs_removed": 0, "files_removed": 0, "bytes_reclaimed": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread or settings.retention_interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        logger.info(f"Retention reclaimer started (every {settings.retention_interval}s)")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(settings.retention_interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Retention pass failed: {e}")
+
+    def run_once(self) -> dict:
+        """Run a single reclaim pass and return its report"""
+        with self._lock:
+            started = time.time()
+            report = {
+                "started_at": datetime.utcnow().isoformat(),
+                "jobs_removed": 0,
+                "outputs_evicted": 0,
+                "partials_removed": 0,
+                "orphans_removed": 0,
+                "scratch_removed": 0,
+                "checkpoints_removed": 0,
+                "stale_uploads": 0,
+                "bytes_reclaimed": 0,
+            }
+
+            self._expire_jobs(report, started)
+            self._evict_over_budget(report)
+            self._sweep_orphans(report, started)
+            self._sweep_scratch(report, started)
+            self._sweep_checkpoints(report, started)
+            self._expire_uploads(report, started)
+
+            report["duration_seconds"] = round(time.time() - started, 3)
+            files_removed = (report["outputs_evicted"] + report["partials_removed"]
+                             + report["orphans_removed"] + report["scratch_removed"]
+                             + report["checkpoints_removed"])
+            self.totals["passes"] += 1
+            self.totals["jobs_removed"] += report["jobs_removed"]
+            self.totals["files_removed"] += files_removed
+            self.totals["bytes_reclaimed"] += report["bytes_reclaimed"]
+            self.last_report = report
+
+            if report["jobs_removed"] or files_removed:
+                logger.info(
+                    f"Retention reclaimed {report['bytes_reclaimed']} bytes, "
+                    f"{report['jobs_removed']} jobs, {files_removed} files"
+                )
+            return report
+
+    def status(self) -> dict:
+        return {
+            "ttls": self.ttls,
+            "storage_budget_bytes": settings.storage_budget_bytes,
+            "output_bytes": sum(size for _, _, size in self._output_files()),
+            "jobs": len(self.jobs),
+            "last_report": self.last_report,
+            "totals": self.totals,
+        }
+
+    def _output_path(self, job: dict) -> str:
+        output_file = job.get("output_file") or f"{job['job_id']}.mp4"
+        return os.path.join(self.output_dir, output_file)
+
+    def _expire_jobs(self, report: dict, now: float):
+        for job_id, job in list(self.jobs.items()):
+            status = job.get("status")
+            ttl = self.ttls.get(status)
+            if ttl is None:
+                continue  # pending/processing jobs are never reclaimed
+
+            # Failed or cancelled jobs can leave a half-written output behind
+            if status != "completed":
+                path = self._output_path(job)
+                if os.path.exists(path):
+                    report["bytes_reclaimed"] += _remove_path(path)
+                    report["partials_removed"] += 1
+
+            finished = _utc_timestamp(job.get("completed_at")) or _utc_timestamp(job.get("created_at"))
+            if finished is None or now - finished < ttl:
+                continue
+
+            for path in (self._output_path(job), os.path.join(self.output_dir, "profiles", job_id)):
+                if os.path.exists(path):
+                    report["bytes_reclaimed"] += _remove_path(path)
+            self.jobs.pop(job_id, None)
+            report["jobs_removed"] += 1
+            self._forget_batch_job(job.get("batch_id"), job_id)
+
+    def _expire_uploads(self, report: dict, now: float):
+        timeout = settings.gdrive_pending_timeout
+        if not self.on_stale_upload or timeout <= 0:
+            return
+        for job in list(self.jobs.values()):
+            if job.get("gdrive_status") != "pending":
+                continue
+            queued = _utc_timestamp(job.get("gdrive_requeued_at")) or _utc_timestamp(job.get("completed_at"))
+            if queued is None or now - queued < timeout:
+                continue
+            try:
+                if self.on_stale_upload(job):
+                    report["stale_uploads"] += 1
+            except Exception as e:
+                logger.error(f"Failed to resolve stale Drive upload of job {job.get('job_id')}: {e}")
+
+    def _forget_batch_job(self, batch_id: Optional[str], job_id: str):
+        batch = self.batches.get(batch_id)
+        if not batch:
+            return
+        if job_id in batch["job_ids"]:
+            batch["job_ids"] = [other for other in batch["job_ids"] if other != job_id]
+        if not batch["job_ids"]:
+            self.batches.pop(batch_id, None)
+
+    def _output_files(self) -> List[tuple]:
+        """(name, mtime, size) of every job output file in the output directory"""
+        files = []
+        try:
+            entries = list(os.scandir(self.output_dir))
+        except FileNotFoundError:
+            return files
+        for entry in entries:
+            if entry.is_file() and OUTPUT_FILE_RE.match(entry.name):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((entry.name, stat.st_mtime, stat.st_size))
+        return files
+
+    def _evict_over_budget(self, report: dict):
+        budget = settings.storage_budget_bytes
+        if budget <= 0:
+            return
+        used = sum(size for _, _, size in self._output_files())
+        if used <= budget:
+            return
+
+        # Least recently downloaded first; never-downloaded outputs age from completion
+        candidates = []
+        for job in list(self.jobs.values()):
+            if job.get("status") != "completed" or not job.get("output_file"):
+                continue
+            if job.get("gdrive_status") == "pending":
+                continue  # still being uploaded to Drive
+            last_used = (_utc_timestamp(job.get("last_downloaded_at"))
+                         or _utc_timestamp(job.get("completed_at")) or 0)
+            candidates.append((last_used, job))
+        candidates.sort(key=lambda item: item[0])
+
+        for _, job in candidates:
+            if used <= budget:
+                break
+            path = self._output_path(job)
+            if not os.path.exists(path):
+                continue  # already gone, or kept on another node or in object storage
+            freed = _remove_path(path)
+            if freed <= 0:
+                continue
+            used -= freed
+            report["bytes_reclaimed"] += freed
+            report["outputs_evicted"] += 1
+            job.pop("output_file", None)
+            job["output_evicted_at"] = datetime.utcnow().isoformat()
+            logger.info(f"Evicted output of job {job['job_id']} ({freed} bytes) to stay under storage budget")
+
+    def _sweep_orphans(self, report: dict, now: float):
+        jobs = list(self.jobs.values())
+        referenced = {job.get("output_file") for job in jobs}
+        # Running jobs write "<job_id>.mp4" plus encoder temp files sharing that prefix
+        active_ids = tuple(job["job_id"] for job in jobs if job.get("status") not in self.ttls)
+        for name, mtime, _ in self._output_files():
+            if name in referenced or (active_ids and name.startswith(active_ids)):
+                continue
+            if now - mtime < settings.orphan_grace_period:
+                continue
+            report["bytes_reclaimed"] += _remove_path(os.path.join(self.output_dir, name))
+            report["orphans_removed"] += 1
+
+    def _sweep_scratch(self, report: dict, now: float):
+        if not self.scratch_dir or not os.path.isdir(self.scratch_dir):
+            return
+        for entry in list(os.scandir(self.scratch_dir)):
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if now - mtime < settings.scratch_ttl:
+                continue
+            report["bytes_reclaimed"] += _remove_path(entry.path)
+            report["scratch_removed"] += 1
+
+    def _sweep_checkpoints(self, report: dict, now: float):
+        for job_id in list_checkpoints():
+            job = self.jobs.get(job_id)
+            if job and job.get("status") not in self.ttls:
+                continue  # still pending or running here
+            checkpoint_dir = os.path.join(settings.checkpoint_path, job_id)
+            try:
+                mtime = os.path.getmtime(checkpoint_dir)
+            except FileNotFoundError:
+                continue
+            if now - mtime < settings.checkpoint_ttl:
+                continue
+            checkpoint = JobCheckpoint(job_id)
+            if not checkpoint.acquire():
+                continue  # a live process is still working on it
+            report["bytes_reclaimed"] += checkpoint.footprint()
+            checkpoint.discard()
+            report["checkpoints_removed"] += 1
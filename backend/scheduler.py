@@ -0,0 +1,180 @@
+"""Weighted fair-share job scheduling across tenants (spreadsheets or users)"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from admission import Footprint, memory_admission
+from config import settings
+from metrics import JOBS_QUEUED, JOBS_RUNNING, QUEUE_WAIT
+
+logger = logging.getLogger(__name__)
+
+# start(job_id) launches a job and returns quickly; the slot stays taken until release(job_id)
+StartJob = Callable[[str], None]
+
+
+class TenantQueue:
+    def __init__(self, name: str):
+        self.name = name
+        self.jobs: Deque[Tuple[str, float, StartJob, Footprint]] = deque()
+        self.running: Dict[str, float] = {}
+        self.vtime = 0.0
+        self.started = 0
+        self.avg_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def weight(self) -> float:
+        return max(float(settings.tenant_weights.get(self.name, 1.0)), 0.01)
+
+    @property
+    def max_running(self) -> int:
+        return int(settings.tenant_max_running.get(self.name, settings.tenant_default_max_running))
+
+
+class FairScheduler:
+    """Starts queued jobs in weighted fair order instead of first come, first served.
+
+    Every tenant has a virtual clock that advances by ``1 / weight`` each
+    time one of its jobs starts; the next job comes from the eligible tenant
+    with the earliest clock, so a tenant with weight 2 gets twice the starts
+    of a tenant with weight 1 while both have work queued. A tenant that was
+    idle rejoins at the clock of the last started job, so it goes next but
+    does not bank credit for the time it had nothing queued.
+    A job starts only when its estimated peak memory fits what the memory
+    admission budget has left; the tenant whose turn it is keeps it, so big
+    jobs wait for room instead of being overtaken forever. At most
+    ``max_running`` jobs per tenant run at once, and optionally at most
+    ``scheduler_max_running`` in total.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._tenants: Dict[str, TenantQueue] = {}
+        self._job_tenant: Dict[str, str] = {}
+        self._vclock = 0.0  # virtual start time of the last started job
+
+    def submit(self, tenant: str, job_id: str, start: StartJob, footprint: Footprint = (0, "compose")):
+        with self._lock:
+            queue = self._tenants.get(tenant)
+            if queue is None:
+                queue = self._tenants[tenant] = TenantQueue(tenant)
+            if not queue.jobs and not queue.running:
+                queue.vtime = max(queue.vtime, self._vclock)
+            queue.jobs.append((job_id, time.monotonic(), start, footprint))
+            self._job_tenant[job_id] = tenant
+        JOBS_QUEUED.inc()
+        self._ensure_started()
+        self._wakeup.set()
+
+    def release(self, job_id: str):
+        """Free a running job's slot, or drop it from its queue; safe to call twice"""
+        with self._lock:
+            tenant = self._job_tenant.pop(job_id, None)
+            queue = self._tenants.get(tenant)
+            if queue is None:
+                return
+            if queue.running.pop(job_id, None) is None:
+                queue.jobs = deque(entry for entry in queue.jobs if entry[0] != job_id)
+                JOBS_QUEUED.dec()
+            else:
+                JOBS_RUNNING.dec()
+        memory_admission.release(job_id)
+        self._wakeup.set()
+
+    def queued(self) -> int:
+        """Jobs submitted here and not yet started"""
+        with self._lock:
+            return sum(len(queue.jobs) for queue in self._tenants.values())
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            tenants = {
+                name: {
+                    "weight": queue.weight,
+                    "max_running": queue.max_running,
+                    "queued": len(queue.jobs),
+                    "running": len(queue.running),
+                    "started": queue.started,
+                    "oldest_wait_seconds": round(now - queue.jobs[0][1], 1) if queue.jobs else 0.0,
+                    "avg_wait_seconds": round(queue.avg_wait, 1),
+                    "max_wait_seconds": round(queue.max_wait, 1),
+                }
+                for name, queue in self._tenants.items()
+            }
+            return {
+                "max_running": settings.scheduler_max_running or None,
+                "memory": memory_admission.status(),
+                "running": sum(len(queue.running) for queue in self._tenants.values()),
+                "queued": sum(len(queue.jobs) for queue in self._tenants.values()),
+                "tenants": tenants,
+            }
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="job-scheduler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(1.0)
+            self._wakeup.clear()
+            while not self._stop.is_set():
+                picked = self._pick()
+                if picked is None:
+                    break
+                job_id, start = picked
+                try:
+                    start(job_id)
+                except Exception as e:
+                    logger.error(f"Failed to start job {job_id}: {e}")
+                    self.release(job_id)
+
+    def _pick(self) -> Optional[Tuple[str, StartJob]]:
+        now = time.monotonic()
+        with self._lock:
+            running = sum(len(queue.running) for queue in self._tenants.values())
+            if settings.scheduler_max_running and running >= settings.scheduler_max_running:
+                return None
+            eligible = [queue for queue in self._tenants.values()
+                        if queue.jobs and len(queue.running) < queue.max_running]
+            if not eligible:
+                return None
+            queue = min(eligible, key=lambda q: q.vtime)
+            footprint = queue.jobs[0][3]
+            if not memory_admission.fits(footprint):
+                return None  # wait for running jobs to free memory
+            job_id, queued_at, start, _ = queue.jobs.popleft()
+            memory_admission.reserve(job_id, footprint)
+            queue.running[job_id] = now
+            self._vclock = queue.vtime
+            queue.vtime += 1.0 / queue.weight
+            queue.started += 1
+            wait = now - queued_at
+            queue.avg_wait = wait if queue.started == 1 else 0.9 * queue.avg_wait + 0.1 * wait
+            queue.max_wait = max(queue.max_wait, wait)
+        JOBS_QUEUED.dec()
+        JOBS_RUNNING.inc()
+        QUEUE_WAIT.observe(wait)
+        logger.info(f"Starting job {job_id} for tenant {queue.name} after {wait:.1f}s in queue "
+                    f"(~{footprint[0] // (1024 * 1024)}MB)")
+        return job_id, start
+
+
+job_scheduler = FairScheduler()
@@ -2,6 +2,7 @@ import subprocess
 import os
 import logging
 from typing import List, Dict, Optional, Callable
+from cancellation import CancelToken, bind_token
 
 logger = logging.getLogger(__name__)
 
@@ -17,9 +18,20 @@ class SimpleVideoProcessor:
         media_files: List[Dict],
         output_path: str,
         output_settings: Dict,
-        progress_callback: Optional[Callable[[int, str], None]] = None
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_token: Optional[CancelToken] = None
     ):
         """Process videos using ffmpeg directly"""
+        with bind_token(cancel_token):
+            self._process_media_files(media_files, output_path, output_settings, progress_callback)
+    
+    def _process_media_files(
+        self,
+        media_files: List[Dict],
+        output_path: str,
+        output_settings: Dict,
+        progress_callback: Optional[Callable[[int, str], None]]
+    ):
         try:
             if progress_callback:
                 progress_callback(10, "Starting video processing...")
@@ -1,16 +1,30 @@
 import os
+import io
+import asyncio
+import hashlib
+import shutil
+import threading
 import aiofiles
 import httpx
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from typing import BinaryIO, Dict, List, Optional, Union
 import boto3
+from boto3.s3.transfer import TransferConfig
 from minio import Minio
 from config import settings
+from origin_guard import origin_guard
+from metrics import BYTES_DOWNLOADED, BYTES_UPLOADED, stage_timer
 import logging
 import json
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# boto3, minio and large local copies block; they run here instead of on the event loop
+_io_pool = ThreadPoolExecutor(max_workers=settings.storage_io_workers, thread_name_prefix="storage-io")
+
 class StorageManager:
     def __init__(self):
         self.backend = settings.storage_backend
@@ -23,12 +37,19 @@ class StorageManager:
                 aws_secret_access_key=settings.s3_secret_key,
                 region_name=settings.s3_region
             )
+            # Large objects go up as parallel multipart parts read straight from disk
+            self.transfer_config = TransferConfig(
+                multipart_threshold=settings.storage_multipart_threshold,
+                multipart_chunksize=settings.storage_part_size,
+                max_concurrency=settings.storage_upload_concurrency
+            )
         elif self.backend == "minio":
             self.minio_client = Minio(
                 settings.s3_endpoint.replace("http://", "").replace("https://", ""),
                 access_key=settings.s3_access_key,
                 secret_key=settings.s3_secret_key,
-                secure=settings.s3_endpoint.startswith("https")
+                secure=settings.s3_endpoint.startswith("https"),
+                region=settings.s3_region  # lets presigning skip a region lookup
             )
             # Ensure bucket exists
             if not self.minio_client.bucket_exists(settings.s3_bucket):
@@ -36,47 +57,119 @@ class StorageManager:
         else:  # local storage
             os.makedirs(settings.storage_path, exist_ok=True)
     
-    async def save_file(self, key: str, content: bytes) -> str:
-        """Save file and return URL"""
+    async def run_blocking(self, func, *args, **kwargs):
+        """Run a blocking storage call on the storage I/O pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_io_pool, partial(func, *args, **kwargs))
+    
+    async def save_file(self, key: str, content: Union[bytes, str, BinaryIO]) -> str:
+        """Save file and return URL.
+
+        ``content`` is bytes, a local file path or a binary stream. Paths and
+        streams are copied in chunks, and on S3/MinIO objects larger than a
+        part are uploaded as parallel multipart parts, so memory use does not
+        grow with the size of the object.
+        """
+        return await self.run_blocking(self._save_file, key, content)
+    
+    def _save_file(self, key: str, content: Union[bytes, str, BinaryIO]) -> str:
+        with stage_timer("upload"):
+            url = self._write_object(key, content)
+        if isinstance(content, bytes):
+            BYTES_UPLOADED.labels(self.backend).inc(len(content))
+        elif isinstance(content, str):
+            BYTES_UPLOADED.labels(self.backend).inc(os.path.getsize(content))
+        return url
+    
+    def _write_object(self, key: str, content: Union[bytes, str, BinaryIO]) -> str:
         if self.backend == "local":
             file_path = os.path.join(settings.storage_path, key)
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
             
-            async with aiofiles.open(file_path, 'wb') as f:
-                await f.write(content)
+            if isinstance(content, str):
+                shutil.copyfile(content, file_path)
+            elif isinstance(content, bytes):
+                with open(file_path, 'wb') as f:
+                    f.write(content)
+            else:
+                with open(file_path, 'wb') as f:
+                    shutil.copyfileobj(content, f, settings.storage_part_size)
             
             return f"/storage/{key}"
         
         elif self.backend == "s3":
-            self.s3_client.put_object(
-                Bucket=settings.s3_bucket,
-                Key=key,
-                Body=content
-            )
+            if isinstance(content, str):
+                self.s3_client.upload_file(content, settings.s3_bucket, key, Config=self.transfer_config)
+            else:
+                if isinstance(content, bytes):
+                    content = io.BytesIO(content)
+                self.s3_client.upload_fileobj(content, settings.s3_bucket, key, Config=self.transfer_config)
             return f"s3://{settings.s3_bucket}/{key}"
         
         elif self.backend == "minio":
-            import io
-            self.minio_client.put_object(
-                settings.s3_bucket,
-                key,
-                io.BytesIO(content),
-                len(content)
-            )
+            upload_options = {
+                "part_size": settings.storage_part_size,
+                "num_parallel_uploads": settings.storage_upload_concurrency
+            }
+            if isinstance(content, str):
+                self.minio_client.fput_object(settings.s3_bucket, key, content, **upload_options)
+            elif isinstance(content, bytes):
+                self.minio_client.put_object(settings.s3_bucket, key, io.BytesIO(content), len(content), **upload_options)
+            else:
+                # Unknown length: MinIO streams it part by part
+                self.minio_client.put_object(settings.s3_bucket, key, content, -1, **upload_options)
             return f"minio://{settings.s3_bucket}/{key}"
     
+    async def delete_file(self, url: str):
+        """Delete a file previously returned by save_file"""
+        await self.run_blocking(self._delete_file, url)
+    
+    def _delete_file(self, url: str):
+        if url.startswith("/storage/"):
+            path = self.get_file_path(url)
+            if os.path.exists(path):
+                os.remove(path)
+        
+        elif url.startswith("s3://"):
+            bucket, key = url[5:].split("/", 1)
+            self.s3_client.delete_object(Bucket=bucket, Key=key)
+        
+        elif url.startswith("minio://"):
+            bucket, key = url[8:].split("/", 1)
+            self.minio_client.remove_object(bucket, key)
+    
+    def presigned_url(self, url: str, expires: Optional[int] = None) -> Optional[str]:
+        """Short-lived GET URL for an S3/MinIO object; None for local files"""
+        expires = expires or settings.presigned_url_ttl
+        if url.startswith("s3://"):
+            bucket, key = url[5:].split("/", 1)
+            return self.s3_client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": bucket, "Key": key},
+                ExpiresIn=expires
+            )
+        elif url.startswith("minio://"):
+            bucket, key = url[8:].split("/", 1)
+            return self.minio_client.presigned_get_object(bucket, key, expires=timedelta(seconds=expires))
+        return None
+    
     def get_file_path(self, url: str) -> str:
         """Get local file path from URL"""
         if url.startswith("/storage/"):
             return os.path.join(settings.storage_path, url[9:])
         return url
     
-    async def download_file(self, url: str, destination: str) -> str:
+    async def download_file(self, url: str, destination: str, expected_sha256: Optional[str] = None) -> str:
         """Download file from URL to local path"""
+        if url.startswith(("/storage/", "s3://", "minio://")):
+            return await self.run_blocking(self._download_object, url, destination)
+        # External URL
+        return await self._download_url(url, destination, expected_sha256)
+    
+    def _download_object(self, url: str, destination: str) -> str:
         if url.startswith("/storage/"):
             # Local file
             source = self.get_file_path(url)
-            import shutil
             shutil.copy2(source, destination)
             return destination
         
@@ -88,111 +181,227 @@ class StorageManager:
             self.s3_client.download_file(bucket, key, destination)
             return destination
         
-        elif url.startswith("minio://"):
+        else:
             # MinIO file
             parts = url[8:].split("/", 1)
             bucket = parts[0]
             key = parts[1]
             self.minio_client.fget_object(bucket, key, destination)
             return destination
+    
+    async def _download_url(self, url: str, destination: str, expected_sha256: Optional[str] = None) -> str:
+        """Stream an external URL to disk one chunk at a time.
+
+        ``max_file_size`` is enforced from Content-Length before the body is
+        read and again while bytes arrive. With ``expected_sha256`` (a media
+        item's ``sha256``) the content is hashed on the way through and
+        checked. The file only appears at ``destination`` once it is
+        complete and verified.
+        """
+        digest = hashlib.sha256() if expected_sha256 else None
+        received = 0
+        tmp_path = destination + ".part"
+        try:
+            await self.run_blocking(origin_guard.acquire, url)
+            try:
+                async with httpx.AsyncClient(follow_redirects=True, timeout=httpx.Timeout(60.0, connect=10.0)) as client:
+                    async with client.stream("GET", url) as response:
+                        origin_guard.record(url, response.status_code, response.headers.get("retry-after"))
+                        response.raise_for_status()
+                        
+                        content_length = response.headers.get("content-length", "")
+                        if content_length.isdigit() and int(content_length) > settings.max_file_size:
+                            raise ValueError(f"File too large: {content_length} bytes exceeds {settings.max_file_size}")
+                        
+                        async with aiofiles.open(tmp_path, 'wb') as f:
+                            async for chunk in response.aiter_bytes(settings.download_chunk_size):
+                                received += len(chunk)
+                                if received > settings.max_file_size:
+                                    raise ValueError(f"File too large: exceeds {settings.max_file_size} bytes")
+                                if digest is not None:
+                                    digest.update(chunk)
+                                await f.write(chunk)
+                                BYTES_DOWNLOADED.inc(len(chunk))
+            except httpx.TransportError:
+                origin_guard.record(url)
+                raise
+            
+            if digest is not None and digest.hexdigest() != expected_sha256.lower():
+                raise ValueError(f"Checksum mismatch for {url}: expected {expected_sha256}, got {digest.hexdigest()}")
+            os.replace(tmp_path, destination)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
         
-        else:
-            # External URL
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, follow_redirects=True)
-                response.raise_for_status()
-                
-                async with aiofiles.open(destination, 'wb') as f:
-                    await f.write(response.content)
-                
-                return destination
+        logger.info(f"Downloaded {received} bytes from {url}")
+        return destination
 
 
 class GoogleDriveStorage:
-    """Google Drive storage handler for uploading processed videos"""
+    """Google Drive storage handler for uploading processed videos.
+
+    Credentials and the discovery client are built once and shared; each
+    thread gets its own authorized HTTP connection (httplib2 is not thread
+    safe) while reusing the same access token until it expires.
+    """
+    
+    SCOPES = ['https://www.googleapis.com/auth/drive.file']
     
     def __init__(self, credentials_path: Optional[str] = None):
         self.credentials_path = credentials_path or os.getenv("GOOGLE_DRIVE_CREDENTIALS")
         self.credentials_json = os.getenv("GOOGLE_DRIVE_CREDENTIALS_JSON")
         self.folder_id = os.getenv("GOOGLE_DRIVE_FOLDER_ID")  # Target folder ID
         self.service = None
+        self.credentials = None
+        self._auth_lock = threading.Lock()
+        self._local = threading.local()
+    
+    @property
+    def configured(self) -> bool:
+        return bool(self.credentials_json or (self.credentials_path and os.path.exists(self.credentials_path)))
         
     def authenticate(self):
         """Authenticate with Google Drive API"""
-        try:
-            # Try JSON string from environment variable first
-            if self.credentials_json:
-                logger.info("Using Google Drive credentials from environment variable")
-                credentials_info = json.loads(self.credentials_json)
-            elif self.credentials_path and os.path.exists(self.credentials_path):
-                logger.info("Using Google Drive credentials from file")
-                with open(self.credentials_path, 'r') as f:
-                    credentials_info = json.load(f)
-            else:
-                logger.warning("Google Drive credentials not found, upload will be skipped")
+        with self._auth_lock:
+            if self.service:
+                return True
+            try:
+                # Try JSON string from environment variable first
+                if self.credentials_json:
+                    logger.info("Using Google Drive credentials from environment variable")
+                    credentials_info = json.loads(self.credentials_json)
+                elif self.credentials_path and os.path.exists(self.credentials_path):
+                    logger.info("Using Google Drive credentials from file")
+                    with open(self.credentials_path, 'r') as f:
+                        credentials_info = json.load(f)
+                else:
+                    logger.warning("Google Drive credentials not found, upload will be skipped")
+                    return False
+                
+                from google.oauth2 import service_account
+                self.credentials = service_account.Credentials.from_service_account_info(
+                    credentials_info,
+                    scopes=self.SCOPES
+                )
+                
+                from googleapiclient.discovery import build, build_from_document
+                from googleapiclient.discovery_cache import get_static_doc
+                if settings.gdrive_api_endpoint:
+                    # Point API, media upload and batch URLs at another server (e.g. a local fake Drive)
+                    document = json.loads(get_static_doc('drive', 'v3'))
+                    document["rootUrl"] = settings.gdrive_api_endpoint.rstrip("/") + "/"
+                    document["baseUrl"] = document["rootUrl"] + document["servicePath"]
+                    self.service = build_from_document(document, credentials=self.credentials)
+                else:
+                    self.service = build('drive', 'v3', credentials=self.credentials, static_discovery=True)
+                return True
+                
+            except Exception as e:
+                logger.error(f"Failed to authenticate with Google Drive: {e}")
                 return False
-            
-            from google.oauth2 import service_account
-            credentials = service_account.Credentials.from_service_account_info(
-                credentials_info,
-                scopes=['https://www.googleapis.com/auth/drive.file']
-            )
-            
-            from googleapiclient.discovery import build
-            self.service = build('drive', 'v3', credentials=credentials)
-            return True
-            
-        except Exception as e:
-            logger.error(f"Failed to authenticate with Google Drive: {e}")
-            return False
+    
+    def _http(self):
+        """This thread's authorized connection"""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            base_http = httplib2.Http(timeout=settings.gdrive_timeout)
+            # Resumable uploads answer 308 per chunk; it is not a redirect here
+            base_http.redirect_codes = base_http.redirect_codes - {308}
+            http = AuthorizedHttp(self.credentials, http=base_http)
+            self._local.http = http
+        return http
+    
+    def upload_file(self, file_path: str, filename: str) -> str:
+        """Resumable upload in ``gdrive_chunk_size`` chunks; returns the file id"""
+        if not self.authenticate():
+            raise RuntimeError("Google Drive is not configured")
+        
+        from googleapiclient.http import MediaFileUpload
+        
+        # File metadata
+        file_metadata = {
+            'name': filename,
+            'parents': [self.folder_id] if self.folder_id else []
+        }
+        media = MediaFileUpload(
+            file_path,
+            mimetype='video/mp4',
+            chunksize=settings.gdrive_chunk_size,
+            resumable=True
+        )
+        request = self.service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id'
+        )
+        
+        response = None
+        while response is None:
+            _, response = request.next_chunk(http=self._http(), num_retries=3)
+        return response['id']
+    
+    def share_files(self, file_ids: List[str]) -> Dict[str, Optional[str]]:
+        """Make files readable by anyone with the link, batching the permission calls.
+
+        Returns the error message per file id (None on success).
+        """
+        if not self.authenticate():
+            raise RuntimeError("Google Drive is not configured")
+        
+        errors: Dict[str, Optional[str]] = {}
+        
+        def on_response(request_id, response, exception):
+            errors[request_id] = str(exception) if exception else None
+        
+        # The Drive batch endpoint takes at most 100 calls per request
+        for offset in range(0, len(file_ids), 100):
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for file_id in file_ids[offset:offset + 100]:
+                batch.add(
+                    self.service.permissions().create(
+                        fileId=file_id,
+                        body={'type': 'anyone', 'role': 'reader'},
+                        fields='id'
+                    ),
+                    request_id=file_id
+                )
+            batch.execute(http=self._http())
+        return errors
+    
+    @staticmethod
+    def shareable_url(file_id: str) -> str:
+        return f"https://drive.google.com/file/d/{file_id}/view?usp=drive_link"
     
     def upload_video(self, file_path: str, filename: str) -> Optional[str]:
         """Upload video to Google Drive and return shareable URL"""
-        if not self.service and not self.authenticate():
+        if not self.authenticate():
             return None
             
         try:
-            from googleapiclient.http import MediaFileUpload
-            
-            # File metadata
-            file_metadata = {
-                'name': filename,
-                'parents': [self.folder_id] if self.folder_id else []
-            }
-            
-            # Media upload
-            media = MediaFileUpload(
-                file_path,
-                mimetype='video/mp4',
-                resumable=True
-            )
-            
-            # Upload file
-            file = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
-            
-            file_id = file.get('id')
+            file_id = self.upload_file(file_path, filename)
+            error = self.share_files([file_id]).get(file_id)
+            if error:
+                raise RuntimeError(error)
             
-            # Make file shareable (anyone with link can view)
-            permission = {
-                'type': 'anyone',
-                'role': 'reader'
-            }
-            
-            self.service.permissions().create(
-                fileId=file_id,
-                body=permission
-            ).execute()
-            
-            # Return shareable URL
-            shareable_url = f"https://drive.google.com/file/d/{file_id}/view?usp=drive_link"
+            shareable_url = self.shareable_url(file_id)
             logger.info(f"Successfully uploaded {filename} to Google Drive: {shareable_url}")
-            
             return shareable_url
             
         except Exception as e:
             logger.error(f"Failed to upload {filename} to Google Drive: {e}")
-            return None
\ No newline at end of file
+            return None
+
+
+_drive_storage: Optional[GoogleDriveStorage] = None
+_drive_storage_lock = threading.Lock()
+
+def get_drive_storage() -> GoogleDriveStorage:
+    """Process-wide Drive client, so credentials and tokens are reused across jobs"""
+    global _drive_storage
+    with _drive_storage_lock:
+        if _drive_storage is None:
+            _drive_storage = GoogleDriveStorage()
+        return _drive_storage
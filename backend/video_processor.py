@@ -6,15 +6,26 @@ import PIL.Image
 if not hasattr(PIL.Image, 'ANTIALIAS'):
     PIL.Image.ANTIALIAS = PIL.Image.LANCZOS
 
-from moviepy.editor import VideoFileClip, ImageClip, concatenate_videoclips
+from moviepy.editor import VideoFileClip, ImageClip, AudioClip, concatenate_videoclips
+from imageio_ffmpeg import get_ffmpeg_exe
 from PIL import Image
 import numpy as np
+import itertools
 import logging
 import requests
+import shutil
+import subprocess
 import tempfile
 import time
 from urllib.parse import urlparse
 from pathlib import Path
+from config import settings
+from cancellation import CancelToken, JobCancelled, bind_token
+from checkpoint import JobCheckpoint
+from downloader import RangeNotSupported, download_ranges, get_session, looks_like_html, supports_ranges
+from origin_guard import PERMANENT_STATUSES, THROTTLE_STATUSES, origin_guard
+from metrics import BYTES_DOWNLOADED, ENCODE_FPS, record_cache, stage_timer
+from job_stats import record_bytes
 
 logger = logging.getLogger(__name__)
 
@@ -22,7 +33,8 @@ class VideoProcessor:
     def __init__(self):
         self.supported_video_extensions = {'.mp4', '.avi', '.mov', '.mkv', '.flv', '.wmv', '.webm'}
         self.supported_image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff'}
-        self.temp_dir = tempfile.gettempdir()
+        self.temp_dir = settings.scratch_path
+        os.makedirs(self.temp_dir, exist_ok=True)
     
     def detect_media_type(self, file_path: str) -> str:
         """Detect if file is video or image based on extension"""
@@ -130,8 +142,16 @@ class VideoProcessor:
                 return url
         return url
 
-    def download_file(self, url: str, output_path: str) -> str:
+    def download_file(self, url: str, output_path: str, cancel_token: Optional[CancelToken] = None) -> str:
         """Download file from URL with improved error handling"""
+        cancel_callbacks = []
+        
+        def close_on_cancel(response):
+            # Closing the response interrupts a blocked socket read immediately
+            if cancel_token:
+                cancel_callbacks.append(cancel_token.add_callback(response.close))
+            return response
+        
         try:
             # Convert Google Drive URLs to direct download format
             original_url = url
@@ -152,27 +172,8 @@ class VideoProcessor:
                 'Accept-Encoding': 'identity',  # Avoid compression issues
                 'Cache-Control': 'no-cache',
                 'Pragma': 'no-cache',
-                'Connection': 'keep-alive',
             }
             
-            # First, check with HEAD request
-            session = requests.Session()
-            session.headers.update(headers)
-            
-            try:
-                head_response = session.head(url, timeout=30, allow_redirects=True)
-                logger.info(f"HEAD request status: {head_response.status_code}")
-                logger.info(f"HEAD final URL: {head_response.url}")
-                logger.info(f"HEAD Content-Type: {head_response.headers.get('content-type', 'N/A')}")
-                logger.info(f"HEAD Content-Length: {head_response.headers.get('content-length', 'N/A')}")
-                
-                content_type = head_response.headers.get('content-type', '')
-                if 'text/html' in content_type.lower():
-                    raise Exception(f"URL returns HTML page (Content-Type: {content_type})")
-                    
-            except Exception as e:
-                logger.warning(f"HEAD request failed: {e}, proceeding with GET")
-            
             # Special handling for specific domains
             if 'test-videos.co.uk' in parsed_url.netloc:
                 headers['Referer'] = 'https://test-videos.co.uk/'
@@ -187,17 +188,19 @@ class VideoProcessor:
                     'Upgrade-Insecure-Requests': '1',
                 })
             
-            # Create session for better connection handling
-            session = requests.Session()
-            session.headers.update(headers)
+            # Process-wide keep-alive pool: repeated hosts reuse their connections
+            session = get_session()
             
-            # Make request with retries
+            # Make request with retries; the origin guard rate limits each origin and
+            # fails fast (OriginUnavailable) on open circuits and recently dead URLs
             max_retries = 3
             for attempt in range(max_retries):
                 try:
                     # Shorter timeout for Google Drive to prevent hanging
                     timeout = 30 if 'drive.google.com' in url else 60
-                    response = session.get(url, stream=True, timeout=timeout, allow_redirects=True)
+                    origin_guard.acquire(url, cancel_token)
+                    response = close_on_cancel(session.get(url, headers=headers, stream=True, timeout=timeout, allow_redirects=True))
+                    origin_guard.record(url, response.status_code, response.headers.get('retry-after'))
                     response.raise_for_status()
                     
                     # Log final URL after redirects
@@ -208,10 +211,12 @@ class VideoProcessor:
                     content_type = response.headers.get('content-type', '')
                     logger.info(f"Content-Type: {content_type}")
                     
+                    # The first bytes are checked on the GET itself instead of a separate HEAD probe
+                    body = response.iter_content(chunk_size=settings.download_chunk_size)
+                    first_chunk = next(body, b'')
+                    
                     # Special handling for Google Drive download confirmation
-                    if 'drive.google.com' in url and 'text/html' in content_type.lower():
-                        # Check if this is a download confirmation page
-                        first_chunk = next(response.iter_content(chunk_size=1024), b'')
+                    if 'drive.google.com' in url and looks_like_html(content_type, first_chunk):
                         response.close()
                         
                         if b'confirm=' in first_chunk or b'download_warning' in first_chunk:
@@ -224,35 +229,60 @@ class VideoProcessor:
                                 confirm_token = confirm_match.group(1)
                                 confirm_url = f"{url}&confirm={confirm_token}"
                                 logger.info(f"Retrying with confirm URL: {confirm_url}")
-                                response = session.get(confirm_url, stream=True, timeout=60, allow_redirects=True)
+                                origin_guard.acquire(confirm_url, cancel_token)
+                                response = close_on_cancel(session.get(confirm_url, headers=headers, stream=True, timeout=60, allow_redirects=True))
+                                origin_guard.record(confirm_url, response.status_code, response.headers.get('retry-after'))
                                 response.raise_for_status()
                                 content_type = response.headers.get('content-type', '')
                                 logger.info(f"Confirmed download Content-Type: {content_type}")
+                                body = response.iter_content(chunk_size=settings.download_chunk_size)
+                                first_chunk = next(body, b'')
                     
                     # Validate content type
-                    if content_type and not any(media_type in content_type.lower() for media_type in ['video', 'octet-stream', 'mp4', 'mpeg', 'binary']):
-                        if 'text/html' in content_type.lower():
-                            logger.error(f"Received HTML page instead of video file. URL may be incorrect.")
-                            logger.error(f"Response headers: {dict(response.headers)}")
-                            raise Exception("URL points to HTML page, not video file")
+                    if looks_like_html(content_type, first_chunk):
+                        logger.error(f"Received HTML page instead of video file. URL may be incorrect.")
+                        logger.error(f"Response headers: {dict(response.headers)}")
+                        response.close()
+                        origin_guard.reject_url(url, "HTML page")
+                        raise Exception("URL points to HTML page, not video file")
                     
                     # Get file size
                     total_size = int(response.headers.get('content-length', 0))
                     logger.info(f"Expected file size: {total_size} bytes")
                     
-                    # Download file
-                    downloaded = 0
-                    chunk_size = 8192
+                    # Large files from servers that support ranges come down over parallel connections
+                    segmented = False
+                    if total_size >= settings.segmented_download_min_size and supports_ranges(response):
+                        response.close()
+                        try:
+                            download_ranges(session, response.url, output_path, total_size, cancel_token, timeout, headers)
+                            segmented = True
+                        except RangeNotSupported as e:
+                            logger.info(f"Segmented download not possible ({e}), using a single stream")
+                            fallback_url = response.url
+                            origin_guard.acquire(fallback_url, cancel_token)
+                            response = close_on_cancel(session.get(fallback_url, headers=headers, stream=True, timeout=timeout))
+                            origin_guard.record(fallback_url, response.status_code, response.headers.get('retry-after'))
+                            response.raise_for_status()
+                            body = response.iter_content(chunk_size=settings.download_chunk_size)
+                            first_chunk = b''
                     
-                    with open(output_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=chunk_size):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded += len(chunk)
-                                
-                                # Progress logging every 1MB
-                                if downloaded % (1024 * 1024) < chunk_size:
-                                    logger.info(f"Downloaded: {downloaded}/{total_size} bytes")
+                    # Download file
+                    if not segmented:
+                        downloaded = 0
+                        
+                        with open(output_path, 'wb') as f:
+                            for chunk in itertools.chain([first_chunk], body):
+                                if cancel_token:
+                                    cancel_token.raise_if_cancelled()
+                                if chunk:
+                                    f.write(chunk)
+                                    downloaded += len(chunk)
+                                    BYTES_DOWNLOADED.inc(len(chunk))
+                                    
+                                    # Progress logging every 10MB
+                                    if downloaded % (10 * 1024 * 1024) < len(chunk):
+                                        logger.info(f"Downloaded: {downloaded}/{total_size} bytes")
                     
                     # Verify download
                     actual_size = os.path.getsize(output_path)
@@ -272,16 +302,37 @@ class VideoProcessor:
                     return output_path
                     
                 except requests.exceptions.RequestException as e:
+                    if cancel_token:
+                        cancel_token.raise_if_cancelled()
                     logger.warning(f"Attempt {attempt + 1} failed: {e}")
-                    if attempt == max_retries - 1:
+                    status = e.response.status_code if e.response is not None else None
+                    if status is None:
+                        origin_guard.record(url)
+                    if attempt == max_retries - 1 or status in PERMANENT_STATUSES:
                         raise
-                    time.sleep(2 ** attempt)  # Exponential backoff
+                    if status in THROTTLE_STATUSES and e.response.headers.get('retry-after'):
+                        continue  # acquire() waits out Retry-After on the next attempt
+                    # Exponential backoff
+                    if cancel_token:
+                        cancel_token.wait(2 ** attempt)
+                        cancel_token.raise_if_cancelled()
+                    else:
+                        time.sleep(2 ** attempt)
                     
         except Exception as e:
+            if cancel_token and cancel_token.cancelled and not isinstance(e, JobCancelled):
+                # The socket was closed under us by the cancel callback
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                raise JobCancelled("Download cancelled") from e
             logger.error(f"Failed to download {url}: {str(e)}")
             if os.path.exists(output_path):
                 os.remove(output_path)
             raise
+        finally:
+            # The token lives as long as the job; drop callbacks of responses that are done
+            for callback in cancel_callbacks:
+                cancel_token.remove_callback(callback)
     
     def normalize_clips(self, clips: List[VideoFileClip], target_resolution: Optional[str] = None) -> List[VideoFileClip]:
         """Normalize all clips to same resolution"""
@@ -303,108 +354,297 @@ class VideoProcessor:
         
         return normalized_clips
     
+    def parse_media_info(self, idx: int, media_info: Dict) -> Dict:
+        """Validate a media item and return its path, timing and type"""
+        file_path = media_info.get("path") or media_info.get("url")
+        if not file_path:
+            logger.error(f"Media info keys: {list(media_info.keys())}")
+            logger.error(f"Media info content: {media_info}")
+            raise ValueError(f"No file path or URL provided in media_info: {media_info}")
+        
+        duration = media_info.get("duration")
+        if duration is None:
+            logger.error(f"Duration is None in media_info: {media_info}")
+            raise ValueError(f"Duration is required but was None for media item {idx}")
+        
+        # Convert to float if needed
+        try:
+            duration = float(duration)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Invalid duration value: {duration}, type: {type(duration)}")
+            raise ValueError(f"Duration must be a number, got {duration} ({type(duration)})")
+        
+        start_time = media_info.get("start_time", 0)
+        if start_time is None:
+            start_time = 0
+        else:
+            try:
+                start_time = float(start_time)
+            except (TypeError, ValueError):
+                logger.error(f"Invalid start_time value: {start_time}")
+                start_time = 0
+        
+        return {
+            "index": idx,
+            "path": file_path,
+            "duration": duration,
+            "start_time": start_time,
+            "media_type": media_info.get("media_type", "auto")
+        }
+    
+    def download_name(self, idx: int, url: str) -> str:
+        """Local file name for a downloaded media item"""
+        # Extract filename from URL or use index
+        url_path = urlparse(url).path
+        if url_path:
+            filename = os.path.basename(url_path)
+            name, ext = os.path.splitext(filename)
+            if not ext:
+                ext = '.mp4'
+        else:
+            name = f"temp_{idx}"
+            ext = '.mp4'
+        return f"{name}_{idx}{ext}"
+    
+    def fetch_media(self, idx: int, url: str, dest_path: str, cancel_token: Optional[CancelToken] = None) -> str:
+        """Download a media item and check that it can be opened"""
+        logger.info(f"Downloading media {idx}: {url}")
+        logger.info(f"Saving to: {dest_path}")
+        
+        with stage_timer("download", item=idx):
+            self.download_file(url, dest_path, cancel_token)
+        
+        # Verify downloaded file
+        if os.path.exists(dest_path):
+            file_size = os.path.getsize(dest_path)
+            logger.info(f"Downloaded file size: {file_size} bytes")
+            record_bytes("download", file_size, item=idx)
+            
+            # Test if file can be opened by MoviePy
+            try:
+                with stage_timer("probe", item=idx):
+                    test_clip = VideoFileClip(dest_path)
+                    test_duration = test_clip.duration
+                    test_clip.close()
+                logger.info(f"File verified, duration: {test_duration}s")
+            except Exception as ve:
+                logger.error(f"Failed to verify video file: {ve}")
+                raise
+        else:
+            raise Exception(f"Downloaded file not found: {dest_path}")
+        
+        return dest_path
+    
+    def load_clip(self, file_path: str, media: Dict, fps: int):
+        """Open a local media file as a trimmed clip of the requested duration"""
+        media_type = media["media_type"]
+        
+        # Auto-detect media type if needed
+        if media_type == "auto":
+            media_type = self.detect_media_type(file_path)
+        
+        # Process based on type
+        with stage_timer("probe", item=media.get("index")):
+            if media_type == "video":
+                return self.process_video(file_path, media["duration"], media["start_time"])
+            return self.process_image(file_path, media["duration"], fps)
+    
+    def encode(self, clip, output_path: str, item: Optional[int] = None, **write_params):
+        """write_videofile, recording encode throughput.
+
+        MoviePy renders frames lazily, so this also covers decoding,
+        resizing and compositing the sources (of media item ``item`` when
+        a single item is encoded).
+        """
+        started = time.perf_counter()
+        with stage_timer("encode", item=item):
+            clip.write_videofile(output_path, **write_params)
+        elapsed = time.perf_counter() - started
+        if elapsed > 0 and clip.duration:
+            ENCODE_FPS.observe(clip.duration * write_params.get("fps", 30) / elapsed)
+    
+    def write_params(self, output_settings: Dict) -> Dict:
+        """Encoder parameters for the requested codec and quality"""
+        # Apply quality settings (optimized for faster encoding)
+        quality_presets = {
+            "low": {"bitrate": "500k", "preset": "ultrafast"},
+            "medium": {"bitrate": "1M", "preset": "faster"},
+            "high": {"bitrate": "2M", "preset": "fast"}
+        }
+        
+        quality = output_settings.get("quality", "medium")
+        preset_settings = quality_presets.get(quality, quality_presets["medium"])
+        
+        return {
+            "codec": output_settings.get("codec", "libx264"),
+            "audio_codec": output_settings.get("audio_codec", "aac"),
+            "fps": output_settings.get("fps", 30),
+            "bitrate": preset_settings["bitrate"],
+            "preset": preset_settings["preset"]
+        }
+    
+    def target_size(self, output_settings: Dict, file_path: str, media: Dict) -> tuple:
+        """Output resolution: the requested one, else the size of the first item"""
+        if output_settings.get("resolution"):
+            width, height = map(int, output_settings["resolution"].split('x'))
+            return width, height
+        clip = self.load_clip(file_path, {**media, "duration": min(media["duration"], 1)}, 1)
+        try:
+            return tuple(clip.size)
+        finally:
+            clip.close()
+    
+    def render_segment(
+        self,
+        file_path: str,
+        media: Dict,
+        segment_path: str,
+        output_settings: Dict,
+        size: tuple
+    ) -> bool:
+        """Encode one media item as a normalized segment; returns whether it has audio.
+
+        Every segment shares resolution, fps, codec settings and an audio
+        track (silence when the source has none), so segments can be joined
+        by ``concat_segments`` without re-encoding the video.
+        """
+        fps = output_settings.get("fps", 30)
+        clip = self.load_clip(file_path, media, fps)
+        try:
+            with stage_timer("render", item=media.get("index")):
+                if tuple(clip.size) != tuple(size):
+                    clip = clip.resize(size)
+                
+                has_audio = clip.audio is not None
+                if not has_audio:
+                    silence = AudioClip(
+                        lambda t: np.zeros((len(t), 2)) if np.ndim(t) else np.zeros(2),
+                        duration=clip.duration,
+                        fps=44100
+                    )
+                    clip = clip.set_audio(silence)
+            
+            # Encode to a temporary name so a crash never leaves a truncated segment
+            tmp_path = segment_path + ".part.mp4"
+            self.encode(
+                clip,
+                tmp_path,
+                item=media.get("index"),
+                logger=None,
+                audio_fps=44100,
+                temp_audiofile=tmp_path + ".m4a",
+                **self.write_params(output_settings)
+            )
+            os.replace(tmp_path, segment_path)
+            return has_audio
+        finally:
+            clip.close()
+    
+    def concat_segments(self, segment_paths: List[str], output_path: str, with_audio: bool = True):
+        """Join normalized segments with the ffmpeg concat demuxer.
+
+        Video is stream-copied; audio is re-encoded (cheap) so segments whose
+        sources had different channel layouts still join cleanly.
+        """
+        list_path = output_path + ".segments.txt"
+        with open(list_path, "w") as f:
+            for path in segment_paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        
+        cmd = [
+            get_ffmpeg_exe(), '-y', '-v', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-c:v', 'copy',
+        ]
+        cmd += ['-c:a', 'aac', '-ac', '2', '-ar', '44100'] if with_audio else ['-an']
+        cmd += ['-movflags', '+faststart', output_path]
+        
+        try:
+            logger.info(f"Concatenating {len(segment_paths)} segments into {output_path}")
+            with stage_timer("concat"):
+                result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise Exception(f"ffmpeg concat failed: {result.stderr.strip()}")
+        finally:
+            if os.path.exists(list_path):
+                os.remove(list_path)
+    
     def process_media_files(
         self, 
         media_files: List[Dict],
         output_path: str,
         output_settings: Dict,
-        progress_callback: Optional[Callable[[int, str], None]] = None
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_token: Optional[CancelToken] = None,
+        checkpoint: Optional[JobCheckpoint] = None
+    ):
+        """Process multiple media files and concatenate them.
+
+        When ``cancel_token`` fires, downloads are interrupted, the ffmpeg
+        processes spawned for this call are killed and JobCancelled is raised.
+        With a ``checkpoint``, items are rendered as separate segments and
+        every completed download, segment and the output are recorded, so a
+        rerun of the same job skips finished work.
+        """
+        with bind_token(cancel_token):
+            try:
+                if checkpoint is not None:
+                    self._process_segments(media_files, output_path, output_settings, progress_callback, cancel_token, checkpoint)
+                else:
+                    self._process_media_files(media_files, output_path, output_settings, progress_callback, cancel_token)
+            except Exception as e:
+                # Never leave a half-written output behind
+                if os.path.exists(output_path) and not (checkpoint and checkpoint.completed_output()):
+                    os.remove(output_path)
+                if cancel_token and cancel_token.cancelled:
+                    logger.info(f"Processing cancelled: {output_path}")
+                    if isinstance(e, JobCancelled):
+                        raise
+                    raise JobCancelled("Processing cancelled") from e
+                logger.error(f"Error in process_media_files: {str(e)}")
+                raise
+    
+    def _process_media_files(
+        self,
+        media_files: List[Dict],
+        output_path: str,
+        output_settings: Dict,
+        progress_callback: Optional[Callable[[int, str], None]],
+        cancel_token: Optional[CancelToken]
     ):
-        """Process multiple media files and concatenate them"""
+        def check_cancelled():
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
         
         clips = []
+        final_clip = None
         total_files = len(media_files)
         
-        # Process each media file
+        # Process each media file; downloads go to a per-call scratch directory
         temp_files = []
+        work_dir = tempfile.mkdtemp(prefix="job_", dir=self.temp_dir)
         try:
             for idx, media_info in enumerate(media_files):
+                check_cancelled()
+                
                 # More granular progress reporting
                 base_progress = int((idx / total_files) * 40)  # 0-40% for processing files
                 if progress_callback:
                     progress_callback(base_progress, f"Starting file {idx + 1}/{total_files}")
                 
-                file_path = media_info.get("path") or media_info.get("url")
-                if not file_path:
-                    logger.error(f"Media info keys: {list(media_info.keys())}")
-                    logger.error(f"Media info content: {media_info}")
-                    raise ValueError(f"No file path or URL provided in media_info: {media_info}")
-                
-                duration = media_info.get("duration")
-                if duration is None:
-                    logger.error(f"Duration is None in media_info: {media_info}")
-                    raise ValueError(f"Duration is required but was None for media item {idx}")
+                media = self.parse_media_info(idx, media_info)
+                file_path = media["path"]
                 
-                # Convert to float if needed
-                try:
-                    duration = float(duration)
-                except (TypeError, ValueError) as e:
-                    logger.error(f"Invalid duration value: {duration}, type: {type(duration)}")
-                    raise ValueError(f"Duration must be a number, got {duration} ({type(duration)})")
-                
-                start_time = media_info.get("start_time", 0)
-                if start_time is None:
-                    start_time = 0
-                else:
-                    try:
-                        start_time = float(start_time)
-                    except (TypeError, ValueError):
-                        logger.error(f"Invalid start_time value: {start_time}")
-                        start_time = 0
-                        
-                media_type = media_info.get("media_type", "auto")
-                
-                logger.info(f"Processing media {idx}: file_path={file_path}, duration={duration}, start_time={start_time}")
+                logger.info(f"Processing media {idx}: file_path={file_path}, duration={media['duration']}, start_time={media['start_time']}")
                 
                 # Download file if it's a URL
                 if file_path.startswith(('http://', 'https://')):
-                    # Extract filename from URL or use index
-                    url_path = urlparse(file_path).path
-                    if url_path:
-                        filename = os.path.basename(url_path)
-                        name, ext = os.path.splitext(filename)
-                        if not ext:
-                            ext = '.mp4'
-                    else:
-                        name = f"temp_{idx}"
-                        ext = '.mp4'
-                    
-                    temp_file = os.path.join(self.temp_dir, f"{name}_{idx}{ext}")
-                    logger.info(f"Downloading media {idx}: {file_path}")
-                    logger.info(f"Saving to: {temp_file}")
-                    
-                    self.download_file(file_path, temp_file)
+                    temp_file = os.path.join(work_dir, self.download_name(idx, file_path))
                     temp_files.append(temp_file)
-                    file_path = temp_file
-                    
-                    # Verify downloaded file
-                    if os.path.exists(temp_file):
-                        file_size = os.path.getsize(temp_file)
-                        logger.info(f"Downloaded file size: {file_size} bytes")
-                        
-                        # Test if file can be opened by MoviePy
-                        try:
-                            test_clip = VideoFileClip(temp_file)
-                            test_duration = test_clip.duration
-                            test_clip.close()
-                            logger.info(f"File verified, duration: {test_duration}s")
-                        except Exception as ve:
-                            logger.error(f"Failed to verify video file: {ve}")
-                            raise
-                    else:
-                        raise Exception(f"Downloaded file not found: {temp_file}")
-                
-                # Auto-detect media type if needed
-                if media_type == "auto":
-                    media_type = self.detect_media_type(file_path)
-                
-                # Process based on type
-                if media_type == "video":
-                    clip = self.process_video(file_path, duration, start_time)
-                else:
-                    clip = self.process_image(file_path, duration, output_settings.get("fps", 30))
+                    file_path = self.fetch_media(idx, file_path, temp_file, cancel_token)
                 
-                clips.append(clip)
+                clips.append(self.load_clip(file_path, media, output_settings.get("fps", 30)))
                 
                 # Update progress after processing each file
                 progress = int(((idx + 1) / total_files) * 40)  # Complete at 40%
@@ -413,40 +653,27 @@ class VideoProcessor:
             
             if not clips:
                 raise ValueError("No valid clips to process")
+            check_cancelled()
             
             # Normalize clips to same resolution
             if progress_callback:
                 progress_callback(60, "Normalizing video dimensions...")
             
-            clips = self.normalize_clips(clips, output_settings.get("resolution"))
-            
-            # Concatenate clips
-            if progress_callback:
-                progress_callback(70, "Concatenating clips...")
-            
-            final_clip = concatenate_videoclips(clips, method="compose")
-            
-            # Apply quality settings (optimized for faster encoding)
-            quality_presets = {
-                "low": {"bitrate": "500k", "preset": "ultrafast"},
-                "medium": {"bitrate": "1M", "preset": "faster"},
-                "high": {"bitrate": "2M", "preset": "fast"}
-            }
-            
-            quality = output_settings.get("quality", "medium")
-            preset_settings = quality_presets.get(quality, quality_presets["medium"])
+            with stage_timer("render"):
+                clips = self.normalize_clips(clips, output_settings.get("resolution"))
+                
+                # Concatenate clips
+                if progress_callback:
+                    progress_callback(70, "Concatenating clips...")
+                
+                final_clip = concatenate_videoclips(clips, method="compose")
             
             # Export video
+            check_cancelled()
             if progress_callback:
                 progress_callback(80, "Encoding final video...")
             
-            write_params = {
-                "codec": output_settings.get("codec", "libx264"),
-                "audio_codec": output_settings.get("audio_codec", "aac"),
-                "fps": output_settings.get("fps", 30),
-                "bitrate": preset_settings["bitrate"],
-                "preset": preset_settings["preset"]
-            }
+            write_params = self.write_params(output_settings)
             
             # Add audio parameter if there's no audio
             if not any(hasattr(clip, 'audio') and clip.audio for clip in clips):
@@ -454,34 +681,27 @@ class VideoProcessor:
             
             logger.info(f"Writing video with params: {write_params}")
             
-            # Create progress callback for encoding
-            def encoding_progress(current_frame, total_frames):
-                if total_frames > 0:
-                    encode_progress = int((current_frame / total_frames) * 20)  # 80-100%
-                    if progress_callback:
-                        progress_callback(80 + encode_progress, f"Encoding {int((current_frame / total_frames) * 100)}%")
-            
-            # Add progress callback if MoviePy version supports it
             try:
-                final_clip.write_videofile(output_path, progress_bar=False, logger=None, **write_params)
+                self.encode(final_clip, output_path, progress_bar=False, logger=None, **write_params)
             except Exception as e:
                 logger.error(f"Error during video encoding: {e}")
                 raise
             
-            # Cleanup
-            for clip in clips:
-                clip.close()
-            final_clip.close()
-            
             if progress_callback:
                 progress_callback(100, "Processing complete!")
             
             logger.info(f"Video processing complete: {output_path}")
             
-        except Exception as e:
-            logger.error(f"Error in process_media_files: {str(e)}")
-            raise
         finally:
+            # Closing the clips stops their ffmpeg reader processes
+            for clip in clips:
+                try:
+                    clip.close()
+                except Exception as e:
+                    logger.warning(f"Failed to close clip: {e}")
+            if final_clip is not None:
+                final_clip.close()
+            
             # Cleanup temp files
             for temp_file in temp_files:
                 try:
@@ -489,4 +709,95 @@ class VideoProcessor:
                         os.remove(temp_file)
                         logger.info(f"Cleaned up temp file: {temp_file}")
                 except Exception as e:
-                    logger.warning(f"Failed to cleanup {temp_file}: {e}")
\ No newline at end of file
+                    logger.warning(f"Failed to cleanup {temp_file}: {e}")
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def _process_segments(
+        self,
+        media_files: List[Dict],
+        output_path: str,
+        output_settings: Dict,
+        progress_callback: Optional[Callable[[int, str], None]],
+        cancel_token: Optional[CancelToken],
+        checkpoint: JobCheckpoint
+    ):
+        def check_cancelled():
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+        
+        if checkpoint.completed_output() == output_path:
+            logger.info(f"Output already rendered for job {checkpoint.job_id}, skipping")
+            if progress_callback:
+                progress_callback(100, "Processing complete!")
+            return
+        
+        if not media_files:
+            raise ValueError("No valid clips to process")
+        
+        total_files = len(media_files)
+        segment_paths = []
+        segment_audio = []
+        work_dir = tempfile.mkdtemp(prefix="job_", dir=self.temp_dir)
+        try:
+            for idx, media_info in enumerate(media_files):
+                check_cancelled()
+                kept_segment = checkpoint.completed_segment(idx)
+                record_cache("checkpoint_segment", bool(kept_segment))
+                if kept_segment:
+                    logger.info(f"Segment {idx} of job {checkpoint.job_id} restored from checkpoint")
+                    segment_paths.append(kept_segment)
+                    segment_audio.append(checkpoint.segment_has_audio(idx))
+                    continue
+                
+                if progress_callback:
+                    progress_callback(int((idx / total_files) * 80), f"Rendering file {idx + 1}/{total_files}")
+                
+                media = self.parse_media_info(idx, media_info)
+                file_path = media["path"]
+                
+                # Download file if it's a URL, reusing a checkpointed download
+                if file_path.startswith(('http://', 'https://')):
+                    cached = checkpoint.completed_download(idx)
+                    record_cache("checkpoint_download", bool(cached))
+                    if cached:
+                        logger.info(f"Source {idx} of job {checkpoint.job_id} restored from checkpoint")
+                        file_path = cached
+                    else:
+                        tmp_path = os.path.join(work_dir, self.download_name(idx, file_path))
+                        self.fetch_media(idx, file_path, tmp_path, cancel_token)
+                        file_path = checkpoint.keep_download(idx, tmp_path)
+                
+                check_cancelled()
+                if not checkpoint.state.get("target_size"):
+                    checkpoint.state["target_size"] = list(self.target_size(output_settings, file_path, media))
+                    checkpoint.save()
+                
+                segment_path = os.path.join(work_dir, f"segment_{idx}.mp4")
+                has_audio = self.render_segment(
+                    file_path, media, segment_path, output_settings, checkpoint.state["target_size"]
+                )
+                segment_paths.append(checkpoint.keep_segment(idx, segment_path, has_audio))
+                segment_audio.append(has_audio)
+            
+            check_cancelled()
+            if progress_callback:
+                progress_callback(85, "Concatenating segments...")
+            
+            with_audio = any(segment_audio)
+            tmp_output = output_path + ".part.mp4"
+            try:
+                self.concat_segments(segment_paths, tmp_output, with_audio=with_audio)
+                os.replace(tmp_output, output_path)
+            finally:
+                # Left behind only if the concat failed or was cancelled
+                if os.path.exists(tmp_output):
+                    os.remove(tmp_output)
+            checkpoint.record_output(output_path)
+            
+            if progress_callback:
+                progress_callback(100, "Processing complete!")
+            
+            logger.info(f"Video processing complete: {output_path}")
+            
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
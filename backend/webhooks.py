@@ -0,0 +1,213 @@
+"""Signed webhook delivery for job and batch state changes"""
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "X-Webhook-Signature"
+TIMESTAMP_HEADER = "X-Webhook-Timestamp"
+EVENT_HEADER = "X-Webhook-Event"
+DELIVERY_HEADER = "X-Webhook-Delivery"
+
+# Status codes worth retrying; any other 4xx means the receiver rejected the payload
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def sign_payload(body: bytes, timestamp: str, secret: Optional[str] = None) -> str:
+    """Return the HMAC-SHA256 signature for a webhook body.
+
+    Receivers recompute ``hmac(secret, f"{timestamp}.{body}")`` and compare it
+    with the ``X-Webhook-Signature`` header (``sha256=<hex>``).
+    """
+    key = (secret or settings.webhook_secret or settings.secret_key).encode()
+    digest = hmac.new(key, timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+class WebhookDispatcher:
+    """Background delivery queue with retries and exponential backoff.
+
+    ``send`` only enqueues, so callers (processing workers) never wait on the
+    network. Delivery threads are started lazily on the first send.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+        backoff_base: Optional[float] = None,
+        backoff_max: Optional[float] = None,
+        timeout: Optional[float] = None,
+        max_queue_size: Optional[int] = None,
+        secret: Optional[str] = None,
+    ):
+        self.workers = workers or settings.webhook_workers
+        self.max_attempts = max_attempts or settings.webhook_max_attempts
+        self.backoff_base = backoff_base or settings.webhook_backoff_base
+        self.backoff_max = backoff_max or settings.webhook_backoff_max
+        self.timeout = timeout or settings.webhook_timeout
+        self.max_queue_size = max_queue_size or settings.webhook_queue_size
+        self.secret = secret
+
+        self._queue: List[tuple] = []  # heap of (due_time, seq, delivery)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._client: Optional[httpx.Client] = None
+        self._stopping = False
+        self.stats = {"sent": 0, "delivered": 0, "retried": 0, "failed": 0, "dropped": 0}
+
+    def send(self, url: str, event: str, payload: Dict[str, Any]) -> Optional[str]:
+        """Queue a signed POST of ``payload`` to ``url``; returns the delivery id.
+
+        The body gets ``occurred_at`` (UTC, when the event was queued), which
+        stays the same across retries.
+        """
+        delivery = {
+            "id": str(uuid.uuid4()),
+            "url": url,
+            "event": event,
+            "body": json.dumps(dict(payload, occurred_at=datetime.utcnow().isoformat()), default=str).encode(),
+            "attempt": 0,
+        }
+
+        with self._cond:
+            if len(self._queue) >= self.max_queue_size:
+                self.stats["dropped"] += 1
+                logger.warning(f"Webhook queue full, dropping {event} for {url}")
+                return None
+            self._ensure_started()
+            self.stats["sent"] += 1
+            heapq.heappush(self._queue, (time.monotonic(), next(self._seq), delivery))
+            self._cond.notify()
+
+        return delivery["id"]
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def stop(self, timeout: float = 5.0):
+        """Stop delivery threads; deliveries still queued are abandoned"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        if self._client:
+            self._client.close()
+            self._client = None
+
+    def _ensure_started(self):
+        # Called with self._cond held
+        if self._threads:
+            return
+        self._stopping = False
+        self._client = httpx.Client(timeout=self.timeout)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"webhook-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_delivery(self) -> Optional[dict]:
+        with self._cond:
+            while not self._stopping:
+                if self._queue:
+                    due = self._queue[0][0]
+                    wait = due - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self._queue)[2]
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+            return None
+
+    def _run(self):
+        while True:
+            delivery = self._next_delivery()
+            if delivery is None:
+                return
+            try:
+                self._deliver(delivery)
+            except Exception as e:
+                logger.error(f"Webhook delivery {delivery['id']} crashed: {e}")
+
+    def _deliver(self, delivery: dict):
+        delivery["attempt"] += 1
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            EVENT_HEADER: delivery["event"],
+            DELIVERY_HEADER: delivery["id"],
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign_payload(delivery["body"], timestamp, self.secret),
+        }
+
+        retry_after = None
+        try:
+            response = self._client.post(delivery["url"], content=delivery["body"], headers=headers)
+            if 200 <= response.status_code < 300:
+                self._count("delivered")
+                logger.info(f"Webhook {delivery['event']} delivered to {delivery['url']}")
+                return
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                self._count("failed")
+                logger.warning(
+                    f"Webhook {delivery['event']} rejected by {delivery['url']} "
+                    f"with status {response.status_code}, not retrying"
+                )
+                return
+            retry_after = response.headers.get("retry-after")
+            error = f"status {response.status_code}"
+        except httpx.HTTPError as e:
+            error = str(e) or type(e).__name__
+
+        if delivery["attempt"] >= self.max_attempts:
+            self._count("failed")
+            logger.error(
+                f"Webhook {delivery['event']} to {delivery['url']} failed after "
+                f"{delivery['attempt']} attempts: {error}"
+            )
+            return
+
+        delay = self._backoff(delivery["attempt"], retry_after)
+        logger.warning(
+            f"Webhook {delivery['event']} to {delivery['url']} failed ({error}), "
+            f"retrying in {delay:.1f}s"
+        )
+        with self._cond:
+            self.stats["retried"] += 1
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._seq), delivery))
+            self._cond.notify()
+
+    def _count(self, outcome: str):
+        with self._cond:
+            self.stats[outcome] += 1
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        # Jitter so receivers recovering from an outage are not hit in lockstep
+        return delay * random.uniform(0.5, 1.0)
+
+
+webhook_dispatcher = WebhookDispatcher()
@@ -487,6 +487,7 @@ function checkJobStatus() {
             sheet.getRange(row, config.resultColumn).setValue(`Processing ${job.progress}%`);
           } else if (job.status === 'completed') {
             // Prioritize Google Drive URL if available, otherwise use download URL
+            // (the Drive upload finishes in the background after completion)
             if (job.gdrive_url) {
               sheet.getRange(row, config.resultColumn).setValue(job.gdrive_url);
             } else if (job.output_url) {
@@ -503,8 +504,8 @@ function checkJobStatus() {
           }
         }
         
-        // Keep job in active list if still processing
-        if (job.status === 'pending' || job.status === 'processing') {
+        // Keep job in active list if still processing or uploading to Drive
+        if (job.status === 'pending' || job.status === 'processing' || job.gdrive_status === 'pending') {
           activeJobs.push(jobId);
         }
       }